@@ -0,0 +1,211 @@
+# coding: utf-8
+'''
+Writes synthetic model inputs for a zone system of any size: skims, TAZ / land use / zonal files, parameter workbooks,
+pre-MC trip tables and the files read by the scenario policies, with the file names, core names and nest structure
+that config.py and mode_choice.py expect.
+
+The files are laid out as the real inputs are, relative to a working folder root/model:
+	root/CTPS_Data_ModelOutputs_2040/	skims and pre-MC trip tables
+	root/LandUse/, root/Other/	zonal files, parameter workbooks, scenario inputs
+	root/output/	model outputs
+so the model runs on them unchanged from root/model.
+
+Usage: python generate_inputs.py root [n_zones] [seed]
+'''
+import os
+import sys
+import warnings
+import tables
+import numpy as np
+import pandas as pd
+import openmatrix as omx
+
+purposes = ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']
+segments = ['_PK_0Auto','_PK_wAuto','_OP_0Auto','_OP_wAuto']
+towns = ['CAMBRIDGE,MA','SOMERVILLE,MA','BROOKLINE,MA','NEWTON,MA','QUINCY,MA','WALTHAM,MA','LOWELL,MA','WORCESTER,MA']
+neighborhoods = ['Downtown','North End','West End','South Boston Waterfront','Chinatown','Bay Village','Back Bay',
+	'South End','Roxbury','Dorchester','Jamaica Plain','Allston','Brighton','Charlestown','East Boston']
+variables = ['IVTT','OVTT','Cost','Parking','length','Sqrlength','AccPEV','EgrPEV','PopD','EmpD','HHSize','VPW','wacc_fact','wegr_fact']
+coefficients = {'IVTT': -0.03, 'OVTT': -0.05, 'Cost': -0.2, 'Parking': -0.1, 'length': -0.3, 'Sqrlength': -0.2, 'AccPEV': 0.01,
+	'EgrPEV': 0.01, 'PopD': 0.002, 'EmpD': 0.002, 'HHSize': 0.1, 'VPW': 0.3, 'wacc_fact': 0.5, 'wegr_fact': 0.5}
+transit_availability = {'Boat': 0.02, 'CommRail': 0.4, 'Rapid_Transit': 0.5, 'LocalBus': 0.7} # share of OD pairs served
+
+
+def write_omx(out_fn, cores):
+	'''
+	:param out_fn: path of the .omx file
+	:param cores: dict, core name: table, or function returning the table (so that one table is held at a time)
+	'''
+	with omx.open_file(out_fn, 'w') as f, warnings.catch_warnings():
+		warnings.simplefilter('ignore', tables.NaturalNameWarning) # core names such as 'Length (Skim)'
+		for name, table in cores.items():
+			f[name] = table() if callable(table) else table
+
+
+class zone_system_generator(object):
+	'''
+	Synthetic zone system: zones scattered over a 30 x 30 mile region, the first zones (in the same share as the 447 of
+	2730 real zones) in central Boston. The region is the same for any number of zones, so finer systems have smaller zones.
+	'''
+	def __init__(self, n_zones = 2730, seed = 0):
+		'''
+		:param n_zones: number of zones
+		:param seed: random seed; the same seed and number of zones give the same files
+		'''
+		self.n = n_zones
+		self.n_boston = max(1, round(n_zones * 447 / 2730))
+		self.rng = np.random.default_rng(seed)
+		self.x = self.rng.uniform(0, 30, self.n)
+		self.y = self.rng.uniform(0, 30, self.n)
+		self.x[:self.n_boston] = self.rng.uniform(12, 18, self.n_boston)
+		self.y[:self.n_boston] = self.rng.uniform(12, 18, self.n_boston)
+		self.ids = np.arange(1, self.n + 1)
+
+	def distance(self, pad = 0):
+		'''
+		:param pad: number of extra zones (e.g. external stations) with a distance of 1 mile
+		:returns: float32 matrix of distances in miles
+		'''
+		dist = np.hypot(self.x[:,None] - self.x[None,:], self.y[:,None] - self.y[None,:]).astype(np.float32) + np.float32(0.3)
+		np.fill_diagonal(dist, 0.4)
+		return np.pad(dist, ((0,pad),(0,pad)), constant_values = 1) if pad else dist
+
+	def uniform(self, low, high):
+		return (low + (high - low) * self.rng.random((self.n, self.n), dtype = np.float32))
+
+	def write_skims(self, data_path):
+		dist = self.distance()
+		for period, congestion in [('AM', 1.3), ('MD', 1.0)]:
+			os.makedirs(os.path.join(data_path, period), exist_ok = True)
+			def toll():
+				toll = np.where(self.rng.random((self.n, self.n)) < 0.1, 2.0, 0.0).astype(np.float32)
+				np.fill_diagonal(toll, 1e7) # intrazonal auto trips are excluded through the toll, as in the real skims
+				return toll
+			write_omx(os.path.join(data_path, period, 'SOV_skim.omx'), {'CongTime': lambda: dist * 2 * congestion,
+				'TerminalTimes': lambda: np.full((self.n, self.n), 3, dtype = np.float32), 'Auto_Toll (Skim)': toll,
+				'Length (Skim)': dist})
+			for mode, served in transit_availability.items():
+				def ivtt(served = served, speed = 3):
+					ivtt = dist * speed * congestion * self.uniform(0.8, 1.2)
+					ivtt[self.rng.random((self.n, self.n)) >= served] = 0 # 0 IVTT: not served
+					return ivtt
+				write_omx(os.path.join(data_path, period, f'A_DAT_for_{mode}_tr_skim.omx'), {'Total_IVTT': ivtt,
+					'Total_OVTT': lambda: self.uniform(10, 20), 'Total_Cost': lambda: np.full((self.n, self.n), 2.4, dtype = np.float32)})
+			write_omx(os.path.join(data_path, period, 'WAT_for_All_tr_skim.omx'), {'Total_IVTT': lambda: ivtt(0.8, 3.5),
+				'Total_OVTT': lambda: self.uniform(12, 22), 'Total_Cost': lambda: np.full((self.n, self.n), 1.7, dtype = np.float32)})
+		del dist
+		dist = self.distance(pad = 5) # non-motorized skims have a few more zones than the other skims
+		write_omx(os.path.join(data_path, '2040_Bike_Skim.omx'), {'BikeTime': lambda: dist * 5, 'Length (Skim)': dist,
+			'OneMileorLess': lambda: (dist <= 1).astype(np.float32)})
+		write_omx(os.path.join(data_path, '2040_Walk_Skim.omx'), {'WalkTime': lambda: dist * 20, 'Length (Skim)': dist})
+
+	def trip_table(self, dist, purpose, growth = 1.0):
+		# trips decay with distance; school trips are mostly 0. Trips per zone scale with the zone size, so totals do not depend on n.
+		trips = self.rng.gamma(0.5, 2 * 2730 / self.n, (self.n, self.n)).astype(np.float32) * np.exp(-dist / 8) * growth
+		if purpose.startswith('HBSc'):
+			trips[self.rng.random((self.n, self.n)) < 0.8] = 0
+		return trips
+
+	def write_trip_tables(self, out_fn, growth = 1.0):
+		dist = self.distance()
+		write_omx(out_fn, {purpose + segment: (lambda purpose = purpose: self.trip_table(dist, purpose, growth))
+			for purpose in purposes for segment in segments})
+
+	def write_zonal_files(self, taz_path, misc_path):
+		rng, n = self.rng, self.n
+		boston = np.arange(n) < self.n_boston
+		town = np.where(boston, 'BOSTON,MA', np.array(towns)[rng.integers(0, len(towns), n)])
+		nhood = np.where(boston, np.array(neighborhoods)[np.arange(n) % len(neighborhoods)], None)
+		pd.DataFrame({'ID': self.ids, 'TAZ_ID': self.ids, 'ID_FOR_CS': self.ids, 'TOWN': town, 'BOSTON_NB': nhood}).to_csv(
+			os.path.join(misc_path, 'SW_TAZ_2010.csv'), index = False)
+		pd.DataFrame({'ID': self.ids, 'POP': rng.integers(100, 5000, n)}).to_csv(os.path.join(taz_path, 'Land_Use_2040.csv'), index = False)
+		parking = np.where(boston, rng.uniform(5, 30, n), np.where(rng.random(n) < 0.3, rng.uniform(0, 10, n), np.nan))
+		pd.DataFrame({'ID': self.ids, 'Daily Parking Cost': parking}).to_csv(os.path.join(taz_path, 'Land_Use_Parking_Costs.csv'), index = False)
+		zonal = pd.DataFrame({'TAZ_ID': self.ids, 'Acc_PEV': rng.uniform(1, 30, n), 'Egr_PEV': rng.uniform(1, 30, n),
+			'Tot_Pop': rng.uniform(100, 5000, n), 'Area': rng.uniform(0.2, 5, n) * 2730 / n, 'Tot_Emp': rng.uniform(10, 5000, n),
+			'HH_Pop': rng.uniform(100, 5000, n), 'HH': rng.uniform(50, 2000, n), 'VehiclesPerWorker': rng.uniform(0.2, 2, n),
+			'AM_wacc_fact': rng.uniform(0, 1, n), 'MD_wacc_fact': rng.uniform(0, 1, n), 'Hwy Prod Term Time': rng.uniform(1, 5, n)})
+		zonal.loc[rng.random(n) < 0.01, 'Acc_PEV'] = np.nan
+		zonal.iloc[::-1].to_csv(os.path.join(taz_path, 'TAZ_zonal_2040.csv'), index = False) # the model sorts the file by TAZ_ID
+
+		pd.DataFrame({'ID_FOR_CS': self.ids, 'UID': self.ids - 1, 'TOWN': [t.split(',')[0] for t in town],
+			'in_i95i93': np.arange(n) < 2 * self.n_boston, 'in_i495': np.arange(n) < 4 * self.n_boston}).to_csv(
+			os.path.join(misc_path, 'TAZ_by_interstate.csv'), index = False)
+		pd.DataFrame({'TOWN': ['BOSTON,MA','CAMBRIDGE,MA','SOMERVILLE,MA','BROOKLINE,MA','QUINCY,MA','NEWTON,MA'],
+			'subway': [1,1,1,1,1,0]}).to_csv(os.path.join(misc_path, 'MBTA_coverage.csv'), index = False)
+
+	def write_param_workbooks(self, misc_path):
+		for fn, smart_mobility in [('param_calib_0716.xlsx', False), ('param_calib_SM.xlsx', True), ('param_calib_SM_mngpol.xlsx', True)]:
+			with pd.ExcelWriter(os.path.join(misc_path, fn)) as writer:
+				for purpose in purposes:
+					self.param_table(purpose, smart_mobility).to_excel(writer, sheet_name = purpose, index = False)
+
+	def param_table(self, purpose, smart_mobility = False):
+		modes = [('DA','auto'), ('SR2','auto')] + ([('SR3+','auto')] if purpose == 'HBW' else []) + \
+			[('Walk','non-motorized'), ('Bike','non-motorized'), ('WAT','transit'), ('DAT_CR','transit'), ('DAT_RT','transit'),
+			('DAT_LB','transit'), ('DAT_B','transit')] + ([('SM_RA','smart mobility'), ('SM_SH','smart mobility')] if smart_mobility else [])
+		theta = {'auto': 0.7, 'non-motorized': 0.9, 'transit': 0.6, 'smart mobility': 0.8}
+		rows = []
+		for mode, nest in modes:
+			row = {'mode': mode, 'nest': nest, 'nest_coefficient': theta[nest]}
+			for pv in ['0_PK','1_PK','0_OP','1_OP']:
+				row['ASC_' + pv] = 0 if mode == 'DA' else self.rng.uniform(-2, 1)
+			for var in variables: # about 60% of the terms are used; unused terms are 0 or blank, as in the calibrated workbooks
+				used = self.rng.random() < 0.6
+				row[var] = coefficients[var] * self.rng.uniform(0.5, 1.5) if used else (np.nan if self.rng.random() < 0.5 else 0)
+			rows.append(row)
+		return pd.DataFrame(rows)
+
+	def write_scenario_inputs(self, misc_path):
+		rng, n = self.rng, self.n
+		k = max(10, n // 10) # OD pairs of the transit and bike project lists
+		rows, cols = rng.integers(0, n, k), rng.integers(0, n, k)
+		pd.DataFrame({'TAZ_0_skim': rows, 'TAZ_1_skim': cols,
+			'IVTT difference': np.where(rng.random(k) < 0.8, rng.uniform(0, 5, k), 0),
+			'OVTT difference': np.where(rng.random(k) < 0.5, rng.uniform(0, 3, k), 0)}).to_csv(
+			os.path.join(misc_path, 'transit_TAZ_and_time_savings.csv'), index = False)
+		pd.DataFrame({'TAZ_0_skim': rows, 'TAZ_1_skim': cols, 'factor_avg': rng.uniform(0, 0.3, k)}).to_csv(
+			os.path.join(misc_path, 'bike_trip_factors.csv'), index = False)
+		pd.DataFrame({'ID_FOR_CS': self.ids[rng.random(n) < 0.2]}).to_csv(os.path.join(misc_path, 'Densified_TAZs.csv'), index = False)
+		pd.DataFrame({'TOWN': [town.split(',')[0] for town in ['BOSTON,MA'] + towns], 'amount_to_shift': rng.uniform(100, 1000, len(towns) + 1),
+			'origin_trips_HH0': rng.uniform(1e4, 1e5, len(towns) + 1), 'origin_trips_HH1': rng.uniform(1e5, 1e6, len(towns) + 1)}).to_csv(
+			os.path.join(misc_path, 'trips_veh_ownership.csv'), index = False)
+		for folder, growth in [('Aggregated Matrix_2016', 0.9), ('Aggregated Matrix_2040NB', 1.0)]:
+			os.makedirs(os.path.join(misc_path, folder), exist_ok = True)
+			self.write_trip_tables(os.path.join(misc_path, folder, 'pre_MC_trip_6_purposes.omx'), growth)
+
+	def write(self, root):
+		'''
+		Writes all inputs under root.
+		:param root: folder of the inputs; the model runs from root/model
+		'''
+		data_path = os.path.join(root, 'CTPS_Data_ModelOutputs_2040')
+		taz_path, misc_path = os.path.join(root, 'LandUse'), os.path.join(root, 'Other')
+		for path in [data_path, taz_path, misc_path, os.path.join(root, 'output'), os.path.join(root, 'model')]:
+			os.makedirs(path, exist_ok = True)
+		self.write_zonal_files(taz_path, misc_path)
+		self.write_param_workbooks(misc_path)
+		self.write_skims(data_path)
+		self.write_trip_tables(os.path.join(data_path, 'pre_MC_trip_6_purposes.omx'))
+		self.write_scenario_inputs(misc_path)
+
+
+def generate(root, n_zones = 2730, seed = 0):
+	'''
+	Writes synthetic inputs for n_zones zones under root (see zone_system_generator.write), unless they are already there.
+	:returns: working folder to run the model from
+	'''
+	stamp = os.path.join(root, 'zone_system.txt')
+	if not os.path.isfile(stamp) or open(stamp).read() != f'{n_zones} {seed}':
+		zone_system_generator(n_zones, seed).write(root)
+		with open(stamp, 'w') as f:
+			f.write(f'{n_zones} {seed}')
+	return os.path.join(root, 'model')
+
+
+if __name__ == '__main__':
+	root = sys.argv[1]
+	n_zones = int(sys.argv[2]) if len(sys.argv) > 2 else 2730
+	seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+	generate(root, n_zones, seed)
+	print(f'Inputs for {n_zones} zones written to {root}.')
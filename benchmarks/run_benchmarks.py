@@ -0,0 +1,271 @@
+# coding: utf-8
+'''
+Times the steps of the mode choice pipeline, and measures the memory they allocate, on synthetic inputs
+(see generate_inputs.py) of several zone system sizes:
+	- Mode_Choice.load_input, generate_zonal_var, read_param, mode_probability_tables, calculate_trips_by_mode and a run for all purposes
+	- every scenario_editor policy, applied to a scenario copy of the base run
+	- the mc_util reports
+Each zone system size runs in its own process, so that memory use of one size does not carry over to the next.
+Memory is the peak of memory allocated during a step, as traced by tracemalloc (numpy arrays included, memory-mapped
+files not); tracing slows down Python code somewhat, --no-memory times the steps without it.
+A step that fails is recorded with its error, and the following steps still run (all but load_input).
+--check also runs all purposes in each execution mode (sparse demand, row blocks, streaming, worker processes, utility cache,
+derived tables) and checks that its trips equal those of the dense run (see check_execution_modes).
+
+Usage: python run_benchmarks.py [--zones 2730 5000 10000] [--root folder] [--out results.csv] [--precision float64] [--no-memory] [--spill] [--stream 256] [--check]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import warnings
+import numpy as np
+import pandas as pd
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_path))
+from generate_inputs import generate
+
+
+class step_timer(object):
+	'''
+	Records the run time and peak allocated memory of benchmark steps.
+	'''
+	def __init__(self, n_zones, trace_memory = True, out_fn = None):
+		'''
+		:param n_zones: number of zones
+		:param trace_memory: trace the memory allocated by steps
+		:param out_fn: csv file the results are written to after every step, so that they are kept if the process is killed
+		'''
+		self.n_zones = n_zones
+		self.trace_memory = trace_memory
+		self.out_fn = out_fn
+		self.results = []
+
+	def run(self, group, step, func, *args, **kwargs):
+		'''
+		:param group: step group, e.g. 'model', 'scenario' or 'report'
+		:param step: step name
+		:param func: function run by the step
+		:returns: return value of func, or None if it failed
+		'''
+		if self.trace_memory:
+			tracemalloc.start()
+		start = time.perf_counter()
+		value, error = None, ''
+		try:
+			value = func(*args, **kwargs)
+		except Exception as e:
+			error = f'{type(e).__name__}: {e}'.splitlines()[0][:200]
+		seconds = time.perf_counter() - start
+		peak_mb = None
+		if self.trace_memory:
+			peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+			tracemalloc.stop()
+		self.results.append({'zones': self.n_zones, 'group': group, 'step': step, 'seconds': round(seconds, 3),
+			'peak_mb': None if peak_mb is None else round(peak_mb, 1), 'error': error})
+		if self.out_fn:
+			pd.DataFrame(self.results).to_csv(self.out_fn, index = False)
+		print(f'{self.n_zones:>6} {group:<9} {step:<40} {seconds:9.2f} s' + (f' {peak_mb:9.1f} MB' if peak_mb is not None else '')
+			+ (f'  {error}' if error else ''), flush = True)
+		return value
+
+
+# settings of the dense run and of each execution mode checked against it (see check_execution_modes): config settings, number of runs
+dense_mode = {'sparse_demand': 0, 'block_rows': None, 'n_threads': 1, 'stream_rows': None, 'n_jobs': 1,
+	'utility_cache_memory': 0, 'utility_cache_disk': 0, 'derived_table_memory': 0}
+execution_modes = {
+	'sparse_demand': ({'sparse_demand': 1}, 1), # all segments evaluated by OD pairs with trips
+	'block_rows': ({'block_rows': 64, 'n_threads': 2}, 1),
+	'stream_rows': ({'stream_rows': 64, 'n_threads': 2}, 1),
+	'n_jobs': ({'n_jobs': 2}, 1),
+	'utility_cache': ({'utility_cache_memory': 1024}, 2), # the second run reads its utilities from the cache
+	'derived_tables': ({'derived_table_memory': 1024}, 2), # the second run reads its derived tables from the registry
+	}
+
+
+def run_all_purposes(config, settings, runs = 1):
+	'''
+	:param config: config module
+	:param settings: dict, config setting: value, set for the run and restored afterwards
+	:param runs: number of times all purposes are run
+	:returns: Mode_Choice object with the trip tables of all purposes
+	'''
+	import mode_choice
+	saved = {name: getattr(config, name) for name in settings}
+	try:
+		for name, value in settings.items():
+			setattr(config, name, value)
+		mc = mode_choice.Mode_Choice(config, run_now = False)
+		mc.load_input()
+		for run in range(runs):
+			mc.run_model(all_purposes = True)
+		return mc
+	finally:
+		for name, value in saved.items():
+			setattr(config, name, value)
+
+
+def compare_trips(mc, reference, rtol):
+	'''
+	:param mc: Mode_Choice object with the trip tables of all purposes
+	:param reference: Mode_Choice object with the trip tables of the dense run
+	:param rtol: largest difference allowed, relative to the largest trips of a table
+	:returns: largest relative difference
+	:raises: AssertionError if a trip table differs by more than rtol or is missing
+	'''
+	worst = 0
+	for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
+		expected_tables, tables = reference.table_container.get_table(purpose), mc.table_container.get_table(purpose)
+		for pv in expected_tables:
+			for mode in expected_tables[pv]:
+				if tables is None or mode not in tables[pv]:
+					raise AssertionError(f'no trip table for {purpose} {pv} {mode}')
+				expected, actual = np.asarray(expected_tables[pv][mode]), np.asarray(tables[pv][mode])
+				worst = max(worst, np.abs(actual - expected).max() / max(np.abs(expected).max(), 1e-12))
+				if worst > rtol:
+					raise AssertionError(f'trips of {purpose} {pv} {mode} differ from the dense run by {worst:.3g} (relative)')
+	return worst
+
+
+def check_execution_modes(timer, config, out_path):
+	'''
+	Runs all purposes densely and in each execution mode (execution_modes), and checks that every trip table equals that
+	of the dense run. Trip tables are kept in memory-mapped files, so that no more than two are compared in memory at a time.
+	:param timer: step_timer; each execution mode is a step of group 'check', with an error if its trips differ
+	:param config: config module
+	:param out_path: folder of the memory-mapped trip tables
+	'''
+	rtol = 1e-9 if config.precision == 'float64' else 1e-4
+	dense = dict(dense_mode, table_spill_path = out_path)
+	reference = timer.run('check', 'dense run', run_all_purposes, config, dense)
+	if reference is None:
+		return
+	for name, (settings, runs) in execution_modes.items():
+		timer.run('check', f'{name} equals dense run', lambda: compare_trips(run_all_purposes(config, dict(dense, **settings), runs), reference, rtol))
+
+
+def benchmark_zone_system(root, n_zones, precision = 'float64', trace_memory = True, out_fn = None, spill = False, stream_rows = None,
+	check = False):
+	'''
+	Runs all steps on the inputs of one zone system, from its working folder.
+	:param root: folder of the generated inputs
+	:param n_zones: number of zones
+	:param out_fn: csv file of the results, written after every step
+	:param spill: keep post-mode choice trip tables in memory-mapped files (config.table_spill_path)
+	:param stream_rows: stream origin zones in blocks of this many rows (config.stream_rows)
+	:param check: check that every execution mode gives the trips of the dense run (see check_execution_modes)
+	:returns: list of dicts, one per step
+	'''
+	os.chdir(os.path.join(root, 'model')) # input and output paths in config.py are relative to the working folder
+	warnings.simplefilter('ignore')
+	import config
+	import mc_util
+	import mode_choice
+	import scenario_editor as se
+	config.precision = precision
+	config.skim_cache_path = tempfile.mkdtemp(prefix = 'skim_cache_', dir = os.path.join(root, 'output')) # every run reads the skims cold
+	if spill:
+		config.table_spill_path = os.path.join(root, 'output')
+	config.stream_rows = stream_rows
+	timer = step_timer(n_zones, trace_memory, out_fn)
+	try:
+		mc = mode_choice.Mode_Choice(config, run_now = False)
+		timer.run('model', 'load_input', mc.load_input)
+		if timer.results[-1]['error']: # nothing else runs without inputs
+			return timer.results
+		timer.run('model', 'generate_zonal_var', mc.generate_zonal_var)
+		timer.run('model', 'read_param (HBW)', mc.read_param, 'HBW')
+		timer.run('model', 'mode_probability_tables (HBW 1_PK)', mc.mode_probability_tables, '1_PK', mc.param['mode'])
+		timer.run('model', 'calculate_trips_by_mode (HBW)', mc.calculate_trips_by_mode)
+		timer.run('model', 'run_model (all purposes)', mc.run_model, all_purposes = True, n_jobs = 1)
+
+		def policy(func, *args, **kwargs):
+			scen = mc.scenario_copy()
+			func(scen, *args, **kwargs)
+			return scen
+		no_scenario = dict.fromkeys(config.scenario_switches, False)
+		for step, func, args in [('decrease_driving_cost', se.decrease_driving_cost, [se.clean_veh_amount]),
+			('land_use_growth_shift', se.land_use_growth_shift, [se.land_use_shift_factor]),
+			('transit_modify_skim', se.transit_modify_skim, []),
+			('active_transportation_modify_skim', se.active_transportation_modify_skim, []),
+			('active_transportation_decrease_PEV', se.active_transportation_decrease_PEV, []),
+			('congestion_charge', se.congestion_charge, [se.congestion_charge_fee]),
+			('TDM_modify_skim_trip_table', se.TDM_modify_skim_trip_table, []),
+			('CAV_input_generator', lambda scen: se.CAV_input_generator(scen, switches = no_scenario), []),
+			('smart_mobility_shift_HH', se.smart_mobility_shift_HH, [])]:
+			timer.run('scenario', step, policy, func, *args)
+		def pivoted_run():
+			scen = policy(se.transit_modify_skim)
+			scen.run_model(all_purposes = True, n_jobs = 1, base = mc)
+			return scen
+		scen = timer.run('scenario', 'run_model (transit, pivoted)', pivoted_run)
+
+		out_path = config.out_path
+		timer.run('report', 'write_trip_tables', mc_util.write_trip_tables, mc, out_path + 'trip_tables.omx')
+		timer.run('report', 'write_mode_share_to_excel', mc_util.write_mode_share_to_excel, mc, 'all', out_path + 'mode_share.xlsx')
+		timer.run('report', 'mode_share_drift', mc_util.mode_share_drift, mc, scen, out_path + 'mode_share_drift.csv')
+		timer.run('report', 'write_summary_by_subregion', mc_util.write_summary_by_subregion, mc, out_path = out_path)
+		for report in [mc_util.vmt_by_neighborhood, mc_util.pmt_by_neighborhood, mc_util.mode_share_by_neighborhood]:
+			for by in [None, 'purpose']:
+				timer.run('report', report.__name__ + (f' (by {by})' if by else ''), report, mc, by = by)
+		timer.run('report', 'transit_ridership', mc_util.transit_ridership, mc)
+		if check:
+			check_execution_modes(timer, config, os.path.join(root, 'output'))
+	finally:
+		shutil.rmtree(config.skim_cache_path, ignore_errors = True)
+	return timer.results
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Benchmarks the mode choice pipeline on synthetic inputs.')
+	parser.add_argument('--zones', type = int, nargs = '+', default = [2730, 5000, 10000], help = 'zone system sizes')
+	parser.add_argument('--root', default = os.path.join(tempfile.gettempdir(), 'cfb_benchmark'),
+		help = 'folder of the generated inputs; inputs of each size are kept in a subfolder and reused')
+	parser.add_argument('--out', default = os.path.join(bench_path, 'results.csv'), help = 'csv file of the results')
+	parser.add_argument('--precision', default = 'float64', choices = ['float64','float32'])
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--no-memory', action = 'store_true', help = 'do not trace memory')
+	parser.add_argument('--spill', action = 'store_true', help = 'keep trip tables in memory-mapped files (config.table_spill_path)')
+	parser.add_argument('--stream', type = int, metavar = 'ROWS', help = 'stream origin zones in blocks of ROWS rows (config.stream_rows)')
+	parser.add_argument('--check', action = 'store_true', help = 'check that every execution mode gives the trips of the dense run')
+	parser.add_argument('--worker', action = 'store_true', help = argparse.SUPPRESS) # runs one size in this process
+	args = parser.parse_args()
+
+	if args.worker:
+		n_zones = args.zones[0]
+		benchmark_zone_system(os.path.join(args.root, str(n_zones)), n_zones, args.precision, not args.no_memory, args.out, args.spill, args.stream,
+			args.check)
+		return
+
+	results = []
+	for n_zones in args.zones:
+		root = os.path.join(args.root, str(n_zones))
+		print(f'Generating inputs for {n_zones} zones in {root}...', flush = True)
+		start = time.perf_counter()
+		generate(root, n_zones, args.seed)
+		print(f'Inputs ready in {time.perf_counter() - start:.1f} seconds.', flush = True)
+		worker_out = os.path.join(root, 'output', 'benchmark.csv')
+		command = [sys.executable, os.path.abspath(__file__), '--worker', '--zones', str(n_zones), '--root', args.root,
+			'--out', worker_out, '--precision', args.precision] + \
+			(['--no-memory'] if args.no_memory else []) + (['--spill'] if args.spill else []) + \
+			(['--stream', str(args.stream)] if args.stream else []) + (['--check'] if args.check else [])
+		if os.path.isfile(worker_out):
+			os.remove(worker_out)
+		returncode = subprocess.run(command).returncode
+		if os.path.isfile(worker_out):
+			results.append(pd.read_csv(worker_out, keep_default_na = False))
+		if returncode != 0: # e.g. killed when out of memory; the steps finished before are kept
+			results.append(pd.DataFrame([{'zones': n_zones, 'group': 'process', 'step': 'exit',
+				'error': f'benchmark process ended with exit code {returncode}'}]))
+	results = pd.concat(results, ignore_index = True)
+	results.to_csv(args.out, index = False)
+	print(f'Results written to {args.out}.')
+
+
+if __name__ == '__main__':
+	main()
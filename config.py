@@ -32,6 +32,10 @@ skim_list = ['drive_skim_PK',
 'bike_skim',
 'walk_skim']
 
+# folder in which skim cores are cached as .npy files, memory-mapped on later runs (e.g. out_path + 'skim_cache');
+# None disables the cache, so cores are read into memory and nothing is written next to the input files.
+skim_cache_path = None
+
 # pre-MC trip table
 pre_MC_trip_file = data_path + "pre_MC_trip_6_purposes.omx"
 
@@ -69,7 +73,7 @@ SM_SH_IVTT_factor = 1.3
 SM_SH_OVTT_factor = 1.3
 SM_SH_cost_factor = 1.3
 
-SM_RA_OVTT_table = 5 * np.ones((2730,2730))
+SM_RA_OVTT = 5 # minutes, applies to all OD pairs
 
 SM_distance_coef = 1.35
 SM_time_coef = 0.21
@@ -79,6 +83,58 @@ SM_SH_AO = 2 # average occupancy of shared smart mobility ride
 SM_VMT_overhead = 1.5
 
 
+# numerical precision of skims, zonal variables, utilities, probabilities and trip tables: 'float64' or 'float32'.
+# float32 halves memory traffic; logsums and exponents are still accumulated in float64.
+precision = 'float64'
+
+# number of worker processes for run_model(all_purposes = True); 1 runs purposes and market segments one after another
+n_jobs = 1
+
+# row-blocked evaluation: number of origin zones per block (None evaluates whole tables at once)
+# and number of threads that evaluate blocks
+block_rows = None
+n_threads = 1
+
+# out-of-core streaming for zone systems whose tables do not fit in memory: number of origin zones per block. Skim and pre-MC
+# trip rows are read from the .omx files block by block (cores edited by scenarios are read whole), and trip tables are written
+# to memory-mapped files in table_spill_path (out_path if None). Streamed runs use n_threads, are not run on worker processes
+# (n_jobs) and are not pivoted from a base run. None holds whole tables in memory.
+stream_rows = None
+
+# demand-aware evaluation: segments in which at most this share of OD pairs have trips are evaluated only for those OD pairs
+# (see Mode_Choice.trips_for_segment_by_cells); 0 evaluates all OD pairs. The container stores trip tables densely, so the
+# memory saved on sparse segments is only kept by writing them to memory-mapped files: sparse runs use table_spill_path,
+# out_path if None, where only the OD pairs with trips are written.
+sparse_demand = 0
+
+# utility cache: utility tables are reused across runs and scenarios whose inputs did not change (see mc_cache.py).
+# budgets in MB of tables kept in memory and on disk; 0 disables. None places the disk cache in the output path.
+utility_cache_memory = 0
+utility_cache_disk = 0
+utility_cache_path = None
+
+# derived variable tables (e.g. transit IVTT with missing paths set to 1e4, drive cost, smart mobility fare) are computed once and
+# kept until one of their inputs changes (see mc_derived.py): budget in MB, e.g. 1024; 0 (default) computes them on every use.
+derived_table_memory = 0
+
+# folder for post-mode choice trip tables written to disk (memory-mapped) as soon as each purpose is stored, which bounds the
+# memory of all-purpose and CAV runs; None keeps all trip tables in memory.
+table_spill_path = None
+
+# trip table output (mc_util.write_trip_tables): rows per HDF5 chunk, compression library ('zlib', 'blosc', 'blosc:lz4', ...)
+# and compression level (0 - 9)
+omx_chunk_rows = 64
+omx_complib = 'zlib'
+omx_complevel = 1
+
+# instrumentation (see mc_trace.py): timed spans of input reading, parameter and utility evaluation, scenario edits and
+# reports are written after each run_model to trace_file, as JSON (.json) or CSV; None disables tracing.
+# trace_memory also records bytes allocated by each span (tracemalloc, slows runs down); profile_file writes cProfile
+# statistics of the main thread (read with pstats).
+trace_file = None
+trace_memory = False
+profile_file = None
+
 # output path
 out_path = r'../output//'
 
@@ -0,0 +1,132 @@
+# coding: utf-8
+import os
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class utility_cache(object):
+	'''
+	Least-recently-used cache of utility tables, keyed by a hash of the utility signature (see Mode_Choice.utility_signature):
+	coefficients and the identities of the skim cores, zonal variables and scalars the utility reads.
+	Tables evicted from memory are kept as .npy files, up to a disk budget; files are found again by later runs.
+	'''
+	def __init__(self, memory_budget, disk_budget = 0, cache_path = None):
+		'''
+		:param memory_budget: bytes of tables kept in memory; 0 keeps none
+		:param disk_budget: bytes of tables kept on disk; 0 keeps none
+		:param cache_path: folder for tables kept on disk
+		'''
+		self.memory_budget = memory_budget
+		self.disk_budget = disk_budget if cache_path else 0
+		self.cache_path = cache_path
+		self._memory = OrderedDict() # key: table
+		self._disk = OrderedDict() # key: bytes
+		self._memory_size = 0
+		self._disk_size = 0
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		if self.disk_budget:
+			os.makedirs(cache_path, exist_ok = True)
+			files = [entry for entry in os.scandir(cache_path) if entry.name.endswith('.npy')]
+			for entry in sorted(files, key = lambda entry: entry.stat().st_mtime):
+				self._disk[entry.name[:-len('.npy')]] = entry.stat().st_size
+				self._disk_size += entry.stat().st_size
+			self._trim_disk()
+
+	@staticmethod
+	def key(signature):
+		'''
+		:param signature: hashable tuple of numbers and strings
+		:returns: hash of the signature
+		'''
+		return hashlib.sha1(repr(signature).encode()).hexdigest()
+
+	def get(self, signature):
+		'''
+		:param signature: utility signature
+		:returns: cached table (read-only), or None
+		'''
+		key = self.key(signature)
+		with self._lock:
+			if key in self._memory:
+				self._memory.move_to_end(key)
+				self.hits += 1
+				return self._memory[key]
+			if key not in self._disk:
+				self.misses += 1
+				return None
+			self._disk.move_to_end(key)
+		try:
+			table = np.load(self._file(key))
+			os.utime(self._file(key))
+		except (OSError, ValueError):
+			with self._lock:
+				self._disk_size -= self._disk.pop(key, 0)
+				self.misses += 1
+			return None
+		table.flags.writeable = False
+		with self._lock:
+			self.hits += 1
+			self._add(key, table)
+		return table
+
+	def put(self, signature, table):
+		'''
+		Stores a copy of a table.
+		:param signature: utility signature
+		:param table: numpy array
+		'''
+		if table.nbytes > max(self.memory_budget, self.disk_budget):
+			return
+		table = np.array(table)
+		table.flags.writeable = False
+		with self._lock:
+			self._add(self.key(signature), table)
+
+	def clear(self):
+		'''Removes all tables from memory; tables on disk are kept.'''
+		with self._lock:
+			self._memory.clear()
+			self._memory_size = 0
+
+	def _file(self, key):
+		return os.path.join(self.cache_path, key + '.npy')
+
+	def _add(self, key, table):
+		if key in self._memory:
+			self._memory.move_to_end(key)
+			return
+		self._memory[key] = table
+		self._memory_size += table.nbytes
+		while self._memory_size > self.memory_budget:
+			key, table = self._memory.popitem(last = False)
+			self._memory_size -= table.nbytes
+			self._spill(key, table)
+
+	def _spill(self, key, table):
+		# keeps a table evicted from memory on disk, evicting the least recently used files
+		if not self.disk_budget or key in self._disk:
+			return
+		try:
+			tmp_fn = f'{self._file(key)}.{uuid.uuid4().hex}.tmp'
+			with open(tmp_fn, 'wb') as f:
+				np.save(f, table)
+			os.replace(tmp_fn, self._file(key))
+		except OSError:
+			return
+		self._disk[key] = os.path.getsize(self._file(key))
+		self._disk_size += self._disk[key]
+		self._trim_disk()
+
+	def _trim_disk(self):
+		while self._disk_size > self.disk_budget:
+			key, size = self._disk.popitem(last = False)
+			self._disk_size -= size
+			try:
+				os.remove(self._file(key))
+			except OSError:
+				pass
@@ -0,0 +1,84 @@
+# coding: utf-8
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class derived_tables(object):
+	'''
+	Registry of derived variable tables: tables var_by_mode computes from skim cores, zonal variables and scalars, e.g. transit IVTT
+	with missing paths set to 1e4 or the smart mobility fare. Each table is computed once, when first used, and handed out read-only.
+	A table is stored in a slot (key) with the signature of its inputs (see Mode_Choice.derived_table); it is computed again only
+	when that signature changes, e.g. after a scenario edits one of its skim cores, so an edit invalidates only the tables derived
+	from the edited inputs. Least recently used tables are dropped beyond the memory budget.
+	'''
+	def __init__(self, memory_budget = 0):
+		'''
+		:param memory_budget: bytes of tables kept; 0 keeps none, so tables are computed on every call
+		'''
+		self.memory_budget = memory_budget
+		self._tables = OrderedDict() # key: (signature, table)
+		self._size = 0
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, signature, func):
+		'''
+		:param key: slot of the table, e.g. ('IVTT', 'DAT_CR', 'PK')
+		:param signature: hashable identity of the inputs of the table; None computes the table without keeping it
+		:param func: function without arguments that computes the table
+		:returns: table, read-only if kept
+		'''
+		if signature is None or not self.memory_budget:
+			return func()
+		with self._lock:
+			entry = self._tables.get(key)
+			if entry is not None and entry[0] == signature:
+				self._tables.move_to_end(key)
+				self.hits += 1
+				return entry[1]
+			self.misses += 1
+		table = np.asarray(func())
+		table.flags.writeable = False
+		with self._lock:
+			self._discard(key) # table of earlier inputs
+			if table.nbytes <= self.memory_budget:
+				self._tables[key] = (signature, table)
+				self._size += table.nbytes
+				while self._size > self.memory_budget:
+					self._discard(next(iter(self._tables)))
+		return table
+
+	def invalidate(self, match = None):
+		'''
+		Drops kept tables.
+		:param match: function of the key that is True for the tables dropped; None drops all
+		'''
+		with self._lock:
+			for key in [key for key in self._tables if match is None or match(key)]:
+				self._discard(key)
+
+	def _discard(self, key):
+		entry = self._tables.pop(key, None)
+		if entry is not None:
+			self._size -= entry[1].nbytes
+
+	def copy(self):
+		'''Returns a registry that starts with the tables of this one; tables are shared, later changes are not.'''
+		registry = derived_tables(self.memory_budget)
+		with self._lock:
+			registry._tables = OrderedDict(self._tables)
+			registry._size = self._size
+		return registry
+
+	def __len__(self):
+		return len(self._tables)
+
+	def __getstate__(self):
+		# copies sent to worker processes hold no tables
+		return {'memory_budget': self.memory_budget, '_tables': OrderedDict(), '_size': 0, 'hits': 0, 'misses': 0}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
@@ -0,0 +1,69 @@
+# coding: utf-8
+import numpy as np
+import pandas as pd
+
+
+class district_map(object):
+	'''
+	Assignment of zones to districts (e.g. Boston neighborhoods, towns, MBTA coverage), built once per zone system.
+	Zone vectors, and the margins or OD blocks of zone tables, are reduced to districts with np.bincount.
+	'''
+	def __init__(self, district_of_zone):
+		'''
+		:param district_of_zone: district label of each zone; NaN or None for zones outside all districts
+		'''
+		codes, districts = pd.factorize(pd.Series(district_of_zone, dtype = object), sort = True)
+		self.districts = list(districts)
+		self.code = codes # district index of each zone, -1 outside all districts
+		self.n = len(codes)
+		self._zones = np.flatnonzero(codes >= 0)
+		self._bins = codes[self._zones]
+
+	@classmethod
+	def from_table(cls, zones, column, n = None):
+		'''
+		:param zones: pandas DataFrame with the zone with index i at label i, e.g. mc_obj.taz_lu
+		:param column: column of district labels
+		:param n: number of zones; by default the number of rows of zones
+		:returns: district_map
+		'''
+		return cls(zones[column].reindex(range(len(zones) if n is None else n)).values)
+
+	def __len__(self):
+		return len(self.districts)
+
+	def reduce(self, vectors):
+		'''
+		:param vectors: array of zone values, of shape (..., n)
+		:returns: array of district sums, of shape (..., number of districts)
+		'''
+		vectors = np.asarray(vectors, dtype = float)
+		flat = vectors.reshape(-1, self.n)[:, self._zones]
+		bins = (np.arange(flat.shape[0]).reshape(-1,1) * len(self) + self._bins).reshape(-1)
+		sums = np.bincount(bins, flat.reshape(-1), minlength = flat.shape[0] * len(self))
+		return sums.reshape(vectors.shape[:-1] + (len(self),))
+
+	def margins(self, table):
+		'''
+		:param table: n x n zone table
+		:returns: 2 x districts array of production (row sums) and attraction (column sums) by district
+		'''
+		table = np.asarray(table)
+		return self.reduce(np.stack([table.sum(axis = 1), table.sum(axis = 0)]))
+
+	def indicator(self):
+		'''
+		:returns: n x districts 0/1 matrix
+		'''
+		indicator = np.zeros((self.n, len(self)))
+		indicator[self._zones, self._bins] = 1
+		return indicator
+
+	def od(self, table, attr = None):
+		'''
+		:param table: n x n zone table
+		:param attr: district_map of attraction zones; by default this map
+		:returns: districts x attraction districts array of OD sums
+		'''
+		attr = self if attr is None else attr
+		return self.reduce((np.asarray(table) @ attr.indicator()).T).T
@@ -0,0 +1,106 @@
+# coding: utf-8
+import numpy as np
+
+
+def nested_logit(utils, nest_of_mode, nest_coefficient, out = None):
+	'''
+	Computes nested logit probabilities from stacked mode utilities:
+	P(mode) = exp(theta_n * LS_n) / sum_k exp(theta_k * LS_k) * exp(U_mode) / exp(LS_n), with LS_n = log sum_{j in n} exp(U_j).
+	Logsums are computed with log-sum-exp, so no utility is exponentiated without a shift.
+	Unavailable alternatives are given a utility of -inf; nests without any available alternative get a logsum of -inf,
+	and OD pairs without any available alternative get a probability of 0 for all modes.
+	:param utils: numpy array, modes x OD dimensions
+	:param nest_of_mode: integer array, nest index of each mode
+	:param nest_coefficient: array, coefficient (theta) of each nest
+	:param out: output array with the shape of utils; may be utils itself, in which case utilities are overwritten with probabilities.
+	:returns: mode probabilities (modes x OD dimensions), nest logsums (nests x OD dimensions)
+	Logsums and exponents are accumulated in float64 whatever the type of utils; probabilities are written in the type of out.
+	'''
+	nest_of_mode = np.asarray(nest_of_mode)
+	if out is None:
+		out = np.empty_like(utils)
+	lowest = np.finfo(np.float64).min
+	logsums = np.empty((len(nest_coefficient),) + utils.shape[1:])
+	shift = np.empty(utils.shape[1:])
+	tmp = np.empty_like(shift)
+	total = np.empty_like(shift)
+
+	with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+		# nest logsums: LS_n = shift + log sum exp(U_j - shift), shift = max_j U_j
+		for nest in range(len(nest_coefficient)):
+			logsum = logsums[nest]
+			members = np.flatnonzero(nest_of_mode == nest)
+			if len(members) == 0:
+				logsum.fill(-np.inf)
+				continue
+			np.copyto(shift, utils[members[0]])
+			for m in members[1:]:
+				np.maximum(shift, utils[m], out = shift)
+			np.maximum(shift, lowest, out = shift) # keeps the shift finite where all utilities are -inf
+			logsum.fill(0)
+			for m in members:
+				np.subtract(utils[m], shift, out = tmp)
+				np.exp(tmp, out = tmp)
+				logsum += tmp
+			np.log(logsum, out = logsum)
+			logsum += shift
+
+		# denominator: D = log sum_k exp(theta_k * LS_k)
+		shift.fill(lowest)
+		for nest, theta in enumerate(nest_coefficient):
+			np.multiply(logsums[nest], theta, out = tmp)
+			np.maximum(shift, tmp, out = shift)
+		total.fill(0)
+		for nest, theta in enumerate(nest_coefficient):
+			np.multiply(logsums[nest], theta, out = tmp)
+			tmp -= shift
+			np.exp(tmp, out = tmp)
+			total += tmp
+		np.log(total, out = total)
+		total += shift
+		np.nan_to_num(total, copy = False, neginf = 0) # no alternative available: all utilities are -inf
+
+		# P(mode) = exp(U_mode + (theta_n - 1) * LS_n - D)
+		for m in range(utils.shape[0]):
+			nest = nest_of_mode[m]
+			np.copyto(tmp, logsums[nest])
+			np.nan_to_num(tmp, copy = False, neginf = 0) # no alternative in the nest available: all utilities are -inf
+			tmp *= nest_coefficient[nest] - 1
+			tmp -= total
+			tmp += utils[m]
+			np.exp(tmp, out = out[m])
+
+	return out, logsums
+
+
+def pivot_nested_logit(base_probs, delta_utils, nest_of_mode, nest_coefficient):
+	'''
+	Pivot-point form of nested_logit: applies utility changes to base-case probabilities,
+	P'(mode) = P(mode) exp(dU_mode) S_n^(theta_n - 1) / sum_k P(k) S_k^theta_k, with S_n = sum_{j in n} P(j|n) exp(dU_j).
+	Given the probabilities of a nested logit model, the result equals nested_logit of the changed utilities.
+	:param base_probs: numpy array, modes x OD dimensions; may be scaled by any positive factor per OD pair, e.g. trips by mode
+	:param delta_utils: numpy array of utility changes, modes x OD dimensions
+	:param nest_of_mode: integer array, nest index of each mode
+	:param nest_coefficient: array, coefficient (theta) of each nest
+	:returns: mode probabilities (modes x OD dimensions); 0 for OD pairs without base probabilities
+	'''
+	nest_of_mode = np.asarray(nest_of_mode)
+	base_probs = np.asarray(base_probs, dtype = np.float64)
+	weights = base_probs * np.exp(delta_utils)
+	factor = np.ones((len(nest_coefficient),) + base_probs.shape[1:])
+	total = np.zeros(base_probs.shape[1:])
+
+	with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+		for nest, theta in enumerate(nest_coefficient):
+			members = np.flatnonzero(nest_of_mode == nest)
+			if len(members) == 0:
+				continue
+			changed = weights[members].sum(axis = 0)
+			base = base_probs[members].sum(axis = 0)
+			# S_n^(theta_n - 1); nests without base probability stay at 0
+			np.power(np.where(base > 0, changed / base, 1), theta - 1, out = factor[nest])
+			total += changed * factor[nest]
+		probs = weights * factor[nest_of_mode] / total
+		np.nan_to_num(probs, copy = False, nan = 0, posinf = 0)
+
+	return probs
@@ -0,0 +1,85 @@
+# coding: utf-8
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+class od_edit(object):
+	'''
+	Defines an edit of a list of OD pairs (e.g. the zone pairs of a project list) with one value per pair.
+	The pairs are turned into index arrays once and applied to any number of tables or skim cores, with one fancy-indexed
+	update per core. A pair listed more than once is edited again, in list order, as if the pairs were edited one by one.
+	'''
+	def __init__(self, rows, cols, values, symmetric = False):
+		'''
+		:param rows: production zone (row) index of each pair
+		:param cols: attraction zone (column) index of each pair
+		:param values: value of each pair, passed to the edit function
+		:param symmetric: also edit the reverse pairs (cols, rows), after all the listed pairs
+		'''
+		rows, cols = np.asarray(rows, dtype = np.intp), np.asarray(cols, dtype = np.intp)
+		values = np.asarray(values, dtype = float)
+		if symmetric:
+			rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+			values = np.concatenate([values, values])
+		self.rows, self.cols, self.values = rows, cols, values
+
+		# rank of each pair among the earlier pairs of the same cell; pairs of equal rank touch distinct cells
+		order = np.lexsort((np.arange(len(rows)), cols, rows))
+		new_cell = np.ones(len(rows), dtype = bool)
+		new_cell[1:] = (np.diff(rows[order]) != 0) | (np.diff(cols[order]) != 0)
+		start = np.maximum.accumulate(np.where(new_cell, np.arange(len(rows)), 0))
+		rank = np.empty(len(rows), dtype = np.intp)
+		rank[order] = np.arange(len(rows)) - start
+		self._rounds = [np.flatnonzero(rank == r) for r in range(rank.max() + 1)] if len(rows) else []
+
+	@classmethod
+	def from_csv(cls, file_path, value_col, row_col = 'TAZ_0_skim', col_col = 'TAZ_1_skim', symmetric = False, skip_zero = False):
+		'''
+		:param file_path: csv file with one OD pair per line
+		:param value_col: column of the pair values
+		:param row_col: column of the production zone index
+		:param col_col: column of the attraction zone index
+		:param symmetric: also edit the reverse pairs
+		:param skip_zero: drop pairs whose value is 0
+		:returns: od_edit
+		'''
+		pairs = pd.read_csv(file_path)
+		if skip_zero:
+			pairs = pairs[pairs[value_col] != 0]
+		return cls(pairs[row_col].values, pairs[col_col].values, pairs[value_col].values, symmetric)
+
+	def __len__(self):
+		return len(self.rows)
+
+	def apply(self, table, func, name = None):
+		'''
+		Replaces the cells of the OD pairs with func(current cell values, pair values).
+		:param table: numpy array, or skim (see mc_skim_store.omx_skim) whose core name is edited
+		:param func: vectorized function of (cell values, pair values)
+		:param name: core name, if table is a skim
+		:returns: the edited table; a numpy array is edited in place unless it is read-only
+		'''
+		if name is None and not table.flags.writeable:
+			table = np.array(table)
+		for pairs in self._rounds:
+			cells = (self.rows[pairs], self.cols[pairs])
+			if name is None:
+				table[cells] = func(table[cells], self.values[pairs])
+			else:
+				table.update(name, cells, func(table.cells(name, cells), self.values[pairs]))
+		return table
+
+	def apply_all(self, cores, func, n_threads = 1):
+		'''
+		Applies the edit to several skim cores.
+		:param cores: list of (skim, core name); each core is listed once
+		:param func: vectorized function of (cell values, pair values)
+		:param n_threads: number of cores edited at the same time
+		'''
+		if n_threads > 1 and len(cores) > 1:
+			with ThreadPoolExecutor(max_workers = n_threads) as pool:
+				list(pool.map(lambda core: self.apply(core[0], func, core[1]), cores))
+		else:
+			for skim, name in cores:
+				self.apply(skim, func, name)
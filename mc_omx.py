@@ -0,0 +1,91 @@
+# coding: utf-8
+import queue
+import threading
+import numpy as np
+import tables
+import openmatrix as omx
+from mc_table_container import sparse_table
+
+
+class omx_writer(object):
+	'''
+	Writes tables to a new .omx file on a background thread, so that tables are compressed and written while the next ones are computed.
+	Tables are written in row chunks with the given HDF5 chunk shape and compression; chunks without any non-zero value are not
+	written at all (HDF5 reads them as 0), so sparse tables take little time and space.
+	Use as a context manager; leaving the context waits until all tables are written.
+	'''
+	def __init__(self, out_fn, chunk_rows = 64, complevel = 1, complib = 'zlib', max_pending = 2):
+		'''
+		:param out_fn: path of the output .omx file
+		:param chunk_rows: rows per HDF5 chunk; a chunk spans all columns
+		:param complevel: compression level, 0 (none) to 9
+		:param complib: compression library: 'zlib', 'blosc' or a blosc compressor such as 'blosc:lz4'
+		:param max_pending: number of tables queued before write() waits, which bounds the memory held by the writer
+		'''
+		self.out_fn = out_fn
+		self.chunk_rows = chunk_rows
+		self.filters = tables.Filters(complevel = complevel, complib = complib)
+		self._queue = queue.Queue(max_pending)
+		self._error = None
+		self._thread = threading.Thread(target = self._run, daemon = True)
+		self._thread.start()
+
+	def write(self, name, table):
+		'''
+		Queues a table for writing.
+		:param name: matrix name
+		:param table: 2-D numpy array (or memory map) or sparse_table; it must not be modified until written
+		:raises: the error of a previous write
+		'''
+		if self._error is not None:
+			raise self._error
+		self._queue.put((name, table))
+
+	def close(self):
+		'''
+		Waits until all queued tables are written and closes the file.
+		:raises: the error of a write
+		'''
+		if self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+		if self._error is not None:
+			raise self._error
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def _run(self):
+		try:
+			f = omx.open_file(self.out_fn, 'w')
+		except Exception as e:
+			self._error = e
+			f = None
+		try:
+			while True:
+				item = self._queue.get()
+				if item is None:
+					break
+				if self._error is None: # after an error, queued tables are dropped so that write() does not block
+					try:
+						self._write(f, *item)
+					except Exception as e:
+						self._error = e
+		finally:
+			if f is not None:
+				f.close()
+
+	def _write(self, f, name, table):
+		shape = np.shape(table)
+		dtype = table.dtype if hasattr(table, 'dtype') else np.asarray(table).dtype
+		chunk_rows = max(1, min(self.chunk_rows, shape[0]))
+		matrix = f.create_matrix(name, atom = tables.Atom.from_dtype(np.dtype(dtype)), shape = shape, filters = self.filters,
+			chunkshape = (chunk_rows, shape[1]))
+		for start in range(0, shape[0], chunk_rows):
+			stop = min(start + chunk_rows, shape[0])
+			chunk = table.rows(start, stop) if isinstance(table, sparse_table) else np.asarray(table[start:stop])
+			if chunk.any():
+				matrix[start:stop] = chunk
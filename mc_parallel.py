@@ -0,0 +1,149 @@
+# coding: utf-8
+import os
+import copy
+import types
+import uuid
+import shutil
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from mc_util import write_mode_share_to_excel
+from mc_table_container import purpose_tables
+from mc_trace import tracer
+
+
+class shared_tables(object):
+	'''
+	Dictionary-like set of read-only tables published as .npy files.
+	Only the file names are pickled; tables are memory-mapped on first access.
+	'''
+	def __init__(self, files):
+		'''
+		:param files: dict, table name: .npy file
+		'''
+		self.files = files
+		self._tables = {}
+
+	def __getitem__(self, name):
+		if name not in self._tables:
+			self._tables[name] = np.load(self.files[name], mmap_mode = 'r')
+		return self._tables[name]
+
+	def __contains__(self, name):
+		return name in self.files
+
+	def __iter__(self):
+		return iter(self.files)
+
+	def __len__(self):
+		return len(self.files)
+
+	def keys(self):
+		return self.files.keys()
+
+	def prefetch(self, names):
+		pass
+
+	def __getstate__(self):
+		return {'files': self.files, '_tables': {}}
+
+
+def publish_tables(tables, shared_dir):
+	'''
+	Writes a dictionary of tables to .npy files, unless tables already publishes itself (see mc_skim_store.omx_skim.publish).
+	:param tables: dict-like, name: numpy array
+	:param shared_dir: output folder
+	:returns: dict, table name: .npy file
+	'''
+	if hasattr(tables, 'publish'):
+		return tables.publish(shared_dir)
+	files = {}
+	for name in tables.keys():
+		files[name] = os.path.join(shared_dir, uuid.uuid4().hex + '.npy')
+		np.save(files[name], tables[name])
+	return files
+
+
+def worker_model(mc_obj, shared_dir):
+	'''
+	Returns a picklable copy of a mode choice object whose skims and pre-MC trip table are read from .npy files.
+	:param mc_obj: mode choice object with inputs loaded
+	:param shared_dir: folder for published tables
+	'''
+	model = copy.copy(mc_obj)
+	model.config = types.SimpleNamespace(**{k: v for k, v in vars(mc_obj.config).items()
+		if not k.startswith('__') and not isinstance(v, types.ModuleType)})
+	model.table_container = None
+	model.trips_by_mode = None
+	model.skims = None
+	model.utility_cache = None
+	model.trace = tracer() # spans are recorded by the parent process only
+	for skim_fn in mc_obj.skim_list:
+		setattr(model, skim_fn, shared_tables(publish_tables(getattr(mc_obj, skim_fn), shared_dir)))
+	model.set_skim_dicts()
+	model.pre_MC_trip_table = shared_tables(publish_tables(mc_obj.pre_MC_trip_table, shared_dir))
+	return model
+
+
+_model = None
+
+def _init_worker(model):
+	global _model
+	_model = model
+
+def _run_segment(purpose, param, pv, out_fn):
+	_model.set_param(param, purpose)
+	trips = _model.trips_for_segment(pv, param['mode'])
+	modes = list(trips)
+	out = np.lib.format.open_memmap(out_fn, mode = 'w+', dtype = trips[modes[0]].dtype, shape = (len(modes),) + trips[modes[0]].shape)
+	for i, mode in enumerate(modes):
+		out[i] = trips[mode]
+	out.flush()
+	return purpose, pv, modes, out_fn
+
+
+def run_parallel(mc_obj, purposes, n_jobs, shared_dir = None):
+	'''
+	Runs mode choice for each purpose and market segment on a process pool and stores the results in mc_obj.table_container.
+	Skims and the pre-MC trip table are published once as memory-mapped .npy files, so workers neither pickle nor reload them.
+	:param mc_obj: mode choice object with inputs loaded
+	:param purposes: list of purposes
+	:param n_jobs: number of worker processes
+	:param shared_dir: folder for published inputs and results; by default a temporary folder that is removed afterwards
+	'''
+	tmp_dir = tempfile.mkdtemp(prefix = 'mc_shared_', dir = shared_dir)
+	try:
+		# parameter tables are read here, which also reads the skim cores they use
+		params = {}
+		for purpose in purposes:
+			mc_obj.read_param(purpose)
+			params[purpose] = mc_obj.param
+		model = worker_model(mc_obj, tmp_dir)
+
+		results = {purpose: {} for purpose in purposes}
+		with ProcessPoolExecutor(n_jobs, initializer = _init_worker, initargs = (model,)) as pool:
+			futures = [pool.submit(_run_segment, purpose, params[purpose], pv, os.path.join(tmp_dir, f'{purpose}_{pv}.npy'))
+				for purpose in purposes for pv in mc_obj.peak_veh]
+			for future in futures:
+				purpose, pv, modes, out_fn = future.result()
+				results[purpose][pv] = (modes, out_fn)
+
+		for purpose in purposes:
+			mc_obj.set_param(params[purpose], purpose)
+			# worker results are memory-mapped and copied straight into the tables of the purpose (in its spill file, if any)
+			modes = list(dict.fromkeys(mode for pv in mc_obj.peak_veh for mode in results[purpose][pv][0]))
+			tables = purpose_tables(mc_obj.peak_veh, modes, mc_obj.shape, mc_obj.dtype, mc_obj.table_container.spill_file(purpose))
+			for pv in mc_obj.peak_veh:
+				segment_modes, out_fn = results[purpose][pv]
+				segment = np.load(out_fn, mmap_mode = 'r')
+				for i, mode in enumerate(segment_modes):
+					tables.set(pv, mode, segment[i])
+				del segment
+			if tables.path is not None:
+				tables.freeze()
+			mc_obj.trips_by_mode = tables
+			mc_obj.table_container.store_table(purpose)
+			write_mode_share_to_excel(mc_obj, purpose)
+			print(f'✓ Mode choice for {purpose} collected.')
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors = True)
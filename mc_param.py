@@ -0,0 +1,89 @@
+# coding: utf-8
+import os
+import uuid
+import numpy as np
+import pandas as pd
+
+
+class compiled_param(object):
+	'''
+	Defines the parameter table of one purpose compiled into arrays:
+	a modes x variables coefficient matrix, one ASC array per market segment and the nest structure.
+	'''
+	def __init__(self, param):
+		'''
+		:param param: parameter table (pandas DataFrame) as read from one sheet of the parameter workbook, NaN filled with 0
+		'''
+		asc_col = list(param.filter(regex='ASC'))
+		coef_col = ['mode','nest','nest_coefficient'] + asc_col
+		self.modes = list(param['mode'])
+		self.mode_index = {mode: i for i, mode in enumerate(self.modes)}
+		self.var_list = list(param.columns.drop(coef_col))
+		self.coef = param[self.var_list].values.astype(float) # modes x variables
+		self.asc = {col[len('ASC_'):]: param[col].values.astype(float) for col in asc_col} # market segment: ASC by mode
+
+		nest_thetas = dict(zip(param['nest'],param['nest_coefficient']))
+		self.nests = list(param['nest'].unique())
+		self.nest_of_mode = np.array([self.nests.index(nest) for nest in param['nest']])
+		self.nest_coefficient = np.array([nest_thetas[nest] for nest in self.nests], dtype = float)
+
+		# non-zero terms by mode, so that utilities only touch variables that apply to a mode
+		self.terms = [[(self.var_list[v], float(self.coef[m,v])) for v in np.flatnonzero(self.coef[m])] for m in range(len(self.modes))]
+
+	def mode_terms(self, mode):
+		'''
+		:param mode: mode name
+		:returns: list of (variable, coefficient) pairs with non-zero coefficient
+		'''
+		return self.terms[self.mode_index[mode]]
+
+	def mode_asc(self, mode, pv):
+		'''
+		:param mode: mode name
+		:param pv: market segment, e.g. '0_PK'
+		:returns: alternative specific constant
+		'''
+		return float(self.asc[pv][self.mode_index[mode]])
+
+
+def read_param_table(param_file, purpose, cache_path = None):
+	'''
+	Reads one sheet of a parameter workbook, NaN filled with 0.
+	Parsed sheets are cached as .npz files (mode, nest and coefficient arrays) keyed by the size and modification time of
+	the workbook, so the workbook is parsed once for all its sheets and not again until it changes.
+	:param param_file: path of the parameter workbook
+	:param purpose: sheet name
+	:param cache_path: folder for cached sheets; None places the cache next to the workbook, False disables caching.
+	:returns: pandas DataFrame
+	'''
+	if cache_path is False:
+		return pd.read_excel(param_file, sheet_name = purpose).fillna(0)
+	if cache_path is None:
+		cache_path = param_file + '.cache'
+	stat = os.stat(param_file)
+	cache_fn = os.path.join(cache_path, f'{os.path.basename(param_file)}_{stat.st_size}_{stat.st_mtime_ns}_{{}}.npz')
+
+	if os.path.isfile(cache_fn.format(purpose)):
+		with np.load(cache_fn.format(purpose)) as f:
+			param = pd.DataFrame(f['values'], columns = list(f['columns']))
+			param.insert(0, 'nest', f['nest'].astype(object))
+			param.insert(0, 'mode', f['mode'].astype(object))
+			order = list(f['order'])
+		return param[order]
+
+	sheets = pd.read_excel(param_file, sheet_name = None)
+	for sheet_name, param in sheets.items():
+		try:
+			_save_param_table(param.fillna(0), cache_fn.format(sheet_name))
+		except (OSError, ValueError, KeyError, TypeError):
+			break # cache folder not writable or sheet not in the parameter table format: parse the workbook next time
+	return sheets[purpose].fillna(0)
+
+
+def _save_param_table(param, fn):
+	os.makedirs(os.path.dirname(fn), exist_ok = True)
+	columns = [col for col in param.columns if col not in ('mode','nest')]
+	tmp_fn = f'{fn}.{uuid.uuid4().hex}.npz'
+	np.savez(tmp_fn, order = np.array(param.columns, dtype = str), columns = np.array(columns, dtype = str),
+		mode = param['mode'].values.astype(str), nest = param['nest'].values.astype(str), values = param[columns].values.astype(float))
+	os.replace(tmp_fn, fn)
@@ -0,0 +1,390 @@
+# coding: utf-8
+import os
+import re
+import copy
+import uuid
+import threading
+import numpy as np
+import openmatrix as omx
+
+
+class omx_skim(object):
+	'''
+	Dictionary-like view of the matrices (cores) of one .omx file.
+	The file is opened once; a core is only read when it is first accessed. Read cores are cached as .npy files
+	(keyed by the size and modification time of the .omx file) and handed out as read-only memory-mapped arrays.
+	Assigning a core, or updating some of its cells (update()), leaves the .omx file and its cache untouched: changes are kept
+	as a sparse edit (the cells that differ from the file) and applied to a copy of the core when it is read, or, if most cells
+	change, as an in-memory replacement. release() drops the edited copies, so a scenario only holds its edits between runs.
+	A streamed skim (stream = True) reads blocks of rows (rows()) directly from the .omx file, so a core is never held whole
+	unless it is accessed whole (e.g. by a scenario edit).
+	'''
+	max_sparse_fraction = 0.25 # edits of up to this share of cells are kept sparse
+
+	def __init__(self, file_path, cache_path = None, dtype = None, stream = False):
+		'''
+		:param file_path: path of the omx file.
+		:param cache_path: folder for cached cores; None or False disables caching (the folder of the omx file is not written to).
+		:param dtype: data type cores are converted to when read; None keeps the type stored in the file.
+		:param stream: read blocks of rows of cores that are not loaded from the file (see rows())
+		'''
+		self.file_path = file_path
+		self.dtype = None if dtype is None else np.dtype(dtype)
+		self.stream = stream
+		self._file = omx.open_file(file_path, 'r')
+		self.cores = list(self._file.list_matrices())
+		stat = os.stat(file_path)
+		self.file_id = (file_path, stat.st_size, stat.st_mtime_ns)
+		if not cache_path:
+			self.cache_dir = None
+		else:
+			self.cache_dir = os.path.join(cache_path, f'{os.path.basename(file_path)}_{stat.st_size}_{stat.st_mtime_ns}')
+			if self.dtype is not None:
+				self.cache_dir += '_' + self.dtype.name
+		self._base = {}
+		self._overrides = {} # name: replaced core
+		self._edits = {} # name: (sorted flat indices, values) of the cells that differ from the file
+		self._materialized = {} # name: core with its edits applied
+		self._lock = threading.Lock()
+		self._file_lock = threading.Lock() # HDF5 reads are not thread-safe
+		self.versions = dict.fromkeys(self.cores, 0)
+		self._tokens = {} # name: unique id of the replaced core
+
+	def __getitem__(self, name):
+		if name in self._overrides:
+			return self._overrides[name]
+		if name in self._edits:
+			base = self._base_core(name) # takes the lock to load the core, so it is read before the lock is taken here
+			with self._lock:
+				if name not in self._materialized:
+					index, values = self._edits[name]
+					table = np.array(base)
+					table.flat[index] = values
+					table.flags.writeable = False
+					self._materialized[name] = table
+				return self._materialized[name]
+		return self._base_core(name)
+
+	def __setitem__(self, name, value):
+		base = self._base_core(name) if name in self.cores else None
+		if base is not None and np.shape(value) == base.shape:
+			index = np.flatnonzero(np.asarray(value) != base)
+			if index.size <= self.max_sparse_fraction * base.size:
+				self._set_edits(name, (index, np.asarray(value).reshape(-1)[index].astype(base.dtype)))
+				return
+		self._edits.pop(name, None)
+		self._overrides[name] = value
+		self._changed(name)
+
+	def update(self, name, index, values):
+		'''
+		Replaces some cells of a core, without reading or copying the whole core.
+		:param name: core name
+		:param index: tuple of integer arrays indexing the cells, e.g. np.ix_(rows, cols) or (rows, cols) of OD pairs;
+		if a cell is listed more than once, the last value is kept.
+		:param values: new values, broadcastable to the shape of the index
+		'''
+		if name in self._overrides:
+			table = np.array(self._overrides[name])
+			table[index] = values
+			self[name] = table
+			return
+		base = self._base_core(name)
+		index = np.broadcast_arrays(*index)
+		flat = np.ravel_multi_index(index, base.shape).reshape(-1)[::-1]
+		values = np.broadcast_to(np.asarray(values, dtype = base.dtype), index[0].shape).reshape(-1)[::-1]
+		if name in self._edits:
+			flat = np.concatenate([flat, self._edits[name][0]])
+			values = np.concatenate([values, self._edits[name][1]])
+		flat, first = np.unique(flat, return_index = True) # keeps the newest value of every cell
+		self._set_edits(name, (flat, values[first]))
+
+	def release(self):
+		'''Drops the copies of edited cores made when they were read; edits are kept and applied again when needed.'''
+		with self._lock:
+			self._materialized = {}
+
+	def rows(self, name, rows):
+		'''
+		:param name: core name
+		:param rows: slice of rows
+		:returns: block of rows of a core; for an edited core, only the block is copied and edited.
+		A streamed skim reads the block from the file if the core is not loaded.
+		'''
+		streamed = self.stream and name in self.cores and name not in self._base
+		if name in self._overrides or name in self._materialized or (name not in self._edits and not streamed):
+			return self[name][rows]
+		start, stop, step = rows.indices(self.shape(name)[0])
+		if step != 1:
+			return self[name][rows]
+		table = self._read_rows(name, start, stop) if streamed else np.array(self._base_core(name)[start:stop])
+		if name not in self._edits:
+			return table
+		index, values = self._edits[name]
+		n = self.shape(name)[1]
+		first, last = np.searchsorted(index, [start * n, stop * n])
+		table.flat[index[first:last] - start * n] = values[first:last]
+		return table
+
+	def cells(self, name, index):
+		'''
+		:param name: core name
+		:param index: tuple of integer arrays indexing the cells, as in update()
+		:returns: values of some cells of a core; an edited core is not copied
+		'''
+		if name not in self._edits or name in self._materialized:
+			return self[name][index]
+		table = self._base_core(name)
+		values = np.array(table[index])
+		edit_index, edit_values = self._edits[name]
+		if not edit_index.size:
+			return values
+		flat = np.ravel_multi_index(np.broadcast_arrays(*index), table.shape)
+		pos = np.minimum(np.searchsorted(edit_index, flat), len(edit_index) - 1)
+		edited = edit_index[pos] == flat
+		values[edited] = edit_values[pos[edited]]
+		return values
+
+	def shape(self, name):
+		if name in self._overrides:
+			return self[name].shape
+		if name in self._base:
+			return self._base[name].shape
+		with self._file_lock:
+			return self._node(name).shape
+
+	def __contains__(self, name):
+		return name in self._overrides or name in self.cores
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def keys(self):
+		return self.cores + [name for name in self._overrides if name not in self.cores]
+
+	def items(self):
+		return [(name, self[name]) for name in self.keys()]
+
+	def prefetch(self, names):
+		'''
+		Reads the given cores (if present in the file) so that later accesses are served from the cache.
+		:param names: iterable of core names; streamed skims read nothing
+		'''
+		if self.stream:
+			return
+		for name in names:
+			if name in self.cores:
+				self[name]
+
+	def _base_core(self, name):
+		if name not in self._base:
+			with self._lock:
+				if name not in self._base:
+					self._base[name] = self._load(name)
+		return self._base[name]
+
+	def _set_edits(self, name, edits):
+		self._overrides.pop(name, None)
+		self._edits[name] = edits
+		self._changed(name)
+
+	def _changed(self, name):
+		with self._lock:
+			self._materialized.pop(name, None)
+		self.versions[name] = self.versions.get(name, 0) + 1
+		self._tokens[name] = uuid.uuid4().hex
+
+	def signature(self, name):
+		'''
+		:param name: core name
+		:returns: hashable identity of the current table of a core; it changes when the file changes or the core is replaced.
+		'''
+		return self.file_id + (name, self._tokens.get(name))
+
+	def changed_cells(self, base, name):
+		'''
+		:param base: omx_skim this skim was copied from (see copy), or the reverse
+		:param name: core name
+		:returns: sorted flat indices of the cells of a core that may differ between this skim and base: the cells edited in either;
+		None if the core is replaced in either or the skims read different files
+		'''
+		if self.file_id != base.file_id or name not in self.cores or name in self._overrides or name in base._overrides:
+			return None
+		no_edits = (np.zeros(0, dtype = np.intp),)
+		return np.union1d(self._edits.get(name, no_edits)[0], base._edits.get(name, no_edits)[0])
+
+	def copy(self):
+		'''
+		Returns a view of the same file whose cores can be replaced or edited without changing this object. Read cores, edits and
+		replaced cores are shared; replaced cores are made read-only, so they are copied before being modified.
+		'''
+		skim = copy.copy(self)
+		for table in self._overrides.values():
+			if isinstance(table, np.ndarray):
+				table.flags.writeable = False
+		skim._overrides = dict(self._overrides)
+		skim._edits = dict(self._edits)
+		skim._materialized = dict(self._materialized)
+		skim.versions = dict(self.versions)
+		skim._tokens = dict(self._tokens)
+		return skim
+
+	def loaded_cores(self):
+		return list(self._base) + [name for name in self._overrides if name not in self._base]
+
+	def publish(self, shared_dir):
+		'''
+		Makes the loaded cores available to other processes as .npy files. Cached cores are published as their cache file,
+		replaced, edited and uncached cores are written to shared_dir.
+		:param shared_dir: folder for cores that are not cached
+		:returns: dict, core name: .npy file
+		'''
+		files = {}
+		for name in self.loaded_cores():
+			if name not in self._overrides and name not in self._edits and self.cache_dir is not None and os.path.isfile(self._cache_file(name)):
+				files[name] = self._cache_file(name)
+			else:
+				files[name] = os.path.join(shared_dir, uuid.uuid4().hex + '.npy')
+				np.save(files[name], self[name])
+		return files
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def _node(self, name):
+		if self._file is None:
+			self._file = omx.open_file(self.file_path, 'r')
+		return self._file[name]
+
+	def _read_rows(self, name, start, stop):
+		# rows start to stop of a core, read from the file
+		with self._file_lock:
+			node = self._node(name)
+			return np.asarray(node[start:stop], dtype = node.dtype if self.dtype is None else self.dtype)
+
+	def _cache_file(self, name):
+		return os.path.join(self.cache_dir, re.sub(r'[^\w.-]', '_', name) + '.npy')
+
+	def _load(self, name):
+		with self._file_lock:
+			node = self._node(name)
+			dtype = node.dtype if self.dtype is None else self.dtype
+			if self.cache_dir is not None:
+				fn = self._cache_file(name)
+				if not os.path.isfile(fn):
+					try:
+						os.makedirs(self.cache_dir, exist_ok = True)
+						tmp_fn = fn + f'.{os.getpid()}.tmp'
+						out = np.lib.format.open_memmap(tmp_fn, mode = 'w+', dtype = dtype, shape = node.shape)
+						step = max(1, 2**24 // max(1, node.shape[-1]))
+						for row in range(0, node.shape[0], step): # copy in row blocks to bound memory use
+							out[row:row + step] = node[row:row + step]
+						out.flush()
+						del out
+						os.replace(tmp_fn, fn)
+					except OSError:
+						fn = None
+				if fn is not None:
+					return np.load(fn, mmap_mode = 'r')
+			table = np.array(node, dtype = dtype)
+			table.flags.writeable = False
+			return table
+
+
+class skim_store(object):
+	'''
+	Holds one omx_skim per skim listed in config.skim_list.
+	'''
+	def __init__(self, config):
+		self.skims = {}
+		for skim_fn in config.skim_list:
+			self.skims[skim_fn] = omx_skim(getattr(config, skim_fn + '_file'), config.skim_cache_path, config.precision,
+				bool(getattr(config, 'stream_rows', None)))
+
+	def __getitem__(self, skim_fn):
+		return self.skims[skim_fn]
+
+	def __iter__(self):
+		return iter(self.skims)
+
+	def copy(self):
+		'''Returns a store of omx_skim.copy() of every skim.'''
+		store = copy.copy(self)
+		store.skims = {skim_fn: skim.copy() for skim_fn, skim in self.skims.items()}
+		return store
+
+	def release(self):
+		for skim in self.skims.values():
+			skim.release()
+
+	def close(self):
+		for skim in self.skims.values():
+			skim.close()
+
+
+class table_rows(object):
+	'''
+	Dictionary-like view of a block of rows of every table in a dictionary of tables (e.g. a skim or the pre-MC trip table).
+	'''
+	def __init__(self, tables, rows, cache = False):
+		'''
+		:param tables: dict-like, name: numpy array
+		:param rows: slice of rows
+		:param cache: keep the blocks read, so that each table is read once (e.g. when streamed from a file)
+		'''
+		self.tables = tables
+		self.rows = rows
+		self._read = {} if cache else None
+
+	def __getitem__(self, name):
+		if self._read is not None and name in self._read:
+			return self._read[name]
+		if hasattr(self.tables, 'rows'):
+			table = self.tables.rows(name, self.rows)
+		else:
+			table = self.tables[name][self.rows]
+		if self._read is not None:
+			self._read[name] = table
+		return table
+
+	def __contains__(self, name):
+		return name in self.tables
+
+	def __iter__(self):
+		return iter(self.tables)
+
+	def keys(self):
+		return self.tables.keys()
+
+
+class table_cells(object):
+	'''
+	Dictionary-like view of some cells (OD pairs) of every table in a dictionary of tables (e.g. a skim or the pre-MC trip table).
+	Tables are returned as arrays of the shape of the index, e.g. OD pairs packed into rows (see Mode_Choice.cell_block).
+	'''
+	def __init__(self, tables, index):
+		'''
+		:param tables: dict-like, name: numpy array
+		:param index: (rows, cols) integer arrays of OD pairs
+		'''
+		self.tables = tables
+		self.index = index
+
+	def __getitem__(self, name):
+		if hasattr(self.tables, 'cells'):
+			return self.tables.cells(name, self.index)
+		return np.asarray(self.tables[name])[self.index]
+
+	def __contains__(self, name):
+		return name in self.tables
+
+	def __iter__(self):
+		return iter(self.tables)
+
+	def keys(self):
+		return self.tables.keys()
@@ -1,10 +1,255 @@
+import os
+import copy
+import uuid
+import weakref
 import numpy as np
 import pandas as pd
 
 
+class sparse_table(object):
+	'''
+	Trip table kept as the flat indices and values of the OD pairs with trips; all other cells are 0.
+	'''
+	def __init__(self, index, values, shape):
+		'''
+		:param index: sorted flat indices of the OD pairs
+		:param values: trips of the OD pairs
+		:param shape: shape of the table
+		'''
+		self.index = index
+		self.values = values
+		self.shape = tuple(shape)
+		self.dtype = values.dtype
+		self.ndim = 2
+
+	def toarray(self):
+		table = np.zeros(self.shape, dtype = self.dtype)
+		table.flat[self.index] = self.values
+		return table
+
+	def rows(self, start, stop):
+		'''
+		:returns: numpy array of rows start to stop of the table
+		'''
+		n = self.shape[1]
+		first, last = np.searchsorted(self.index, [start * n, stop * n])
+		table = np.zeros((stop - start, n), dtype = self.dtype)
+		table.flat[self.index[first:last] - start * n] = self.values[first:last]
+		return table
+
+	def __array__(self, dtype = None):
+		table = self.toarray()
+		return table if dtype is None else table.astype(dtype)
+
+	def sum(self, axis = None, dtype = None):
+		if axis is None:
+			return self.values.sum(dtype = dtype)
+		return self.toarray().sum(axis = axis, dtype = dtype)
+
+
+class segment_tables(dict):
+	'''
+	Dictionary of mode: trip table of one market segment of a purpose_tables object; the tables are views of its array.
+	'''
+	def __init__(self, tables, pv):
+		s = tables.segment_index[pv]
+		super().__init__((mode, tables.array[s, m]) for mode, m in tables.mode_index.items() if tables.stored[s, m])
+		self.tables = tables
+		self.pv = pv
+
+	def weighted_sum(self, weights):
+		'''
+		:param weights: dict, mode: weight; modes not listed are left out
+		:returns: sum of weight * trip table over the modes of the segment, as one reduction
+		'''
+		return self.tables.weighted_sum(weights, [self.pv])
+
+
+class spill_file(object):
+	'''
+	.npy file of a purpose_tables array. The file is removed when the last purpose_tables holding it (the tables that wrote it
+	and copies of them, e.g. the base tables a scenario shares) is collected, not with the container that created it.
+	'''
+	def __init__(self, path):
+		self.path = path
+		weakref.finalize(self, _remove_file, path)
+
+
+def _remove_file(path):
+	try:
+		os.remove(path)
+	except OSError: # e.g. still memory-mapped on Windows
+		pass
+
+
+class purpose_tables(object):
+	'''
+	Post-mode choice trip tables of one purpose, kept in one contiguous array indexed market segment x mode x O x D.
+	Indexing by market segment returns a dict of mode: trip table (segment_tables), as the nested dicts used before.
+	The array is either in memory or in a .npy file, memory-mapped read-only once the tables are stored (see spill() and freeze());
+	the file is removed with the tables (see spill_file).
+	'''
+	def __init__(self, segments, modes, shape, dtype = float, path = None):
+		'''
+		:param segments: market segments, e.g. ['0_PK','1_PK','0_OP','1_OP']
+		:param modes: modes
+		:param shape: shape of a trip table
+		:param dtype: data type of the trip tables
+		:param path: new .npy file that holds the array, removed with the tables; None keeps it in memory
+		'''
+		self.segments = list(segments)
+		self.modes = list(modes)
+		self.segment_index = {pv: s for s, pv in enumerate(self.segments)}
+		self.mode_index = {mode: m for m, mode in enumerate(self.modes)}
+		shape = (len(self.segments), len(self.modes)) + tuple(shape)
+		if path is None:
+			self.array = np.zeros(shape, dtype = dtype)
+		else:
+			self.array = np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+		self.path = path
+		self._file = None if path is None else spill_file(path)
+		self.stored = np.zeros(self.array.shape[:2], dtype = bool) # segment x mode: trip table is stored
+		self.sums = None # segment x mode: total trips, if accumulated while the tables were written (see Mode_Choice.stream_trips_by_mode)
+
+	@classmethod
+	def from_dict(cls, trips, dtype = None, path = None):
+		'''
+		:param trips: dict, market segment: {mode: trip table (numpy array or sparse_table)}
+		:param dtype: data type of the trip tables; by default that of the first table
+		:param path: new .npy file the tables are written to, removed with the tables; None keeps them in memory
+		:returns: purpose_tables
+		'''
+		modes = list(dict.fromkeys(mode for pv in trips for mode in trips[pv]))
+		first = next(table for pv in trips for table in trips[pv].values())
+		if dtype is None:
+			dtype = first.dtype if hasattr(first, 'dtype') else np.asarray(first).dtype
+		tables = cls(trips, modes, np.shape(first), dtype, path)
+		for pv in trips:
+			for mode, table in trips[pv].items():
+				tables.set(pv, mode, table)
+		if path is not None:
+			tables.freeze()
+		return tables
+
+	def freeze(self):
+		'''
+		Flushes the tables written to the .npy file of the array and memory-maps it again read-only.
+		'''
+		self.array.flush()
+		self.array = np.load(self.path, mmap_mode = 'r')
+
+	def spill(self, path):
+		'''
+		:param path: new .npy file, removed with the returned tables
+		:returns: purpose_tables with the tables of this object, written to path and memory-mapped read-only
+		'''
+		np.save(path, self.array)
+		tables = copy.copy(self)
+		tables.array = np.load(path, mmap_mode = 'r')
+		tables.stored = self.stored.copy()
+		tables.path = path
+		tables._file = spill_file(path)
+		return tables
+
+	def set(self, pv, mode, table):
+		'''
+		Stores a trip table.
+		:param pv: market segment
+		:param mode: mode
+		:param table: trip table (numpy array or sparse_table)
+		'''
+		s, m = self.segment_index[pv], self.mode_index[mode]
+		self.sums = None
+		if isinstance(table, sparse_table):
+			if self.stored[s, m]:
+				self.array[s, m] = 0
+			self.array[s, m].reshape(-1)[table.index] = table.values # only the OD pairs with trips are written
+		else:
+			self.array[s, m] = table
+		self.stored[s, m] = True
+
+	def __getitem__(self, pv):
+		return segment_tables(self, pv)
+
+	def __iter__(self):
+		return iter(self.segments)
+
+	def __len__(self):
+		return len(self.segments)
+
+	def __contains__(self, pv):
+		return pv in self.segment_index
+
+	def keys(self):
+		return list(self.segments)
+
+	def values(self):
+		return [self[pv] for pv in self.segments]
+
+	def items(self):
+		return [(pv, self[pv]) for pv in self.segments]
+
+	def stored_modes(self):
+		'''
+		:returns: modes with at least one stored trip table
+		'''
+		return [mode for mode, m in self.mode_index.items() if self.stored[:, m].any()]
+
+	def totals(self):
+		'''
+		:returns: pandas DataFrame of total trips by mode (rows) and market segment (columns), NaN where no table is stored
+		'''
+		totals = self.sums if self.sums is not None else self.array.sum(axis = (2,3), dtype = np.float64)
+		return pd.DataFrame(np.where(self.stored, totals, np.nan).T, index = self.modes, columns = self.segments)
+
+	def weighted_sum(self, weights, segments = None):
+		'''
+		:param weights: dict, mode: weight; modes not listed are left out
+		:param segments: market segments summed; by default all
+		:returns: sum of weight * trip table over the segments and modes, as one reduction over the array
+		'''
+		w = np.zeros(self.stored.shape, dtype = self.array.dtype)
+		rows = [self.segment_index[pv] for pv in (self.segments if segments is None else segments)]
+		for mode, weight in weights.items():
+			if mode in self.mode_index:
+				w[rows, self.mode_index[mode]] = weight
+		w[~self.stored] = 0
+		s, m = np.nonzero(w)
+		if not len(s):
+			return np.zeros(self.array.shape[2:], dtype = self.array.dtype)
+		box = (slice(s.min(), s.max() + 1), slice(m.min(), m.max() + 1))
+		return np.einsum('sm,smij->ij', w[box], self.array[box])
+
+	def __add__(self, other):
+		'''
+		:param other: purpose_tables with (at least) the stored tables of this object
+		:returns: purpose_tables of the sums of the stored tables of this object and other; if either is in a file, the sums are
+		written to a new file next to it rather than held in memory
+		'''
+		spilled = self.path or other.path
+		path = None if spilled is None else os.path.join(os.path.dirname(spilled), f'mc_tables_sum_{uuid.uuid4().hex}.npy')
+		tables = purpose_tables(self.segments, self.modes, self.array.shape[2:], self.array.dtype, path)
+		tables.stored = self.stored.copy()
+		if other.segments == self.segments and other.modes == self.modes:
+			np.add(self.array, other.array, out = tables.array)
+		else:
+			for pv in self.segments:
+				for mode in self[pv]:
+					np.add(self[pv][mode], other[pv][mode], out = tables.array[self.segment_index[pv], self.mode_index[mode]])
+		if path is not None:
+			tables.freeze()
+		return tables
+
+
 class table_container(object):
 	'''
-	Defines an object that contains post-mode choice trip tables.
+	Defines an object that contains post-mode choice trip tables: a purpose_tables object by purpose.
+	If config.table_spill_path is set, the tables of each purpose are written to a memory-mapped file as soon as they are stored,
+	so that only the purpose being computed is held in memory; each file is removed with the purpose_tables that hold it, which
+	may outlive the container (e.g. base tables shared with scenario runs).
+	Streamed (config.stream_rows) and sparse (config.sparse_demand) runs always keep their tables in files, in out_path if
+	table_spill_path is not set: sparse tables are written to the file OD pair by OD pair (see purpose_tables.set), and would
+	otherwise be expanded to dense tables in memory.
 	'''
 	def __init__(self, mc_obj):
 		self.purpose_calculated = {purpose: False for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']}
@@ -13,24 +258,64 @@ class table_container(object):
 		for purpose in self.container:
 			self.container[purpose] = {'0_PK':{},'1_PK':{},'0_OP':{},'1_OP':{}}
 		self.modes = set()
-		
+		config = getattr(mc_obj, 'config', None)
+		self.spill_path = getattr(config, 'table_spill_path', None)
+		if not self.spill_path and (getattr(config, 'stream_rows', None) or getattr(config, 'sparse_demand', 0)):
+			self.spill_path = config.out_path
+
 	def store_table(self,purpose):
-		self.container[purpose] = self.model.trips_by_mode
-		self.modes = self.modes | set(self.model.param['mode'])
+		self.set_table(purpose, self.model.trips_by_mode)
+		self.model.trips_by_mode = self.container[purpose] # the trip tables of the model are replaced by views of the stored array
+
+	def set_table(self, purpose, tables):
+		'''
+		Stores the trip tables of a purpose.
+		:param purpose: purpose
+		:param tables: purpose_tables, or dict of market segment: {mode: trip table}
+		'''
+		if not isinstance(tables, purpose_tables):
+			tables = purpose_tables.from_dict(tables, self.model.dtype, self.spill_file(purpose))
+		elif self.spill_path and tables.path is None:
+			tables = tables.spill(self.spill_file(purpose))
+		self.container[purpose] = tables
+		self.modes = self.modes | set(tables.stored_modes())
 		self.purpose_calculated[purpose] = True
-	
+
+	def spill_file(self, purpose):
+		'''
+		:param purpose: purpose
+		:returns: new .npy file for the tables of a purpose in spill_path, removed with the purpose_tables written to it;
+		None if tables are kept in memory
+		'''
+		if not self.spill_path:
+			return None
+		os.makedirs(self.spill_path, exist_ok = True)
+		return os.path.join(self.spill_path, f'mc_tables_{purpose}_{uuid.uuid4().hex}.npy')
+
 	def get_table(self,purpose):
 		if purpose in self.container.keys() and self.purpose_calculated[purpose] == True:
 			return self.container[purpose]
 		else:
 			return None
-	
+
 	def aggregate_by_mode_segment(self, mode, pv):
-		trip_sum = np.zeros((2730,2730))
+		trip_sum = np.zeros(self.model.zones.shape, dtype = self.model.dtype)
 		for purpose in ['HBW','HBO', 'NHB', 'HBSc1', 'HBSc2', 'HBSc3']:
-			try:
-				trip_sum += self.container[purpose][pv][mode]
-			except: pass
-			
+			tables = self.get_table(purpose)
+			if tables and mode in tables[pv]:
+				trip_sum += tables[pv][mode]
+
 		return trip_sum
 
+	def aggregate(self, weights, segments = None, purposes = None):
+		'''
+		:param weights: dict, mode: weight; modes not listed are left out
+		:param segments: market segments summed; by default all
+		:param purposes: purposes summed; by default all calculated purposes
+		:returns: sum of weight * trip table over purposes, segments and modes
+		'''
+		trip_sum = np.zeros(self.model.zones.shape, dtype = self.model.dtype)
+		for purpose in (purposes or ['HBW','HBO', 'NHB', 'HBSc1', 'HBSc2', 'HBSc3']):
+			if self.get_table(purpose):
+				trip_sum += self.get_table(purpose).weighted_sum(weights, segments)
+		return trip_sum
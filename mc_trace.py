@@ -0,0 +1,199 @@
+# coding: utf-8
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import functools
+import threading
+import tracemalloc
+try:
+	import resource
+except ImportError: # not available on Windows
+	resource = None
+
+
+def peak_rss():
+	'''
+	:returns: peak resident set size of the process in bytes, or None where it is not available
+	'''
+	if resource is None:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == 'darwin' else rss * 1024 # bytes on macOS, kB elsewhere
+
+
+class tracer(object):
+	'''
+	Records timed spans of a model run: wall time, CPU time of the thread, bytes allocated (net, with trace_memory) and peak RSS
+	of the process at the end of each span. Spans nest within each thread (path) and are written as a JSON or CSV trace.
+	A disabled tracer hands out a shared no-op span, so instrumented code costs next to nothing when tracing is off.
+	'''
+	fields = ['name', 'path', 'thread', 'start', 'wall', 'cpu', 'allocated', 'peak_rss', 'error', 'attrs']
+
+	def __init__(self, enabled = False, trace_memory = False, profile = False):
+		'''
+		:param enabled: record spans
+		:param trace_memory: trace allocations with tracemalloc, which slows down Python code
+		:param profile: profile the thread that created the tracer with cProfile (see write_profile())
+		'''
+		self.enabled = enabled
+		self.trace_memory = enabled and trace_memory
+		self.spans = []
+		self.origin = time.perf_counter()
+		self._lock = threading.Lock()
+		self._local = threading.local()
+		if self.trace_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+		self.profiler = None
+		if profile:
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+
+	@classmethod
+	def from_config(cls, config):
+		'''
+		:param config: config module; see trace_file, trace_memory and profile_file
+		:returns: tracer, enabled if config.trace_file or config.profile_file is set
+		'''
+		trace_file, profile_file = getattr(config, 'trace_file', None), getattr(config, 'profile_file', None)
+		return cls(bool(trace_file or profile_file), getattr(config, 'trace_memory', False), bool(profile_file))
+
+	def span(self, name, **attrs):
+		'''
+		:param name: span name, e.g. a function name
+		:param attrs: attributes of the span, e.g. market segment and mode
+		:returns: context manager that records the span
+		'''
+		if not self.enabled:
+			return _null_span
+		return _span(self, name, attrs)
+
+	def _stack(self):
+		if not hasattr(self._local, 'stack'):
+			self._local.stack = []
+		return self._local.stack
+
+	def _record(self, span):
+		with self._lock:
+			self.spans.append(span)
+
+	def summary(self):
+		'''
+		:returns: list of dicts with the count, total wall and CPU time, allocated bytes and largest peak RSS of spans by name,
+		in order of total wall time
+		'''
+		totals = {}
+		for span in list(self.spans):
+			total = totals.setdefault(span['name'], {'name': span['name'], 'count': 0, 'wall': 0.0, 'cpu': 0.0, 'allocated': None, 'peak_rss': None})
+			total['count'] += 1
+			total['wall'] += span['wall']
+			total['cpu'] += span['cpu']
+			if span['allocated'] is not None:
+				total['allocated'] = (total['allocated'] or 0) + span['allocated']
+			if span['peak_rss'] is not None:
+				total['peak_rss'] = max(total['peak_rss'] or 0, span['peak_rss'])
+		return sorted(totals.values(), key = lambda total: -total['wall'])
+
+	def write(self, out_fn):
+		'''
+		Writes the spans recorded so far.
+		:param out_fn: .json file (list of spans) or .csv file (one line per span, attributes as JSON)
+		'''
+		spans = list(self.spans)
+		if os.path.dirname(out_fn):
+			os.makedirs(os.path.dirname(out_fn), exist_ok = True)
+		if out_fn.endswith('.json'):
+			with open(out_fn, 'w') as f:
+				json.dump(spans, f, indent = 1, default = str)
+		else:
+			with open(out_fn, 'w', newline = '') as f:
+				writer = csv.DictWriter(f, self.fields)
+				writer.writeheader()
+				for span in spans:
+					writer.writerow(dict(span, attrs = json.dumps(span['attrs'], default = str)))
+
+	def write_profile(self, out_fn):
+		'''
+		Writes the cProfile statistics collected so far (read with pstats or snakeviz).
+		:param out_fn: output file
+		'''
+		if self.profiler is not None:
+			self.profiler.create_stats()
+			self.profiler.dump_stats(out_fn)
+			self.profiler.enable()
+
+	def flush(self, config):
+		'''
+		Writes the trace and profile to config.trace_file and config.profile_file, if set.
+		'''
+		if getattr(config, 'trace_file', None):
+			self.write(config.trace_file)
+		if getattr(config, 'profile_file', None):
+			self.write_profile(config.profile_file)
+
+	def __getstate__(self):
+		# copies sent to worker processes do not trace
+		return {'enabled': False, 'trace_memory': False, 'spans': [], 'origin': self.origin, 'profiler': None}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+
+class _span(object):
+	def __init__(self, tracer, name, attrs):
+		self.tracer = tracer
+		self.name = name
+		self.attrs = attrs
+
+	def __enter__(self):
+		stack = self.tracer._stack()
+		stack.append(self.name)
+		self.path = '/'.join(stack)
+		self.allocated = tracemalloc.get_traced_memory()[0] if self.tracer.trace_memory else None
+		self.cpu = time.thread_time()
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		wall = time.perf_counter() - self.start
+		cpu = time.thread_time() - self.cpu
+		allocated = tracemalloc.get_traced_memory()[0] - self.allocated if self.allocated is not None else None
+		self.tracer._stack().pop()
+		self.tracer._record({'name': self.name, 'path': self.path, 'thread': threading.current_thread().name,
+			'start': self.start - self.tracer.origin, 'wall': wall, 'cpu': cpu, 'allocated': allocated, 'peak_rss': peak_rss(),
+			'error': exc_type.__name__ if exc_type is not None else '', 'attrs': self.attrs})
+		return False
+
+
+class _no_span(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+_null_span = _no_span()
+
+
+def traced(name = None, attrs = None):
+	'''
+	Decorator that records a span for each call of a function whose first argument is a mode choice object (or of a method
+	of Mode_Choice), using the tracer of that object (mc_obj.trace).
+	:param name: span name; by default the function name
+	:param attrs: function of the other arguments returning a dict of span attributes
+	'''
+	def decorate(func):
+		span_name = name or func.__name__
+		@functools.wraps(func)
+		def wrapper(mc_obj, *args, **kwargs):
+			trace = getattr(mc_obj, 'trace', None)
+			if trace is None or not trace.enabled:
+				return func(mc_obj, *args, **kwargs)
+			with trace.span(span_name, **(attrs(*args, **kwargs) if attrs else {})):
+				return func(mc_obj, *args, **kwargs)
+		return wrapper
+	return decorate
@@ -6,63 +6,84 @@ from IPython.display import display
 from openpyxl import load_workbook,Workbook
 from time import strftime
 import os.path
+import config
 from config import out_path, misc_path
+from mc_district import district_map
+from mc_omx import omx_writer
+from mc_trace import traced
 
 AO_dict = {'DA':1,'SR2':2,'SR3+':3.5,'SM_RA':1, 'SM_SH':2}
+mode_categories = {'DA':'drive','SR2':'drive','SR3+':'drive','Bike':'non-motorized','Walk':'non-motorized',
+	'WAT':'transit','DAT_CR':'transit','DAT_B':'transit','DAT_LB':'transit','DAT_RT':'transit','SM_RA':'smart mobility','SM_SH':'smart mobility'}
 
-def store_omx_as_dict(infile_path):
+def store_omx_as_dict(infile_path, dtype = None):
 	'''
 	Given an omx file, it stores the matrices in a dictionary.
 	:param infile_path: path of the omx file.
+	:param dtype: data type matrices are converted to; None keeps the type stored in the file.
 	:returns: dict
 	'''
 	store_dict = {}
 	with omx.open_file(infile_path,'r') as f:
 		for name in f.list_matrices():
-			store_dict[name] = np.array(f[name])
+			store_dict[name] = np.array(f[name], dtype = dtype)
 	return store_dict
 
 	
-def expand_prod(var_vector):
+def expand_prod(var_vector, n = None):
 	'''
-	This returns a 2730 x 2730 table for a zonal variable vector that applies to the production side.
-	:param var_vector: either a pandas series or a numpy array with at least 2730 entries
-	:returns: numpy array 2730 x 2730
+	This returns an n x n table for a zonal variable vector that applies to the production side.
+	:param var_vector: either a pandas series or a numpy array with at least n entries
+	:param n: number of zones; by default the length of var_vector
+	:returns: numpy array n x n
 	:raises: ValueError
 	'''
+	n = len(var_vector) if n is None else n
 	try:
-		return np.repeat(var_vector.values[:2730].reshape(2730,1),2730,axis= 1)
+		return np.repeat(var_vector.values[:n].reshape(n,1),n,axis= 1)
 	except:
-		try: return np.repeat(var_vector[:2730].reshape(2730,1),2730,axis= 1)
+		try: return np.repeat(var_vector[:n].reshape(n,1),n,axis= 1)
 		except: raise ValueError('error expanding vector, check size and input type')
 
-def expand_attr(var_vector):
+def expand_attr(var_vector, n = None):
 	'''
-	This returns a 2730 x 2730 table for a zonal variable vector that applies to the attraction side.
-	:param var_vector: either a pandas series or a numpy array with at least 2730 entries
-	:returns: numpy array 2730 x 2730
+	This returns an n x n table for a zonal variable vector that applies to the attraction side.
+	:param var_vector: either a pandas series or a numpy array with at least n entries
+	:param n: number of zones; by default the length of var_vector
+	:returns: numpy array n x n
 	:raises: ValueError
 	'''	
-
+	n = len(var_vector) if n is None else n
 	try:
-		return np.repeat(var_vector.values[:2730].reshape(1,2730),2730,axis= 0)
+		return np.repeat(var_vector.values[:n].reshape(1,n),n,axis= 0)
 	except:
-		try: return np.repeat(var_vector[:2730].reshape(1,2730),2730,axis = 0)
+		try: return np.repeat(var_vector[:n].reshape(1,n),n,axis = 0)
 		except: raise ValueError('error expanding vector')
 	
 	
-def write_trip_tables(mc_obj,out_fn):
+@traced()
+def write_trip_tables(mc_obj,out_fn, by_purpose = False):
 	'''
 	This writes the resulting trip tables of mode choice to a .omx file. Trips of all purposes are combined.
-	Format: keys are mode_peak_vehicleownership
+	Format: keys are mode_peak_vehicleownership (and mode_peak_vehicleownership_purpose for the tables of each purpose)
+	Tables are compressed and written on a background thread while the next ones are aggregated; chunk shape and compression
+	are set in config.py.
 	:param mc_obj: mode choice module object as defined in the IPython notebook
 	:param out_fn: path of output .omx file
+	:param by_purpose: also write the tables of each purpose
 	'''
-	with omx.open_file(out_fn,'w') as ttmc:
+	with omx_writer(out_fn, config.omx_chunk_rows, config.omx_complevel, config.omx_complib) as ttmc:
 		for pv in mc_obj.peak_veh:
 			for mode in mc_obj.table_container.modes:
-				ttmc[f'{mode}_{pv}'] = mc_obj.table_container.aggregate_by_mode_segment( mode, pv)
+				ttmc.write(f'{mode}_{pv}', mc_obj.table_container.aggregate_by_mode_segment( mode, pv))
+		if by_purpose:
+			for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
+				if mc_obj.table_container.get_table(purpose):
+					for pv in mc_obj.peak_veh:
+						for mode, table in mc_obj.table_container.get_table(purpose)[pv].items():
+							ttmc.write(f'{mode}_{pv}_{purpose}', table)
 	
+@traced()
 def display_mode_share(mc_obj):
 	'''
 	This displays a mode share summary by market segment (with / without vehicle, peak / off-peak) on the IPython notebook.
@@ -71,14 +92,30 @@ def display_mode_share(mc_obj):
 	
 	mode_share = pd.DataFrame(None)
 	for purpose in ['HBW','HBO', 'NHB', 'HBSc1', 'HBSc2', 'HBSc3']:
-		mode_share = mode_share.add(pd.DataFrame({pv:{mode:(mc_obj.table_container.get_table(purpose)[pv][mode].sum()) for mode in mc_obj.table_container.get_table(purpose)[pv]} for pv in mc_obj.peak_veh}).T,
-			fill_value = 0)
+		if mc_obj.table_container.get_table(purpose):
+			mode_share = mode_share.add(mc_obj.table_container.get_table(purpose).totals()[mc_obj.peak_veh].T, fill_value = 0)
 	
 	avg_mode_share = mode_share.div(mode_share.sum(1), axis = 0)
 
 	display(avg_mode_share.style.format("{:.2%}"))
 	
 	
+def mode_share_table(trip_table, peak_veh):
+	'''
+	:param trip_table: trip tables of a purpose (see mc_table_container.purpose_tables), or dict of market segment: {mode: trip table}
+	:param peak_veh: market segments
+	:returns: pandas DataFrame of total trips by mode (rows) and market segment (columns)
+	'''
+	if hasattr(trip_table, 'totals'):
+		totals = trip_table.totals()[peak_veh]
+		return totals[totals.notna().any(axis = 1)]
+	mode_share = pd.DataFrame(columns = peak_veh)
+	for pv in peak_veh:
+		for mode in trip_table[pv].keys():
+			mode_share.loc[mode,pv] = trip_table[pv][mode].sum(dtype = np.float64)
+	return mode_share
+
+@traced(attrs = lambda purpose, out_excel_fn = None: {'purpose': purpose})
 def write_mode_share_to_excel(mc_obj,purpose, out_excel_fn = None):
 	'''
 	Writes mode share summary by purpose and market segment to an Excel workbook.
@@ -99,11 +136,7 @@ def write_mode_share_to_excel(mc_obj,purpose, out_excel_fn = None):
 		writer.book = book
 		
 		for purp in ['HBW','HBO', 'NHB', 'HBSc1', 'HBSc2', 'HBSc3']:
-			trip_table = mc_obj.table_container.get_table(purp)
-			mode_share = pd.DataFrame(columns = mc_obj.peak_veh)
-			for pv in mc_obj.peak_veh:
-				for mode in trip_table[pv].keys():
-					mode_share.loc[mode,pv] = trip_table[pv][mode].sum()
+			mode_share = mode_share_table(mc_obj.table_container.get_table(purp), mc_obj.peak_veh)
 			
 			mode_share['Total'] = mode_share.sum(1)
 			mode_share['Share'] = mode_share['Total'] / mode_share['Total'].sum()
@@ -126,10 +159,7 @@ def write_mode_share_to_excel(mc_obj,purpose, out_excel_fn = None):
 		writer = pd.ExcelWriter(out_excel_fn,engine = 'openpyxl')
 		writer.book = book
 		
-		mode_share = pd.DataFrame(columns = mc_obj.peak_veh)
-		for pv in mc_obj.peak_veh:
-			for mode in mc_obj.trips_by_mode[pv].keys():
-				mode_share.loc[mode,pv] = mc_obj.trips_by_mode[pv][mode].sum()
+		mode_share = mode_share_table(mc_obj.trips_by_mode, mc_obj.peak_veh)
 		
 		mode_share['Total'] = mode_share.sum(1)
 		mode_share['Share'] = mode_share['Total'] / mode_share['Total'].sum()
@@ -141,195 +171,157 @@ def write_mode_share_to_excel(mc_obj,purpose, out_excel_fn = None):
 		mode_share.to_excel(writer, sheet_name = purpose)
 	
 		writer.save()
-		
+
+@traced()
+def mode_share_drift(mc_ref, mc_test, out_fn = None):
+	'''
+	Compares mode shares by purpose and market segment of two model runs, e.g. a float32 run (config.precision) against a float64 run.
+	:param mc_ref: mode choice module object of the reference run
+	:param mc_test: mode choice module object of the run to be validated
+	:param out_fn: output csv filename; if None specified, in the output path defined in config.py
+	:returns: pandas DataFrame with reference and test shares and their difference in percentage points
+	'''
+	if out_fn is None:
+		out_fn = out_path + 'mode_share_drift.csv'
+	rows = []
+	for purpose in ['HBW','HBO', 'NHB', 'HBSc1', 'HBSc2', 'HBSc3']:
+		ref_table = mc_ref.table_container.get_table(purpose)
+		test_table = mc_test.table_container.get_table(purpose)
+		if not ref_table or not test_table:
+			continue
+		ref_totals, test_totals = mode_share_table(ref_table, mc_ref.peak_veh), mode_share_table(test_table, mc_ref.peak_veh)
+		for pv in mc_ref.peak_veh:
+			for mode in ref_table[pv]:
+				rows.append({'purpose': purpose, 'segment': pv, 'mode': mode,
+					'reference share': ref_totals.loc[mode,pv] / ref_totals[pv].sum(),
+					'test share': test_totals.loc[mode,pv] / test_totals[pv].sum()})
+	drift = pd.DataFrame(rows, columns = ['purpose','segment','mode','reference share','test share'])
+	drift['drift (pp)'] = (drift['test share'] - drift['reference share']) * 100
+	drift.to_csv(out_fn, index = False)
+	return drift
+		
+def district_maps(mc_obj):
+	'''
+	:param mc_obj: mode choice module object as defined in the IPython notebook
+	:returns: dict of the district maps of the zone system of mc_obj (see mc_district.py), built on first use: 'neighborhood' for Boston
+	neighborhoods and 'town'; transit_ridership() adds the MBTA coverage.
+	'''
+	if getattr(mc_obj, '_district_maps', None) is None:
+		n = mc_obj.zones.n
+		towns = mc_obj.taz_lu.sort_values('TAZ_ID').iloc[0:n]
+		mc_obj._district_maps = {'neighborhood': district_map.from_table(towns, 'BOSTON_NB', n), 'town': district_map.from_table(towns, 'TOWN', n)}
+	return mc_obj._district_maps
+
 def mt_prod_attr_nhood(mc_obj, trip_table, skim): # miles traveled. For VMT and PMT, by neighborhood
-	# sum prodct of trip_table - skims
-	mt_total = trip_table * skim['Length (Skim)'] 
-	
-	# calculate marginals
-	prod = pd.DataFrame(np.sum(mt_total,axis = 1)/2, columns = ['Production'])
-	attr = pd.DataFrame(np.sum(mt_total,axis = 0) / 2, columns = ['Attraction'])
-	
-	towns = mc_obj.taz_lu.sort_values('TAZ_ID').iloc[0:2730]
-	mt_taz = pd.concat([towns[['TAZ_ID','BOSTON_NB']],prod,attr],axis = 1,join = 'inner')
-	mt_taz.index.names=['Boston Neighborhood']
-	return mt_taz.groupby(['BOSTON_NB']).sum()[['Production','Attraction']].reset_index()
-	
+	neighborhoods = district_maps(mc_obj)['neighborhood']
+	mt = neighborhoods.margins(trip_table * skim['Length (Skim)']) / 2
+	return pd.DataFrame({'BOSTON_NB': neighborhoods.districts, 'Production': mt[0], 'Attraction': mt[1]})
+
+def neighborhood_summary(mc_obj, zone_values):
+	'''
+	Reduces zone values of every purpose and market segment to the Boston neighborhoods in one pass.
+	:param mc_obj: mode choice module object as defined in the IPython notebook
+	:param zone_values: function of (peak, tables by mode of a market segment) returning a k x zones array
+	:returns: (list of (purpose, peak, veh_own) segments, segments x k x neighborhoods array)
+	'''
+	neighborhoods = district_maps(mc_obj)['neighborhood']
+	segments, values = [], []
+	for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
+		for peak in ['PK','OP']:
+			for veh_own in ['0','1']:
+				if mc_obj.table_container.get_table(purpose):
+					segments.append((purpose, peak, veh_own))
+					values.append(neighborhoods.reduce(zone_values(peak, mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'])))
+	return segments, np.array(values)
+
+def write_neighborhood_summary(mc_obj, segments, values, columns, name, out_fn = None, by = None, share = False):
+	'''
+	Writes the neighborhood summary of neighborhood_summary() for each requested grouping.
+	:param columns: names of the k values of each neighborhood
+	:param name: name of the summary, used in the default file names
+	:param out_fn: output csv filename (for a single grouping); if None specified, in the output path defined in config.py
+	:param by: None, 'peak', 'veh_own', 'purpose' or a list of these
+	:param share: divide the values of each neighborhood by their sum
+	'''
+	neighborhoods = district_maps(mc_obj)['neighborhood']
+	groupings = by if isinstance(by, list) else [by]
+	if any(grouping not in [None,'peak','veh_own','purpose'] for grouping in groupings):
+		print(f'Only supports {name.replace("_"," ").upper()} by neighborhood, peak / vehicle ownership, purpose.')
+		return
+
+	def summary(group):
+		table = pd.DataFrame(values[group].sum(axis = 0).T, index = pd.Index(neighborhoods.districts, name = 'BOSTON_NB'), columns = columns)
+		return table.divide(table.sum(axis = 1), axis = 0) if share else table
+
+	field = {'purpose': 0, 'peak': 1, 'veh_own': 2}
+	for grouping in groupings:
+		if grouping is None:
+			table = summary(slice(None))
+		else:
+			levels = list(dict.fromkeys(segment[field[grouping]] for segment in segments))
+			keys = {'0': 'No car', '1': 'With car'} if grouping == 'veh_own' else {}
+			table = pd.concat([summary([segment[field[grouping]] == level for segment in segments]) for level in levels],
+				axis = 1, keys = [keys.get(level, level) for level in levels])
+		if out_fn is None or len(groupings) > 1:
+			fn = out_path + (f'{name}_by_neighborhood.csv' if grouping is None else f'{name}_by_neighborhood_by_{grouping}.csv')
+		else:
+			fn = out_fn
+		table.to_csv(fn)
+
+@traced(attrs = lambda out_fn = None, by = None: {'by': by})
 def vmt_by_neighborhood(mc_obj, out_fn = None, by = None):
 	'''
 	Summarizes VMT production and attraction by the 26 Boston neighborhoods.
 	:param mc_obj: mode choice module object as defined in the IPython notebook
 	:param out_fn: output csv filename; if None specified, in the output path defined in config.py	
 	:param by: grouping used for the summary; if None specified, only aggregate production and attraction will be provided.
+	A list of groupings writes one file per grouping from a single pass over the trip tables.
 	'''
-	
-	if out_fn is None and by is None:
-		out_fn = out_path + f'vmt_by_neighborhood.csv'
-	elif out_fn is None and by:
-		out_fn = out_path + f'vmt_by_neighborhood_by_{by}.csv'
 	skim_dict = {'PK': mc_obj.drive_skim_PK,'OP':mc_obj.drive_skim_OP}
-	if by in ['peak','veh_own','purpose'] == False:
-		print('Only supports VMT by neighborhood, peak / vehicle ownership, purpose.')
-		return
-		
-	else:
-		vmt_master_table = pd.DataFrame(columns = ['Production','Attraction','peak','veh_own','purpose'])
-		for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-			for peak in ['PK','OP']:
-				for veh_own in ['0','1']:
-					if mc_obj.table_container.get_table(purpose):
-						drive_modes = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'].keys()
-						
-						auto_trip_table = sum([
-						mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode] / AO_dict[mode]
- for mode in ['DA','SR2','SR3+'] if mode in drive_modes])
-						
-						
-						
-						vmt_table = mt_prod_attr_nhood(mc_obj,auto_trip_table,skim_dict[peak])
-						vmt_table['peak'] = peak
-						vmt_table['veh_own'] = veh_own
-						vmt_table['purpose'] = purpose
-						vmt_master_table = vmt_master_table.append(vmt_table)
-		
-		if by == None:
-			vmt_summary = vmt_master_table.groupby('BOSTON_NB').sum()
-		
-		elif by == 'peak':
-			vmt_summary = pd.concat([
-			vmt_master_table.groupby(['peak','BOSTON_NB']).sum().loc[peak] for peak in ['PK','OP']], axis = 1, keys = ['PK','OP'])
-		
-		elif by == 'veh_own':
-			vmt_summary = pd.concat([
-			vmt_master_table.groupby(['veh_own','BOSTON_NB']).sum().loc[veh_own] for veh_own in ['0','1']], axis = 1, keys = ['No car', 'With car']
-			)
-			
-		elif by == 'purpose':
-			vmt_summary = pd.concat([
-			vmt_master_table.groupby(['purpose','BOSTON_NB']).sum().loc[purpose] for purpose in vmt_master_table.purpose.unique()],axis = 1, keys= vmt_master_table.purpose.unique())
-
-		vmt_summary.to_csv(out_fn)
+	def vmt(peak, tables):
+		auto_trip_table = tables.weighted_sum({mode: 1 / AO_dict[mode] for mode in ['DA','SR2','SR3+']})
+		mt = auto_trip_table * skim_dict[peak]['Length (Skim)']
+		return np.stack([mt.sum(axis = 1), mt.sum(axis = 0)]) / 2
+	segments, values = neighborhood_summary(mc_obj, vmt)
+	write_neighborhood_summary(mc_obj, segments, values, ['Production','Attraction'], 'vmt', out_fn, by)
 
+@traced(attrs = lambda out_fn = None, by = None: {'by': by})
 def pmt_by_neighborhood(mc_obj, out_fn = None, by = None):
 	'''
 	Summarizes PMT production and attraction by the 26 Boston neighborhoods.
 	:param mc_obj: mode choice module object as defined in the IPython notebook
 	:param out_fn: output csv filename; if None specified, in the output path defined in config.py	
 	:param by: grouping used for the summary; if None specified, only aggregate production and attraction will be provided.
+	A list of groupings writes one file per grouping from a single pass over the trip tables.
 	'''
-	
-	if out_fn is None and by is None:
-		out_fn = out_path + f'pmt_by_neighborhood.csv'
-	elif out_fn is None and by:
-		out_fn = out_path + f'pmt_by_neighborhood_by_{by}.csv'
-		
 	skim_dict = {'PK': mc_obj.drive_skim_PK,'OP':mc_obj.drive_skim_OP}
-	
-	if by in ['peak','veh_own','purpose'] == False:
-		print('Only supports PMT by neighborhood, peak / vehicle ownership, purpose.')
-		return
-		
-	else:
-		pmt_master_table = pd.DataFrame(columns = ['Production','Attraction','peak','veh_own','purpose'])
-		for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-			for peak in ['PK','OP']:
-				for veh_own in ['0','1']:
-					if mc_obj.table_container.get_table(purpose):
-						drive_modes = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'].keys()
-						person_trip_table = sum([mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode] for mode in ['DA','SR2','SR3+','SM_RA','SM_SH'] if mode in drive_modes])
-						
-						pmt_table = mt_prod_attr_nhood(mc_obj,person_trip_table,skim_dict[peak])
-						pmt_table['peak'] = peak
-						pmt_table['veh_own'] = veh_own
-						pmt_table['purpose'] = purpose
-						pmt_master_table = pmt_master_table.append(pmt_table)
-		
-		if by == None:
-			pmt_summary = pmt_master_table.groupby('BOSTON_NB').sum()
-		
-		elif by == 'peak':
-			pmt_summary = pd.concat([
-			pmt_master_table.groupby(['peak','BOSTON_NB']).sum().loc[peak] for peak in ['PK','OP']], axis = 1, keys = ['PK','OP'])
-		
-		elif by == 'veh_own':
-			pmt_summary = pd.concat([
-			pmt_master_table.groupby(['veh_own','BOSTON_NB']).sum().loc[veh_own] for veh_own in ['0','1']], axis = 1, keys = ['No car', 'With car']
-			)
-			
-		elif by == 'purpose':
-			pmt_summary = pd.concat([
-			pmt_master_table.groupby(['purpose','BOSTON_NB']).sum().loc[purpose] for purpose in pmt_master_table.purpose.unique()],axis = 1, keys= pmt_master_table.purpose.unique())
-
-		pmt_summary.to_csv(out_fn)
+	def pmt(peak, tables):
+		person_trip_table = tables.weighted_sum(dict.fromkeys(['DA','SR2','SR3+','SM_RA','SM_SH'], 1))
+		mt = person_trip_table * skim_dict[peak]['Length (Skim)']
+		return np.stack([mt.sum(axis = 1), mt.sum(axis = 0)]) / 2
+	segments, values = neighborhood_summary(mc_obj, pmt)
+	write_neighborhood_summary(mc_obj, segments, values, ['Production','Attraction'], 'pmt', out_fn, by)
 
+@traced(attrs = lambda out_fn = None, by = None: {'by': by})
 def mode_share_by_neighborhood(mc_obj, out_fn = None, by = None):
 	'''
-	Summarizes mode share as the average of trips to/from the 26 Boston neighborhoods, in three categories - drive, non-motorized and transit.
+	Summarizes mode share as the average of trips to/from the 26 Boston neighborhoods, in three categories - drive, non-motorized and transit
+	(and smart mobility, if modeled).
 	:param mc_obj: mode choice module object as defined in the IPython notebook
 	:param out_fn: output csv filename; if None specified, in the output path defined in config.py	
-	:param by: grouping used for the summary
+	:param by: grouping used for the summary; a list of groupings writes one file per grouping.
 	'''
-	if out_fn is None and by is None:
-		out_fn = out_path + f'mode_share_by_neighborhood.csv'
-	elif out_fn is None and by:
-		out_fn = out_path + f'mode_share_by_neighborhood_by_{by}.csv'
-
-	if by in ['peak','veh_own','purpose'] == False:
-		print('Only supports PMT by neighborhood, peak / vehicle ownership, purpose.')
-		return
-
-	else:
-		mode_categories = {'DA':'drive','SR2':'drive','SR3+':'drive','Bike':'non-motorized','Walk':'non-motorized',
-	'WAT':'transit','DAT_CR':'transit','DAT_B':'transit','DAT_LB':'transit','DAT_RT':'transit','SM_RA':'smart mobility','SM_SH':'smart mobility'}
-		share_master_table = pd.DataFrame(columns = ['drive','non-motorized','transit','peak','veh_own','purpose'])
-
-		for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-			for peak in ['PK','OP']:
-				for veh_own in ['0','1']:
-					if mc_obj.table_container.get_table(purpose):
-						share_table = pd.DataFrame(index = range(0,2730),columns = ['drive','non-motorized','transit']).fillna(0)
-						for mode in mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}']:
-						
-							trip_table = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode]
-							category = mode_categories[mode]
-							
-							share_table[category] += (trip_table.sum(axis = 1)+trip_table.sum(axis = 0))/2
-						
-						towns = mc_obj.taz_lu.sort_values('TAZ_ID').iloc[0:2730]
-						trips = pd.concat([towns[['TAZ_ID','BOSTON_NB']],share_table],axis = 1,join = 'inner').groupby(['BOSTON_NB']).sum().drop(['TAZ_ID'],axis = 1)
-						trips['peak'] = peak
-						trips['veh_own'] = veh_own
-						trips['purpose'] = purpose
-						
-						share_master_table = share_master_table.append(trips.reset_index())
-		
-		if by == None:
-			trip_summary = share_master_table.groupby('BOSTON_NB').sum()
-			share_summary = trip_summary.divide(trip_summary.sum(axis = 1),axis = 0)
-		
-		elif by == 'peak':
-			share_summary = pd.concat([
-			share_master_table.groupby(['peak','BOSTON_NB']).sum().loc[peak].divide(
-			share_master_table.groupby(['peak','BOSTON_NB']).sum().loc[peak].sum(axis=1),axis = 0)
-			for peak in ['PK','OP']
-			], axis = 1, keys = ['PK','OP'])
-		
-		elif by == 'veh_own':
-			share_summary = pd.concat([
-			share_master_table.groupby(['veh_own','BOSTON_NB']).sum().loc[veh_own].divide(
-			share_master_table.groupby(['veh_own','BOSTON_NB']).sum().loc[veh_own].sum(axis=1),axis = 0)
-			for veh_own in ['0','1']
-			], axis = 1, keys = ['No car', 'With car'])
-			
-		elif by == 'purpose':
-			share_summary = pd.concat([
-			share_master_table.groupby(['purpose','BOSTON_NB']).sum().loc[purpose].divide(
-			share_master_table.groupby(['purpose','BOSTON_NB']).sum().loc[purpose].sum(axis=1),axis = 0)
-			for purpose in share_master_table.purpose.unique()
-			],axis = 1, keys= share_master_table.purpose.unique())
-		
-		
-		share_summary.to_csv(out_fn)
+	categories = ['drive','non-motorized','transit','smart mobility']
+	def trips(peak, tables):
+		category_trips = np.zeros((len(categories), len(district_maps(mc_obj)['neighborhood'].code)))
+		for mode in tables:
+			category_trips[categories.index(mode_categories[mode])] += (tables[mode].sum(axis = 1) + tables[mode].sum(axis = 0)) / 2
+		return category_trips
+	segments, values = neighborhood_summary(mc_obj, trips)
+	modeled = [purpose for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3'] if mc_obj.table_container.get_table(purpose)]
+	if not any(mode_categories[mode] == 'smart mobility' for purpose in modeled for tables in mc_obj.table_container.get_table(purpose).values() for mode in tables):
+		categories, values = categories[:3], values[:, :3]
+	write_neighborhood_summary(mc_obj, segments, values, categories, 'mode_share', out_fn, by, share = True)
 	
 	
 def sum_unequal_length(a,b):
@@ -339,8 +331,84 @@ def sum_unequal_length(a,b):
         a.resize(b.shape, refcheck=False)
     return a+b	
 	
+subregion_fields = {'neighboring':'BOS_AND_NEI','i93':'in_i95i93','i495':'in_i495'}
+
+def subregion_zone_sets(taz_fn = misc_path + "TAZ_by_interstate.csv", n = None):
+	'''
+	Reads the subregion definition once and returns the zone sets used by the subregion summaries as 0/1 indicator columns.
+	:param taz_fn: TAZ file that contains subregion definition
+	:param n: number of zones; by default the largest UID in the file + 1
+	:returns: (dict of zone set name: column, n x zone sets indicator matrix)
+	'''
+	taz = pd.read_csv(taz_fn)
+	taz['BOS_AND_NEI'] = taz['TOWN'].isin(['WINTHROP','CHELSEA','REVERE','SOMERVILLE','CAMBRIDGE','WATERTOWN','NEWTON',
+              'BROOKLINE','NEEDHAM','DEDHAM','MILTON','QUINCY','BOSTON'])
+	uid = taz['UID'].astype(int).values
+	if n is None:
+		n = uid.max() + 1
+	boston = taz['TOWN'].values == 'BOSTON'
+	# for every subregion: its zones and its Boston zones; the entire region is all zones and the Boston zones in the file
+	masks = {'boston': boston, ('region','zones'): None, ('region','boston'): boston}
+	for subregion, field in subregion_fields.items():
+		masks[(subregion,'zones')] = (taz[field] == True).values
+		masks[(subregion,'boston')] = boston & masks[(subregion,'zones')]
+	columns = {name: j for j, name in enumerate(masks)}
+	indicator = np.zeros((n, len(masks)))
+	for name, mask in masks.items():
+		if mask is None:
+			indicator[:, columns[name]] = 1
+		else:
+			indicator[uid[mask], columns[name]] = 1
+	return columns, indicator
+
+@traced()
+def summarize_by_subregion(mc_obj, taz_fn = misc_path + "TAZ_by_interstate.csv"):
+	'''
+	Computes VMT and PMT to/from Boston and the mode share of trips to/from Boston for all subregions in one pass over the trip tables.
+	Every trip table is reduced to its sums over the subregion zone sets (one matrix product per table); the subregion results are
+	combinations of these sums.
+	:param mc_obj: mode choice module object as defined in the IPython notebook
+	:param taz_fn: TAZ file that contains subregion definition
+	:returns: dict of subregion ('neighboring','i93','i495','region'): {'VMT': value, 'PMT': value, 'mode share': {category: share}}
+	'''
+	columns, indicator = subregion_zone_sets(taz_fn, mc_obj.zones.n)
+	skim_dict = {'PK': mc_obj.drive_skim_PK,'OP':mc_obj.drive_skim_OP}
+	categories = ['drive','non-motorized','transit','smart mobility']
+	# trips or miles from every zone to each zone set
+	to_sets = {metric: np.zeros(indicator.shape) for metric in ['VMT','PMT'] + categories}
+
+	for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
+		if not mc_obj.table_container.get_table(purpose):
+			continue
+		for peak in ['PK','OP']:
+			length = skim_dict[peak]['Length (Skim)']
+			for veh_own in ['0','1']:
+				tables = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}']
+				vehicle_trips = tables.weighted_sum({mode: 1 / AO_dict[mode] for mode in ['DA','SR2','SR3+','SM_RA','SM_SH']})
+				person_trips = tables.weighted_sum(dict.fromkeys(['DA','SR2','SR3+'], 1))
+				to_sets['VMT'] += (vehicle_trips * length) @ indicator
+				to_sets['PMT'] += (person_trips * length) @ indicator
+				for mode in tables:
+					to_sets[mode_categories[mode]] += np.asarray(tables[mode]) @ indicator
+
+	def block_sum(metric, rows, cols): # sum over OD pairs from zone set rows to zone set cols
+		return indicator[:, columns[rows]] @ to_sets[metric][:, columns[cols]]
+
+	summary = {}
+	for subregion in ['neighboring','i93','i495','region']:
+		zones, boston = (subregion,'zones'), (subregion,'boston')
+		summary[subregion] = {}
+		for metric in ['VMT','PMT']:
+			# half of the miles of each trip to/from Boston are attributed to each end that is a Boston zone of the subregion
+			summary[subregion][metric] = (block_sum(metric, 'boston', boston) + block_sum(metric, boston, zones)
+				+ block_sum(metric, zones, boston) + block_sum(metric, boston, 'boston')) / 2 - block_sum(metric, 'boston', 'boston')
+		trips = {category: block_sum(category, 'boston', zones) + block_sum(category, zones, 'boston') - block_sum(category, 'boston', 'boston')
+			for category in categories}
+		summary[subregion]['mode share'] = {category: trips[category] / sum(trips.values()) for category in categories}
+	return summary
+
 def compute_summary_by_subregion(mc_obj,taz_fn = misc_path + "TAZ_by_interstate.csv", metric = 'VMT',subregion = 'neighboring'):
-	''' Computing function used by write_summary_by_subregion(), does not produce outputs'''
+	''' Computing function used by write_summary_by_subregion(), does not produce outputs; see summarize_by_subregion()'''
 
 	if metric.lower() not in ('vmt','pmt','mode share'):
 		print('Only supports VMT, PMT and mode share calculations.')
@@ -348,132 +416,9 @@ def compute_summary_by_subregion(mc_obj,taz_fn = misc_path + "TAZ_by_interstate.
 	if subregion.lower() not in ('neighboring','i93','i495','region'):
 		print('Only supports "neighboring" for towns neighboring Boston, I93, I495 or Region.')
 		return
-	
-	taz = pd.read_csv(taz_fn).sort_values(['ID_FOR_CS']).set_index('ID_FOR_CS')[['UID','TOWN','in_i95i93','in_i495']]
-	taz['BOS_AND_NEI'] = taz['TOWN'].isin([n for n in ['WINTHROP','CHELSEA','REVERE','SOMERVILLE','CAMBRIDGE','WATERTOWN','NEWTON',
-              'BROOKLINE','NEEDHAM','DEDHAM','MILTON','QUINCY','BOSTON']])
-	subregion_dict = {'neighboring':'BOS_AND_NEI','i93':'in_i95i93','i495':'in_i495'}
-	
-			
-	if metric.lower() == 'vmt':
-		skim_dict = {'PK': mc_obj.drive_skim_PK,'OP':mc_obj.drive_skim_OP}
-		vmt_table = np.zeros((2730,2730))
-		for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-			for peak in ['PK','OP']:
-				for veh_own in ['0','1']:
-					if mc_obj.table_container.get_table(purpose):
-						drive_modes = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'].keys()
-						trip_table = sum([mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode] / AO_dict[mode] for mode in ['DA','SR2','SR3+','SM_RA','SM_SH'] if mode in drive_modes])
-						vmt_table += trip_table * skim_dict[peak]['Length (Skim)']
-						
-		if subregion.lower() in subregion_dict:
-			field = subregion_dict[subregion.lower()]
-			boston_o_auto_vmt = vmt_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:, taz[taz[field]== True].UID.astype(int).values]
-			boston_d_auto_vmt = vmt_table[taz[taz[field]== True].UID.astype(int).values,:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values]
-			town_definition = taz[taz[field]== True]
-		
-		elif subregion.lower() == 'region':
-			boston_o_auto_vmt = vmt_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:]
-			boston_d_auto_vmt = vmt_table[:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values]
-			town_definition = taz
-		
-		zone_vmt_daily_o = pd.DataFrame(sum_unequal_length(np.sum(boston_o_auto_vmt,axis=0), np.sum(boston_o_auto_vmt,axis=1))/2 ,columns=["VMT"])
-		zone_vmt_daily_d = pd.DataFrame(sum_unequal_length(np.sum(boston_d_auto_vmt,axis=0), np.sum(boston_d_auto_vmt,axis=1))/2 ,columns=["VMT"])
-
-		boston_within_auto_vmt = vmt_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values]
-		zone_vmt_daily_within = pd.DataFrame(np.sum(boston_within_auto_vmt,axis=0)/2+np.sum(boston_within_auto_vmt,axis=1)/2,columns = ['VMT'])
-
-		town_vmt_o=pd.concat([town_definition,zone_vmt_daily_o],axis=1,join='inner')
-		town_vmt_d=pd.concat([town_definition,zone_vmt_daily_d],axis=1,join='inner')
-		town_vmt_within = pd.concat([taz[taz['TOWN']=='BOSTON'],zone_vmt_daily_within],axis=1,join='inner')
-
-		vmt_sum_o = town_vmt_o[town_vmt_o['TOWN']=='BOSTON'].groupby(['TOWN']).sum()['VMT']
-		vmt_sum_d = town_vmt_d[town_vmt_d['TOWN']=='BOSTON'].groupby(['TOWN']).sum()['VMT']
-		vmt_sum_within = town_vmt_within.groupby(['TOWN']).sum()['VMT']
-
-		boston_portion_vmt = (vmt_sum_o + vmt_sum_d - vmt_sum_within).values[0]
-		
-		return boston_portion_vmt
-	
-	elif metric.lower() == 'pmt':
-		skim_dict = {'PK': mc_obj.drive_skim_PK,'OP':mc_obj.drive_skim_OP}
-		
-		
-		pmt_table = np.zeros((2730,2730))
-		for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-			for peak in ['PK','OP']:
-				for veh_own in ['0','1']:
-					if mc_obj.table_container.get_table(purpose):
-						drive_modes = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'].keys()
-						
-						trip_table = sum([mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode] for mode in ['DA','SR2','SR3+'] if mode in drive_modes])
-						
-						pmt_table += trip_table * skim_dict[peak]['Length (Skim)']
-		
-		if subregion.lower() in subregion_dict:
-			field = subregion_dict[subregion.lower()]
-			boston_o_auto_pmt = pmt_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:, taz[taz[field]== True].UID.astype(int).values]
-			boston_d_auto_pmt = pmt_table[taz[taz[field]== True].UID.astype(int).values,:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values]
-			town_definition = taz[taz[field]== True]
-		
-		elif subregion.lower() == 'region':
-			boston_o_auto_pmt = pmt_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:]
-			boston_d_auto_pmt = pmt_table[:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values]
-			town_definition = taz
-		
-		zone_pmt_daily_o = pd.DataFrame(sum_unequal_length(np.sum(boston_o_auto_pmt,axis=0), np.sum(boston_o_auto_pmt,axis=1))/2 ,columns=["PMT"])
-		zone_pmt_daily_d = pd.DataFrame(sum_unequal_length(np.sum(boston_d_auto_pmt,axis=0), np.sum(boston_d_auto_pmt,axis=1))/2 ,columns=["PMT"])
-
-		boston_within_auto_pmt = pmt_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values]
-		zone_pmt_daily_within = pd.DataFrame(np.sum(boston_within_auto_pmt,axis=0)/2+np.sum(boston_within_auto_pmt,axis=1)/2,columns = ['PMT'])
-
-		town_pmt_o=pd.concat([town_definition,zone_pmt_daily_o],axis=1,join='inner')
-		town_pmt_d=pd.concat([town_definition,zone_pmt_daily_d],axis=1,join='inner')
-		town_pmt_within = pd.concat([taz[taz['TOWN']=='BOSTON'],zone_pmt_daily_within],axis=1,join='inner')
-
-		pmt_sum_o = town_pmt_o[town_pmt_o['TOWN']=='BOSTON'].groupby(['TOWN']).sum()['PMT']
-		pmt_sum_d = town_pmt_d[town_pmt_d['TOWN']=='BOSTON'].groupby(['TOWN']).sum()['PMT']
-		pmt_sum_within = town_pmt_within.groupby(['TOWN']).sum()['PMT']
-
-		boston_portion_pmt = (pmt_sum_o + pmt_sum_d - pmt_sum_within).values[0]
-		
-		return boston_portion_pmt
-
-	elif metric.lower() == 'mode share':		
-		mode_categories = {'DA':'drive','SR2':'drive','SR3+':'drive','Bike':'non-motorized','Walk':'non-motorized',
-	'WAT':'transit','DAT_CR':'transit','DAT_B':'transit','DAT_LB':'transit','DAT_RT':'transit','SM_RA':'smart mobility','SM_SH':'smart mobility'}
-		
-		share_table = dict(zip(['drive','non-motorized','transit','smart mobility'],[0,0,0,0]))
-		subregion_dict = {'neighboring':'BOS_AND_NEI','i93':'in_i95i93','i495':'in_i495'}
-		if subregion.lower() in subregion_dict:
-			field = subregion_dict[subregion.lower()]
-
-			for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-				for peak in ['PK','OP']:
-					for veh_own in ['0','1']:
-						if mc_obj.table_container.get_table(purpose):
-							for mode in mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}']:
-								trip_table = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode]
-								boston_ii_trips = trip_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values].sum()
-								trips = trip_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:, taz[taz[field]== True].UID.astype(int).values].sum() + trip_table[taz[taz[field]== True].UID.astype(int).values,:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values].sum() - boston_ii_trips
-								category = mode_categories[mode]
-								share_table[category]+=trips
-								
-		elif subregion.lower() == 'region':
-			for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-				for peak in ['PK','OP']:
-					for veh_own in ['0','1']:
-						if mc_obj.table_container.get_table(purpose):
-							for mode in mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}']:
-								trip_table = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode]
-								boston_ii_trips = trip_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values].sum()
-								trips = trip_table[taz[taz['TOWN']=='BOSTON'].UID.astype(int).values,:][:].sum() + trip_table[:][:,taz[taz['TOWN']=='BOSTON'].UID.astype(int).values].sum() - boston_ii_trips
-								category = mode_categories[mode]
-								share_table[category]+=trips
-		# normalize
-		return (pd.DataFrame.from_dict(share_table,orient = 'index') / (pd.DataFrame.from_dict(share_table,orient = 'index').sum())).to_dict()[0]
-		
+	return summarize_by_subregion(mc_obj, taz_fn)[subregion.lower()][{'vmt':'VMT','pmt':'PMT','mode share':'mode share'}[metric.lower()]]
 		
+@traced()
 def write_summary_by_subregion(mc_obj, taz_fn = misc_path+ "TAZ_by_interstate.csv", out_path = out_path):
 
 	'''
@@ -487,14 +432,16 @@ def write_summary_by_subregion(mc_obj, taz_fn = misc_path+ "TAZ_by_interstate.cs
 	vmt_summary_df = pd.DataFrame(index = subregion_dict.values(), columns = ['VMT to/from Boston'])
 	pmt_summary_df = pd.DataFrame(index = subregion_dict.values(), columns = ['PMT to/from Boston'])
 	mode_share_df = pd.DataFrame(index = subregion_dict.values(),columns = ['drive','non-motorized','transit','smart mobility'])
+	summary = summarize_by_subregion(mc_obj, taz_fn)
 	for subregion in subregion_dict:
-		vmt_summary_df.loc[subregion_dict[subregion]] = compute_summary_by_subregion(mc_obj,taz_fn, metric = 'VMT',subregion = subregion)
-		pmt_summary_df.loc[subregion_dict[subregion]] = compute_summary_by_subregion(mc_obj,taz_fn, metric = 'PMT',subregion = subregion)
-		mode_share_df.loc[subregion_dict[subregion]] = compute_summary_by_subregion(mc_obj,taz_fn, metric = 'mode share',subregion = subregion)
+		vmt_summary_df.loc[subregion_dict[subregion]] = summary[subregion]['VMT']
+		pmt_summary_df.loc[subregion_dict[subregion]] = summary[subregion]['PMT']
+		mode_share_df.loc[subregion_dict[subregion]] = summary[subregion]['mode share']
 	vmt_summary_df.to_csv(out_path + 'vmt_summary_subregions.csv')
 	pmt_summary_df.to_csv(out_path + 'pmt_summary_subregions.csv')
 	mode_share_df.to_csv(out_path + 'mode_share_summary_subregions.csv')
 		
+@traced()
 def transit_ridership(mc_obj,MBTA_fn =misc_path + "MBTA_coverage.csv",out_fn = None):
 	'''
 	Summarizes transit ridership by peak period in cities and towns with MBTA subway service.
@@ -502,23 +449,25 @@ def transit_ridership(mc_obj,MBTA_fn =misc_path + "MBTA_coverage.csv",out_fn = N
 	:param mbta_fn: TAZ file that contains MBTA coverage definition
 	:param out_path: output path.
 	'''
-
-	MBTA_cvg = pd.read_csv(MBTA_fn)
-	taz_cvg = mc_obj.taz_lu.merge(MBTA_cvg, how = 'left', on = 'TOWN')
-	taz_cvg = taz_cvg[['ID_FOR_CS','subway','TOWN']]
-	taz_cvg['covered'] = taz_cvg['subway']==1 # 870 TAZs included.
-	ridership = {'PK':0, 'OP':0}
+	maps = district_maps(mc_obj)
+	if ('MBTA', MBTA_fn) not in maps:
+		MBTA_cvg = pd.read_csv(MBTA_fn)
+		taz_cvg = mc_obj.taz_lu.merge(MBTA_cvg, how = 'left', on = 'TOWN').iloc[0:mc_obj.zones.n]
+		maps[('MBTA', MBTA_fn)] = district_map(np.where(taz_cvg['subway']==1, 'covered', None)) # 870 TAZs included.
+		maps[('BOSTON,MA', MBTA_fn)] = district_map(np.where(taz_cvg['TOWN']=='BOSTON,MA', 'Boston', None))
+	covered, boston = maps[('MBTA', MBTA_fn)], maps[('BOSTON,MA', MBTA_fn)]
+	boston_zones = boston.indicator()
+	to_boston = {peak: np.zeros(boston_zones.shape) for peak in ['PK','OP']} # trips from every zone to Boston
 	for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
 		for peak in ['PK','OP']:
 			for veh_own in ['0','1']:
 				if mc_obj.table_container.get_table(purpose):
 					for mode in set(mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'])&set(['WAT','DAT_B','DAT_CR','DAT_LB','DAT_RT']):
-						trips = mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode][taz_cvg['covered'],:][:,(taz_cvg['TOWN']=='BOSTON,MA')].sum()
-						ridership[peak]+=trips
+						to_boston[peak] += mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode] @ boston_zones
+	ridership = {peak: covered.reduce(to_boston[peak].T).sum() for peak in to_boston}
 						
 	# calculate ridership
 	if out_fn is None:
 		pd.DataFrame.from_dict({'Ridership':ridership}).to_csv(out_path + 'transit_ridership_summary.csv')
 	else:
 		pd.DataFrame.from_dict({'Ridership':ridership}).to_csv(out_path + out_fn)
-	
\ No newline at end of file
@@ -0,0 +1,170 @@
+# coding: utf-8
+import copy
+import hashlib
+import numpy as np
+
+
+class zonal_table(object):
+	'''
+	Defines a zonal variable that applies to the production (rows) or attraction (columns) side of an n x n table
+	(or of a block of its rows, see take()).
+	Only the zonal vector is stored; view() returns it as a broadcastable (n,1) or (1,n) array.
+	Sub-blocks of the table can be scaled with scale_block() without expanding the table.
+	'''
+	def __init__(self, var_vector, side, n = None, dtype = float):
+		'''
+		:param var_vector: either a pandas series or a numpy array with at least n entries
+		:param side: 'prod' or 'attr'
+		:param n: number of zones; by default the length of var_vector
+		:param dtype: data type of the zonal vector
+		:raises: ValueError
+		'''
+		if side not in ('prod','attr'):
+			raise ValueError('side must be "prod" or "attr"')
+		vector = np.asarray(var_vector, dtype = dtype)
+		if n is None:
+			n = len(vector)
+		if vector.ndim != 1 or len(vector) < n:
+			raise ValueError('error expanding vector, check size and input type')
+		self.vector = vector[:n].copy()
+		self.vector.flags.writeable = False
+		self.vector_id = hashlib.sha1(self.vector.tobytes()).hexdigest()
+		self.side = side
+		self.shape = (n, n)
+		self.ndim = 2
+		self.blocks = [] # (rows, cols, factor); rows and cols are sorted zone indices
+		self.version = 0
+
+	def view(self):
+		'''
+		:returns: (n,1) array for production side variables, (1,n) array for attraction side variables; if sub-blocks are scaled, the full table.
+		'''
+		if self.blocks:
+			return self.toarray()
+		return self._broadcast(slice(None))
+
+	def scale_block(self, rows, cols, factor):
+		'''
+		Multiplies the sub-block [rows, cols] of the table by factor; the zones need not be consecutive.
+		:param rows: slice or indices of production zones, e.g. zone_system.subsets['boston']
+		:param cols: slice or indices of attraction zones
+		:param factor: scaling factor
+		'''
+		rows = np.unique(np.arange(self.shape[0])[rows])
+		cols = np.unique(np.arange(self.shape[1])[cols])
+		self.blocks.append((rows, cols, factor))
+		self.version += 1
+
+	def copy(self):
+		'''
+		:returns: zonal_table sharing the zonal vector, whose blocks can be scaled without changing this table
+		'''
+		table = copy.copy(self)
+		table.blocks = list(self.blocks)
+		return table
+
+	def signature(self):
+		'''
+		:returns: hashable identity of the table: zonal vector, side and scaled blocks
+		'''
+		return (self.vector_id, self.side, self.shape,
+			tuple((hashlib.sha1(rows.tobytes()).hexdigest(), hashlib.sha1(cols.tobytes()).hexdigest(), factor)
+				for rows, cols, factor in self.blocks))
+
+	def changed_cells(self, base):
+		'''
+		:param base: zonal_table this table was copied from (see copy)
+		:returns: sorted flat indices of the cells where this table may differ from base: the blocks scaled since the copy;
+		None if the tables differ otherwise
+		'''
+		signature, base_signature = self.signature(), base.signature()
+		scaled = len(base.blocks)
+		if signature[:3] != base_signature[:3] or signature[3][:scaled] != base_signature[3]:
+			return None
+		cells = [np.ravel_multi_index(np.ix_(rows, cols), self.shape).reshape(-1) for rows, cols, factor in self.blocks[scaled:]]
+		return np.unique(np.concatenate(cells)) if cells else np.zeros(0, dtype = np.intp)
+
+	def take(self, rows):
+		'''
+		:param rows: slice of production zones
+		:returns: zonal_table for the block of rows of the table
+		'''
+		start, stop = rows.indices(self.shape[0])[:2]
+		table = copy.copy(self)
+		if self.side == 'prod':
+			table.vector = self.vector[start:stop]
+			table.vector_id = hashlib.sha1(table.vector.tobytes()).hexdigest()
+		table.shape = (stop - start, self.shape[1])
+		table.blocks = [(r[(r >= start) & (r < stop)] - start, c, f) for r, c, f in self.blocks]
+		table.blocks = [(r, c, f) for r, c, f in table.blocks if len(r)]
+		return table
+
+	def cells(self, index):
+		'''
+		:param index: (rows, cols) integer arrays of OD pairs
+		:returns: numpy array of the values of the table at the OD pairs, of the shape of the index
+		'''
+		rows, cols = np.broadcast_arrays(*index)
+		values = self.vector[rows if self.side == 'prod' else cols]
+		for r, c, f in self.blocks:
+			values[np.isin(rows, r) & np.isin(cols, c)] *= f
+		return values
+
+	def add_to(self, out, coeff = 1):
+		'''
+		Adds coeff * table to out in place.
+		:param out: numpy array with the shape of the table
+		:param coeff: coefficient
+		'''
+		out += coeff * self._broadcast(slice(None))
+		if self.blocks:
+			rows, cols, factor = self._block_factor()
+			out[np.ix_(rows, cols)] += coeff * (factor - 1) * self._broadcast(rows, cols)
+
+	def toarray(self):
+		'''
+		:returns: numpy array with the shape of the table
+		'''
+		table = np.array(np.broadcast_to(self._broadcast(slice(None)), self.shape))
+		if self.blocks:
+			rows, cols, factor = self._block_factor()
+			table[np.ix_(rows, cols)] *= factor
+		return table
+
+	def __array__(self, dtype = None):
+		table = self.toarray()
+		return table if dtype is None else table.astype(dtype)
+
+	def _broadcast(self, rows, cols = slice(None)):
+		if self.side == 'prod':
+			return self.vector[rows].reshape(-1,1)
+		else:
+			return self.vector[cols].reshape(1,-1)
+
+	def _block_factor(self):
+		# combined scaling factor over all zones of the scaled blocks
+		rows = np.unique(np.concatenate([r for r, c, f in self.blocks]))
+		cols = np.unique(np.concatenate([c for r, c, f in self.blocks]))
+		factor = np.ones((len(rows), len(cols)))
+		for r, c, f in self.blocks:
+			factor[np.ix_(np.searchsorted(rows, r), np.searchsorted(cols, c))] *= f
+		return rows, cols, factor
+
+
+def add_scaled(out, coeff, table, tmp = None):
+	'''
+	Adds coeff * table to out in place.
+	:param out: numpy array
+	:param coeff: coefficient
+	:param table: numpy array, scalar or zonal_table broadcastable to out
+	:param tmp: scratch array of the shape and type of out for coeff * table; None allocates a temporary table
+	'''
+	if isinstance(table, zonal_table):
+		table.add_to(out, coeff)
+	elif coeff == 1:
+		out += table
+	elif tmp is not None and np.shape(table) == out.shape and np.result_type(table) == tmp.dtype:
+		np.multiply(table, coeff, out = tmp)
+		out += tmp
+	else:
+		out += coeff * table
@@ -0,0 +1,62 @@
+# coding: utf-8
+import numpy as np
+
+
+class zone_system(object):
+	'''
+	Zone system of a model run: the number of zones of the OD tables, the TAZ table row of each zone and named subsets of zones.
+	It is derived from the inputs when they are loaded (see from_inputs), so that the model runs on any number of zones;
+	table shapes, row blocks, scenario edits and summaries are sized from it.
+	'''
+	def __init__(self, taz, n = None):
+		'''
+		:param taz: pandas DataFrame with one row per zone, in the order of the zones in the skims (e.g. Mode_Choice.taz_lu);
+		rows past n (e.g. external stations) are ignored
+		:param n: number of zones; by default the number of rows of taz
+		:raises: ValueError if taz has fewer than n rows
+		'''
+		n = len(taz) if n is None else int(n)
+		if len(taz) < n:
+			raise ValueError(f'TAZ table has {len(taz)} rows for {n} zones')
+		self.n = n
+		self.shape = (n, n)
+		self.taz = taz.iloc[:n].reset_index(drop = True)
+		self.ids = self.taz['ID'].values
+		self.subsets = {}
+		if 'TOWN' in self.taz:
+			self.subsets['boston'] = self.where('TOWN', ['BOSTON,MA'])
+
+	@classmethod
+	def from_inputs(cls, taz, skim, core = None):
+		'''
+		:param taz: TAZ table, see __init__
+		:param skim: skim (see mc_skim_store.omx_skim) whose tables have one row and column per zone, e.g. the peak drive skim
+		:param core: core that gives the number of zones; by default the first core of the skim
+		:returns: zone_system
+		'''
+		return cls(taz, skim.shape(core or skim.cores[0])[0])
+
+	def __len__(self):
+		return self.n
+
+	def where(self, column, values):
+		'''
+		:param column: column of the TAZ table
+		:param values: list of values
+		:returns: sorted indices of the zones whose value of column is in values
+		'''
+		return np.flatnonzero(self.taz[column].isin(values).values)
+
+	def index_of(self, ids):
+		'''
+		:param ids: zone IDs (column ID of the TAZ table)
+		:returns: sorted indices of the zones with these IDs
+		'''
+		return np.flatnonzero(np.isin(self.ids, ids))
+
+	def table_nbytes(self, dtype):
+		'''
+		:param dtype: data type
+		:returns: bytes of one OD table
+		'''
+		return self.n * self.n * np.dtype(dtype).itemsize
@@ -8,13 +8,53 @@ import warnings
 import tables
 import config
 import time
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from IPython.display import display
 from openpyxl import load_workbook
 from mc_util import *
-from mc_table_container import table_container
+from mc_table_container import table_container, purpose_tables, sparse_table
+from mc_skim_store import omx_skim, skim_store, table_rows, table_cells
+from mc_zonal import zonal_table, add_scaled
+from mc_param import compiled_param, read_param_table
+from mc_logit import nested_logit, pivot_nested_logit
+from mc_parallel import run_parallel
+from mc_cache import utility_cache
+from mc_derived import derived_tables
+from mc_trace import tracer, traced
+from mc_zones import zone_system
 warnings.simplefilter('ignore', tables.NaturalNameWarning)
 import gc
 
+# skim cores read by var_by_mode, by variable and skim group
+skim_cores_by_var = {
+	'IVTT': {'drive':['CongTime'], 'transit':['Total_IVTT']},
+	'OVTT': {'drive':['TerminalTimes'], 'transit':['Total_OVTT'], 'Walk':['WalkTime'], 'Bike':['BikeTime']},
+	'Cost': {'drive':['Auto_Toll (Skim)','Length (Skim)','CongTime'], 'transit':['Total_Cost']},
+	'length': {'Walk':['Length (Skim)'], 'Bike':['Length (Skim)']},
+	'Sqrlength': {'Walk':['Length (Skim)'], 'Bike':['Length (Skim)']}
+	}
+
+# zonal variables and model / config scalars read by var_by_mode, by variable and skim group
+zonal_vars_by_var = {
+	'OVTT': {'transit':['Hwy_Prod_Term']},
+	'Parking': {'drive':['parking']},
+	'AccPEV': {'transit':['AccPEV'], 'Walk':['AccPEV'], 'Bike':['AccPEV']},
+	'EgrPEV': {'transit':['EgrPEV'], 'Walk':['EgrPEV'], 'Bike':['EgrPEV']},
+	'PopD': {'transit':['PopD'], 'Walk':['PopD'], 'Bike':['PopD']},
+	'EmpD': {'transit':['EmpD'], 'Walk':['EmpD'], 'Bike':['EmpD']},
+	'HHSize': {'drive':['HHSize']},
+	'VPW': {'drive':['VPW']},
+	'wacc_fact': {'transit':['wacc_PK','wacc_OP']},
+	'wegr_fact': {'transit':['wegr_PK','wegr_OP']}
+	}
+scalars_by_var = {
+	'IVTT': {'drive':['SM_SH_IVTT_factor']},
+	'OVTT': {'drive':['SM_RA_OVTT','SM_SH_OVTT_factor']},
+	'Cost': {'drive':['cost_per_mile','AO_dict','SM_base_fare','SM_distance_coef','SM_time_coef','SM_SH_cost_factor']}
+	}
+
 class Mode_Choice(object):
 	'''Mode choice object that computes mode probabilities given inputs.'''
 	def __init__(self,config, run_now = False, all_purposes = False):
@@ -23,8 +63,13 @@ class Mode_Choice(object):
 		self.cost_per_mile = config.cost_per_mile
 		self.purpose = config.purpose
 		self.param_file = config.param_file
+		self.param_tables = {} # parameter tables by purpose that take precedence over param_file, e.g. CAV parameters
 		self.table_container = table_container(self)
 		self.peak_veh = ['0_PK','1_PK','0_OP','1_OP'] # vehicle ownership + peak: market segments used in trip tables
+		self.zones = None # zone system, set when inputs are loaded (see read_zone_system)
+		self.shape = None # shape of OD tables; a row block (see row_block) has fewer rows
+		self.dtype = np.dtype(config.precision)
+		self._demand_support = {} # pre-MC trip table name: (table, flat indices of its OD pairs with trips)
 	
 		self.drive_modes = ['DA','SR2','SR3+','SR2+']
 		self.DAT_modes = ['DAT_CR','DAT_RT','DAT_LB','DAT_B']
@@ -32,37 +77,103 @@ class Mode_Choice(object):
 		self.active_modes = ['Walk','Bike']
 		self.smart_mobility_modes = ['SM_RA','SM_SH']
 		self.start_time = time.time()
+		self.trace = tracer.from_config(config) # timed spans of the run, see mc_trace.py
 		
 		self.mode_share_excel_fn = config.out_path + "MC_mode_share_{}.xlsx".format(time.strftime("%Y%m%d_%H%M%S"))
+		self.utility_cache = None
+		if config.utility_cache_memory or config.utility_cache_disk:
+			self.utility_cache = utility_cache(config.utility_cache_memory * 2**20, config.utility_cache_disk * 2**20,
+				config.utility_cache_path or config.out_path + 'utility_cache')
+		self.derived = derived_tables(config.derived_table_memory * 2**20) # derived variable tables, see derived_table
 		
 		if run_now == True:
 			self.load_input()
 			self.run_model(all_purposes)
 		
-	def run_model(self, all_purposes = False):
-		if all_purposes:
-			print('Running for all purposes...')
-			for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-				print(f'Mode choice for {purpose} started.')
-				self.run_for_purpose(purpose)
-				write_mode_share_to_excel(self,purpose)
-		else:
-			print(f'Mode choice for {self.purpose} started.')
-			self.run_for_purpose(purpose = None)
+	def run_model(self, all_purposes = False, n_jobs = None, base = None):
+		'''
+		:param all_purposes: run all six purposes; otherwise only config.purpose
+		:param n_jobs: number of worker processes used for all purposes; by default config.n_jobs
+		:param base: base run this object was copied from (see scenario_copy); if given, trips are pivoted from its results
+		'''
+		if n_jobs is None:
+			n_jobs = self.config.n_jobs
+		with self.trace.span('run_model', all_purposes = all_purposes, n_jobs = n_jobs, pivot = base is not None):
+			if all_purposes and n_jobs > 1 and base is None and not self.config.stream_rows:
+				print(f'Running for all purposes on {n_jobs} processes...')
+				run_parallel(self, ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3'], n_jobs)
+			elif all_purposes:
+				print('Running for all purposes...')
+				for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
+					print(f'Mode choice for {purpose} started.')
+					self.run_for_purpose(purpose, base)
+					write_mode_share_to_excel(self,purpose)
+			else:
+				print(f'Mode choice for {self.purpose} started.')
+				self.run_for_purpose(purpose = None, base = base)
+			if getattr(self, 'skims', None) is not None:
+				self.skims.release() # edited skim cores are applied again when next read
+		self.trace.flush(self.config) # trace and profile written after every run
 	
-	def run_for_purpose(self, purpose = None):
+	@traced(attrs = lambda purpose = None, base = None: {'purpose': purpose})
+	def run_for_purpose(self, purpose = None, base = None):
 		if purpose == None:
 			purpose = self.purpose
 		self.read_param(purpose)
-		self.calculate_trips_by_mode()
+		if self.config.stream_rows: # streamed runs are not pivoted from a base run
+			self.trips_by_mode = self.stream_trips_by_mode(purpose, self.config.stream_rows, self.config.n_threads)
+		else:
+			self.calculate_trips_by_mode(self.pivot_base(base, purpose) if base is not None else None)
 		self.table_container.store_table(purpose)
 	
+	def scenario_copy(self):
+		'''
+		Returns a copy of the mode choice object with loaded inputs to which scenarios can be applied without changing this object.
+		Skims, trip tables and zonal variables are shared until they are replaced; shared tables are made read-only.
+		Run the copy with run_model(base = self) to pivot from the results of this object.
+		'''
+		scen = copy.copy(self)
+		scen.table_container = table_container(scen)
+		scen.param_tables = dict(self.param_tables)
+		scen.derived = self.derived.copy()
+		scen.skims = self.skims.copy()
+		for skim_fn in self.skim_list:
+			setattr(scen, skim_fn, scen.skims[skim_fn])
+		scen.set_skim_dicts()
+		if isinstance(self.pre_MC_trip_table, omx_skim): # streamed, see read_trip_table
+			scen.pre_MC_trip_table = self.pre_MC_trip_table.copy()
+		else:
+			for table in self.pre_MC_trip_table.values():
+				table.flags.writeable = False
+			scen.pre_MC_trip_table = dict(self.pre_MC_trip_table)
+		for var in self.zonal_vars:
+			setattr(scen, var, getattr(self, var).copy())
+		return scen
+	
+	def pivot_base(self, base, purpose):
+		'''
+		:param base: base run this object was copied from
+		:param purpose: purpose of the active parameter table
+		:returns: shallow copy of base with the base parameter table of purpose, or None if trips cannot be pivoted from base
+		'''
+		base_trips = base.table_container.get_table(purpose)
+		param = base.param_table(purpose)
+		if not base_trips or list(param['mode']) != list(self.param['mode']):
+			print(f'No base results with the modes of {purpose} to pivot from; running the full model.')
+			return None
+		base_view = copy.copy(base)
+		base_view.set_param(param, purpose)
+		base_view.trips_by_mode = base_trips
+		return base_view
+	
 	def load_input(self):
 		self.read_taz_data()
 		self.read_skims()
+		self.read_zone_system()
 		self.read_trip_table()
 		self.generate_zonal_var()
 	
+	@traced()
 	def read_taz_data(self):
 		taz = pd.read_csv(self.config.taz_file)
 		land_use = pd.read_csv(self.config.land_use_file)
@@ -71,49 +182,78 @@ class Mode_Choice(object):
 		self.taz_zonal = pd.read_csv(self.config.taz_zonal_file).sort_values('TAZ_ID')
 		print(f'✓ TAZ / land use / parking / zonal variables read. Time elapsed: {time.time()-self.start_time:.2f} seconds')
 
+	@traced()
 	def read_skims(self):
+		# skim cores are read lazily, see prefetch_skims
+		self.skims = skim_store(self.config)
 		self.skim_list = []
 		for skim_fn in self.config.skim_list:
-			exec('self.' + skim_fn +
-				 ' = store_omx_as_dict(self.config.'
-				 +skim_fn+ '_file)')	
+			setattr(self, skim_fn, self.skims[skim_fn])
 			self.skim_list.append(skim_fn)
 		
-		print(f'✓ skims read. Time elapsed: {time.time()-self.start_time:.2f} seconds')
-		
+		print(f'✓ skims opened. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+		self.set_skim_dicts()
+	
+	def read_zone_system(self):
+		# number of zones from the peak drive skim, zone attributes and subsets from the TAZ table
+		self.zones = zone_system.from_inputs(self.taz_lu, self.drive_skim_PK)
+		self.shape = self.zones.shape
+		print(f'✓ zone system of {self.zones.n} zones set. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+
+	def set_skim_dicts(self):
 		self.skim_PK_dict = {'drive':self.drive_skim_PK,'DAT_B':self.DAT_B_skim_PK,'DAT_CR':self.DAT_CR_skim_PK,'DAT_RT':self.DAT_RT_skim_PK,'DAT_LB':self.DAT_LB_skim_PK,'WAT':self.WAT_skim_PK,'Walk':self.walk_skim,'Bike':self.bike_skim,'SM_RA':self.drive_skim_PK,'SM_SH':self.drive_skim_PK}
 		
 		self.skim_OP_dict = {'drive':self.drive_skim_OP,'DAT_B':self.DAT_B_skim_OP,'DAT_CR':self.DAT_CR_skim_OP,'DAT_RT':self.DAT_RT_skim_OP,'DAT_LB':self.DAT_LB_skim_OP,'WAT':self.WAT_skim_OP,'Walk':self.walk_skim,'Bike':self.bike_skim,'SM_RA':self.drive_skim_OP,'SM_SH':self.drive_skim_OP}
 		
+	@traced()
 	def read_trip_table(self):
-		self.pre_MC_trip_table = store_omx_as_dict(self.config.pre_MC_trip_file)
+		if self.config.stream_rows: # rows are read from the file when needed, see stream_trips_by_mode
+			self.pre_MC_trip_table = omx_skim(self.config.pre_MC_trip_file, False, self.dtype, stream = True)
+		else:
+			self.pre_MC_trip_table = store_omx_as_dict(self.config.pre_MC_trip_file, self.dtype)
 		print(f'✓ trip table read. Time elapsed: {time.time()-self.start_time:.2f} seconds')
 		
+	@traced()
 	def generate_zonal_var(self):
 	# this generates parking, PEV, pop density, emp density, hh size, vpw, wacc, wegr tables.
-		self.parking = expand_attr(self.taz_parking['Daily Parking Cost'])/2
-		self.AccPEV = expand_prod(self.taz_zonal['Acc_PEV'].fillna(0.001))
-		self.EgrPEV = expand_attr(self.taz_zonal['Egr_PEV'].fillna(0.001))
-		self.PopD = np.sqrt(expand_prod( self.taz_zonal['Tot_Pop']/self.taz_zonal['Area'] ) )
-		self.EmpD = np.sqrt(expand_attr( self.taz_zonal['Tot_Emp']/self.taz_zonal['Area'] ) )
-		self.HHSize = expand_prod((self.taz_zonal['HH_Pop']/self.taz_zonal['HH']).fillna(0))
-		self.VPW = expand_prod( self.taz_zonal['VehiclesPerWorker'].fillna(
-		self.taz_zonal['VehiclesPerWorker'].mean()))
-		self.wacc_PK = expand_prod( self.taz_zonal['AM_wacc_fact'])
-		self.wacc_OP = expand_prod( self.taz_zonal['MD_wacc_fact'])
-		self.wegr_PK = expand_attr( self.taz_zonal['AM_wacc_fact'])
-		self.wegr_OP = expand_attr( self.taz_zonal['MD_wacc_fact'])
-		self.Hwy_Prod_Term = expand_prod( self.taz_zonal['Hwy Prod Term Time']) 
+	# zonal variables are stored as vectors and broadcast on the production (rows) or attraction (columns) side.
+		n = self.zones.n
+		self.parking = zonal_table(self.taz_parking['Daily Parking Cost'].values/2, 'attr', n, dtype = self.dtype)
+		self.AccPEV = zonal_table(self.taz_zonal['Acc_PEV'].fillna(0.001), 'prod', n, dtype = self.dtype)
+		self.EgrPEV = zonal_table(self.taz_zonal['Egr_PEV'].fillna(0.001), 'attr', n, dtype = self.dtype)
+		self.PopD = zonal_table(np.sqrt( self.taz_zonal['Tot_Pop']/self.taz_zonal['Area'] ), 'prod', n, dtype = self.dtype)
+		self.EmpD = zonal_table(np.sqrt( self.taz_zonal['Tot_Emp']/self.taz_zonal['Area'] ), 'attr', n, dtype = self.dtype)
+		self.HHSize = zonal_table((self.taz_zonal['HH_Pop']/self.taz_zonal['HH']).fillna(0), 'prod', n, dtype = self.dtype)
+		self.VPW = zonal_table( self.taz_zonal['VehiclesPerWorker'].fillna(
+		self.taz_zonal['VehiclesPerWorker'].mean()), 'prod', n, dtype = self.dtype)
+		self.wacc_PK = zonal_table( self.taz_zonal['AM_wacc_fact'], 'prod', n, dtype = self.dtype)
+		self.wacc_OP = zonal_table( self.taz_zonal['MD_wacc_fact'], 'prod', n, dtype = self.dtype)
+		self.wegr_PK = zonal_table( self.taz_zonal['AM_wacc_fact'], 'attr', n, dtype = self.dtype)
+		self.wegr_OP = zonal_table( self.taz_zonal['MD_wacc_fact'], 'attr', n, dtype = self.dtype)
+		self.Hwy_Prod_Term = zonal_table( self.taz_zonal['Hwy Prod Term Time'], 'prod', n, dtype = self.dtype) 
+		self.zonal_vars = ['parking','AccPEV','EgrPEV','PopD','EmpD','HHSize','VPW','wacc_PK','wacc_OP','wegr_PK','wegr_OP','Hwy_Prod_Term']
 		print(f'✓ zonal variable tables generated. Time elapsed: {time.time()-self.start_time:.2f} seconds')
 		
+	@traced(attrs = lambda purpose = None: {'purpose': purpose})
 	def read_param(self, purpose = None):
 
-		if purpose:
-			param = pd.read_excel(self.param_file,sheet_name = purpose).fillna(0)
-		else:	
+		if not purpose:
 			purpose = self.config.purpose
-			param = pd.read_excel(self.param_file,sheet_name=self.config.purpose).fillna(0) 
 		
+		self.set_param(self.param_table(purpose), purpose)
+		self.prefetch_skims()
+		print(f'✓ Parameter table for {purpose} generated. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+	
+	def param_table(self, purpose):
+		'''Returns the parameter table of purpose: from param_tables if present, otherwise from param_file.'''
+		if purpose in self.param_tables:
+			return self.param_tables[purpose].fillna(0)
+		return read_param_table(self.param_file, purpose)
+	
+	def set_param(self, param, purpose):
+		'''
+		Sets the parameter table (one sheet of the parameter workbook) used for the following mode choice calculations.
+		'''
 		trip_tables = [purpose+ i for i in ['_PK_0Auto','_PK_wAuto','_OP_0Auto','_OP_wAuto']]
 
 		self.trip_tables_dict = dict(zip(self.peak_veh,trip_tables))
@@ -122,9 +262,24 @@ class Mode_Choice(object):
 		self.coef_table = param[coef_col]
 		self.var_list = param.columns.drop(coef_col)
 		self.param = param
+		self.compiled_param = compiled_param(param)
 		self.AO_dict = self.config.AO_dict[purpose]
-		print(f'✓ Parameter table for {purpose} generated. Time elapsed: {time.time()-self.start_time:.2f} seconds')
-		
+	
+	@traced()
+	def prefetch_skims(self):
+		'''Reads the skim cores used by the variables of the active parameter table; other cores stay on disk.'''
+		for skim_dict in [self.skim_PK_dict, self.skim_OP_dict]:
+			for key, skim in skim_dict.items():
+				if key in ['drive','SM_RA','SM_SH']:
+					group = 'drive'
+				elif key in self.DAT_modes + ['WAT']:
+					group = 'transit'
+				else:
+					group = key
+				for var in self.var_list:
+					skim.prefetch(skim_cores_by_var.get(var,{}).get(group,[]))
+		
+	@traced(attrs = lambda pv, var, mode: {'pv': pv, 'var': var, 'mode': mode})
 	def var_by_mode(self,pv,var,mode):
 		drive_modes = self.drive_modes
 		DAT_modes = self.DAT_modes
@@ -132,7 +287,8 @@ class Mode_Choice(object):
 		active_modes = self.active_modes
 		smart_mobility_modes = self.smart_mobility_modes
 		
-		table = np.zeros((2730,2730))
+		table = 0 # variables that do not apply to a mode are 0
+		n = self.zones.n # skims with more zones (walk and bike) are cut to the zone system
 		
 		peak = pv[2:]
 		if peak == 'PK':
@@ -148,12 +304,12 @@ class Mode_Choice(object):
 				table = skim['CongTime']
 			elif mode in DAT_modes:
 				skim = skim_dict[mode]
-				table = skim['Total_IVTT']
-				table[np.where(table==0)]=+1e4 # 0 in DAT skims indicates no path found
+				table = self.derived_table(('IVTT', mode, peak), skim, ['Total_IVTT'],
+					lambda: np.where(skim['Total_IVTT']==0, 1e4, skim['Total_IVTT'])) # 0 in DAT skims indicates no path found
 			elif mode in WAT_modes:
 				skim = skim_dict['WAT']
-				table = skim['Total_IVTT']
-				table[np.where(table==0)]=+1e4 # 0 in DAT skims indicates no path found
+				table = self.derived_table(('IVTT', 'WAT', peak), skim, ['Total_IVTT'],
+					lambda: np.where(skim['Total_IVTT']==0, 1e4, skim['Total_IVTT'])) # 0 in DAT skims indicates no path found
 			elif mode in active_modes:
 				pass
 			elif mode in smart_mobility_modes:
@@ -161,7 +317,8 @@ class Mode_Choice(object):
 				if mode == 'SM_RA':
 					table = skim['CongTime']
 				elif mode == 'SM_SH':
-					table = skim['CongTime'] * self.config.SM_SH_IVTT_factor
+					table = self.derived_table(('IVTT', mode, peak), skim, ['CongTime'],
+						lambda: skim['CongTime'] * self.config.SM_SH_IVTT_factor, [self.config.SM_SH_IVTT_factor])
 			else: print(mode,var,'not found in var_by_mode module')
 			
 		elif var == 'OVTT':
@@ -170,32 +327,34 @@ class Mode_Choice(object):
 				table = skim['TerminalTimes']
 			elif mode in DAT_modes: 
 				skim = skim_dict[mode] 
-				table = skim['Total_OVTT'] + self.Hwy_Prod_Term # add Hwy Prod Term Time
+				table = self.derived_table(('OVTT', mode, peak), skim, ['Total_OVTT'],
+					lambda: skim['Total_OVTT'] + self.Hwy_Prod_Term.view(), lambda: [self.Hwy_Prod_Term.signature()]) # add Hwy Prod Term Time
 			elif mode in WAT_modes:
 				skim = skim_dict['WAT']
 				table = skim['Total_OVTT']
 			elif mode in active_modes: # walk time, bike time from skims.
 				skim = skim_dict[mode]
-				table = skim[mode+'Time'][:2730,:2730]
+				table = skim[mode+'Time'][:n,:n]
 			elif mode in smart_mobility_modes:
 				skim = skim_dict['drive']
 				if mode == 'SM_RA':
-					table = self.config.SM_RA_OVTT_table
+					table = self.config.SM_RA_OVTT
 				elif mode == 'SM_SH':
-					table = self.config.SM_RA_OVTT_table * self.config.SM_SH_OVTT_factor
+					table = self.config.SM_RA_OVTT * self.config.SM_SH_OVTT_factor
 				#table = skim['TerminalTimes']				
 			else: print(mode,var,'not found in var_by_mode module')
 
 		elif var == 'Cost':
 			if mode in drive_modes:
 				skim = skim_dict['drive']
-				toll = skim['Auto_Toll (Skim)'] 
-				toll[np.where(abs(toll)>1e6)] = 0 # eliminate same-zone large value issues
-				
-				length = skim['Length (Skim)']
 				AO = self.AO_dict[mode]
+				def drive_cost():
+					toll = np.where(abs(skim['Auto_Toll (Skim)'])>1e6, 0, skim['Auto_Toll (Skim)']) # eliminate same-zone large value issues
+					length = skim['Length (Skim)']
+					return (toll/AO + length * self.cost_per_mile)
 				
-				table = (toll/AO + length * self.cost_per_mile)
+				table = self.derived_table(('Cost', 'drive', AO, peak), skim, ['Auto_Toll (Skim)','Length (Skim)'], drive_cost,
+					[AO, self.cost_per_mile])
 
 			elif mode in DAT_modes: 
 				skim = skim_dict[mode]
@@ -207,18 +366,21 @@ class Mode_Choice(object):
 				pass
 			elif mode in smart_mobility_modes:
 				skim = skim_dict['drive']
-				toll = skim['Auto_Toll (Skim)']
-				toll[np.where(abs(toll)>1e6)] = 0 # eliminate same-zone large value issues
+				def smart_mobility_fare():
+					toll = np.where(abs(skim['Auto_Toll (Skim)'])>1e6, 0, skim['Auto_Toll (Skim)']) # eliminate same-zone large value issues
+					length = skim['Length (Skim)']
+					time = skim['CongTime']
+					return self.config.SM_base_fare + self.config.SM_distance_coef * length + self.config.SM_time_coef * time + toll
 				
-				length = skim['Length (Skim)']
-				time = skim['CongTime']
-				
-				total_cost = self.config.SM_base_fare + self.config.SM_distance_coef * length + self.config.SM_time_coef * time + toll
+				cores = ['Auto_Toll (Skim)','Length (Skim)','CongTime']
+				fare_inputs = [self.config.SM_base_fare, self.config.SM_distance_coef, self.config.SM_time_coef]
+				total_cost = self.derived_table(('Cost', 'SM_RA', peak), skim, cores, smart_mobility_fare, fare_inputs)
 				
 				if mode == 'SM_RA':
 					table = total_cost
 				elif mode == 'SM_SH':
-					table = total_cost / self.config.SM_SH_cost_factor
+					table = self.derived_table(('Cost', 'SM_SH', peak), skim, cores,
+						lambda: total_cost / self.config.SM_SH_cost_factor, fare_inputs + [self.config.SM_SH_cost_factor])
 			
 			else: print(mode,var,'not found in var_by_mode module')    
 		
@@ -232,7 +394,7 @@ class Mode_Choice(object):
 		elif var == 'length':
 			if mode in active_modes:
 				skim = skim_dict[mode]
-				table = skim['Length (Skim)'][:2730,:2730]
+				table = skim['Length (Skim)'][:n,:n]
 			elif mode in drive_modes + DAT_modes + WAT_modes + smart_mobility_modes:
 				pass
 			else: print(mode,var,'not found in var_by_mode module')
@@ -240,7 +402,7 @@ class Mode_Choice(object):
 		elif var == 'Sqrlength':
 			if mode in active_modes:
 				skim = skim_dict[mode]
-				table = np.sqrt(skim['Length (Skim)'][:2730,:2730])
+				table = self.derived_table(('Sqrlength', mode), skim, ['Length (Skim)'], lambda: np.sqrt(skim['Length (Skim)'][:n,:n]))
 			elif mode in drive_modes + DAT_modes + WAT_modes + smart_mobility_modes:
 				pass
 			else: print(mode,var,'not found in var_by_mode module')        
@@ -289,14 +451,14 @@ class Mode_Choice(object):
 			
 		elif var == 'wacc_fact':
 			if mode in WAT_modes:
-				table = self.wacc_PK * (peak == 'PK') + self.wacc_OP * (peak == 'OP')
+				table = self.wacc_PK if peak == 'PK' else self.wacc_OP
 			elif mode in drive_modes + active_modes + DAT_modes + smart_mobility_modes:
 				pass
 			else: print(mode,var, 'not found in var_by_mode module')
 			
 		elif var == 'wegr_fact':
 			if mode in WAT_modes + DAT_modes:
-				table = self.wegr_PK * (peak == 'PK') + self.wegr_OP * (peak == 'OP')
+				table = self.wegr_PK if peak == 'PK' else self.wegr_OP
 			elif mode in drive_modes + active_modes + smart_mobility_modes:
 				pass
 			else: print(mode,var, 'not found in var_by_mode module')
@@ -304,87 +466,414 @@ class Mode_Choice(object):
 		else:
 			print(mode, var, 'not implemented in var_by_mode module')
 		
-		# dimension check
-		if table.shape!=(2730,2730):
-			try: table = table[:2730,:2730]
+		# dimension check; scalars and zonal vectors are broadcast in the utility calculation
+		if np.ndim(table) == 2 and table.shape!=self.shape:
+			try: table = table[:self.shape[0],:self.shape[1]]
 			except: raise
 		
 		return table			
 	
-	def mode_probability_tables(self,pv,modes):
-		var_values = {}
-		for mode in modes:
-			var_values[mode]={}
-			for var in self.var_list:
-				var_values[mode][var] = self.var_by_mode(pv,var,mode)
-
-		# compute utility for each mode.
-		mode_utils = {}
-		for mode in modes: 
-			util = np.zeros((2730,2730))
-			util += self.param[self.param['mode']==mode]['ASC_'+pv].values
-			for var in self.var_list:
-				# coefficient values
-				coeff = self.param[self.param['mode']==mode][var].values
-				util += coeff * var_values[mode][var]
-			mode_utils[mode] = np.exp(util)
-			
-		# compute logsums
-		nests = self.param[self.param['mode'].isin(modes)].nest.unique()
-		nest_logsums= dict(zip(nests,[np.zeros((2730,2730))]*len(nests)))
-		
-		for mode in modes:
-			nest = dict(zip(self.param['mode'],self.param['nest']))[mode]
-			nest_logsum = nest_logsums[nest]
-			nest_logsums[nest] = nest_logsum + mode_utils[mode]
-		
-		zero_logsum = {}
-
-		for nest in nests:
-			zero_logsum[nest] = (nest_logsums[nest]==0) # apply the mask later in probability calculation
-			(nest_logsums[nest])[~zero_logsum[nest]] = np.log((nest_logsums[nest])[~zero_logsum[nest]]) # if nest logsum is not zero, calculate log.
-		
-		# from logsums to mode probability
-		nest_thetas = dict(zip(self.param['nest'],self.param['nest_coefficient']))
-		mode_probs = {}
-		
-		all_nest_sum = np.zeros((2730,2730))
-		# if a nest has entries with zero logsum, it will be excluded.
-		for nest in nests:
-			all_nest_sum[~zero_logsum[nest]] += np.exp(nest_thetas[nest] * nest_logsums[nest][~zero_logsum[nest]])
-		
+	def derived_table(self, key, skim, cores, func, inputs = ()):
+		'''
+		Returns a variable table derived from skim cores (and other inputs) by func, from the registry of derived tables
+		(see mc_derived.py): it is computed once and again only after one of its inputs changed, e.g. by a scenario edit.
+		Tables of skims that cannot identify their cores (e.g. in row and cell blocks) are computed on every call.
+		:param key: slot of the table in the registry, e.g. ('IVTT', 'DAT_CR', 'PK')
+		:param skim: skim the table is derived from
+		:param cores: cores of skim the table is derived from
+		:param func: function without arguments that computes the table
+		:param inputs: other inputs of the table: scalars and zonal variable signatures, or a function returning them, which is
+		only called if the table is kept (zonal variables of cell blocks are plain arrays without a signature)
+		'''
+		signature = None
+		if hasattr(skim, 'signature'):
+			inputs = inputs() if callable(inputs) else inputs
+			signature = (tuple(skim.signature(core) for core in cores), tuple(inputs), self.shape, self.dtype.name)
+		return self.derived.get(key, signature, func)
+	
+	def input_group(self, mode):
+		'''Returns the skim group of a mode used in skim_cores_by_var, zonal_vars_by_var and scalars_by_var.'''
+		if mode in self.drive_modes + self.smart_mobility_modes:
+			return 'drive'
+		elif mode in self.DAT_modes + self.WAT_modes:
+			return 'transit'
+		return mode
+	
+	def utility_signature(self, pv, mode):
+		'''
+		Identifies the utility of a mode in a market segment: its ASC and coefficients, and the skim cores, zonal variables
+		and scalars read by its variables. Utilities with equal signatures are equal.
+		Returns None if the skims cannot identify their cores (e.g. in row blocks).
+		'''
+		param = self.compiled_param
+		group = self.input_group(mode)
+		skim_dict = self.skim_PK_dict if pv[2:] == 'PK' else self.skim_OP_dict
+		skim = skim_dict['drive' if mode in self.drive_modes else 'WAT' if mode in self.WAT_modes else mode]
+		if not hasattr(skim, 'signature'):
+			return None
+		inputs = []
+		for var, coeff in param.mode_terms(mode):
+			scalars = [getattr(self, name) if hasattr(self, name) else getattr(self.config, name) for name in scalars_by_var.get(var,{}).get(group,[])]
+			inputs.append((var, coeff,
+				tuple(skim.signature(core) for core in skim_cores_by_var.get(var,{}).get(group,[])),
+				tuple(getattr(self, name).signature() for name in zonal_vars_by_var.get(var,{}).get(group,[])),
+				tuple(value.get(mode) if isinstance(value, dict) else value for value in scalars)))
+		return (self.shape, self.dtype.name, pv, mode, param.mode_asc(mode,pv), tuple(inputs))
+	
+	def changed_cells(self, base, pv, modes):
+		'''
+		:param base: base run with the parameter table of the active purpose (see pivot_base)
+		:param pv: market segment, e.g. '0_PK'
+		:param modes: modes whose utility signatures differ from base
+		:returns: sorted flat indices of the OD pairs where the inputs of these utilities may differ from base: cells of skim cores
+		edited by update() and blocks of zonal variables scaled by scale_block(); None if they may differ anywhere, e.g. after a
+		coefficient, scalar or whole core changed
+		'''
+		cells = [np.zeros(0, dtype = np.intp)]
 		for mode in modes:
-			mode_probs[mode]={}
-			
-			nest = dict(zip(self.param['mode'],self.param['nest']))[mode]
-			theta = nest_thetas[nest]
-			modes_in_nest = self.param[self.param['nest']==nest]['mode']
+			signature, base_signature = self.utility_signature(pv,mode), base.utility_signature(pv,mode)
+			if signature is None or base_signature is None or signature[:5] != base_signature[:5] or len(signature[5]) != len(base_signature[5]):
+				return None
+			group = self.input_group(mode)
+			key = 'drive' if mode in self.drive_modes else 'WAT' if mode in self.WAT_modes else mode
+			skim = (self.skim_PK_dict if pv[2:] == 'PK' else self.skim_OP_dict)[key]
+			base_skim = (base.skim_PK_dict if pv[2:] == 'PK' else base.skim_OP_dict)[key]
+			for (var, coeff, cores, zonal, scalars), base_inputs in zip(signature[5], base_signature[5]):
+				if (var, coeff, scalars) != (base_inputs[0], base_inputs[1], base_inputs[4]):
+					return None
+				for core, core_signature, base_core_signature in zip(skim_cores_by_var.get(var,{}).get(group,[]), cores, base_inputs[2]):
+					if core_signature != base_core_signature:
+						edited = skim.changed_cells(base_skim, core)
+						if edited is not None: # skims with more zones (walk and bike) are cut to the zone system
+							rows, cols = np.unravel_index(edited, skim.shape(core))
+							inside = (rows < self.zones.n) & (cols < self.zones.n)
+							edited = np.ravel_multi_index((rows[inside], cols[inside]), self.shape)
+						cells.append(edited)
+				for name, zonal_signature, base_zonal_signature in zip(zonal_vars_by_var.get(var,{}).get(group,[]), zonal, base_inputs[3]):
+					if zonal_signature != base_zonal_signature:
+						cells.append(getattr(self, name).changed_cells(getattr(base, name)))
+				if any(edited is None for edited in cells):
+					return None
+		return np.unique(np.concatenate(cells))
+	
+	def mode_utility(self, pv, mode):
+		'''
+		:param pv: market segment, e.g. '0_PK'
+		:param mode: mode name
+		:returns: utility table of a mode: ASC plus the variables with a non-zero coefficient
+		'''
+		param = self.compiled_param
+		signature = self.utility_signature(pv,mode) if self.utility_cache is not None else None
+		cached = self.utility_cache.get(signature) if signature is not None else None
+		if cached is not None:
+			return np.array(cached)
+		util = self.fill_utility(np.empty(self.shape, dtype = self.dtype), pv, mode)
+		if signature is not None:
+			self.utility_cache.put(signature, util)
+		return util
+	
+	def fill_utility(self, util, pv, mode, tmp = None):
+		'''
+		Writes the utility of a mode to util: the ASC, then each variable with a non-zero coefficient, added in place as soon as
+		it is evaluated, so that no more than one variable table is alive at a time.
+		:param util: numpy array of shape self.shape
+		:param pv: market segment, e.g. '0_PK'
+		:param mode: mode name
+		:param tmp: scratch array of the shape of util for scaled variables (see add_scaled)
+		:returns: util
+		'''
+		param = self.compiled_param
+		util.fill(param.mode_asc(mode,pv))
+		for var, coeff in param.mode_terms(mode):
+			add_scaled(util, coeff, self.var_by_mode(pv,var,mode), tmp)
+		return util
+	
+	@traced(attrs = lambda pv, modes, out = None: {'pv': pv})
+	def mode_probability_tables(self,pv,modes, out = None):
+		'''
+		:param pv: market segment, e.g. '0_PK'
+		:param modes: modes
+		:param out: array of shape (number of modes,) + self.shape that utilities, then probabilities are written to;
+		by default a new array. Reusing it across segments or blocks avoids allocating it for each of them.
+		:returns: dict of mode: probability table (views of out), dict of nest: logsum table
+		'''
+		# only variables with a non-zero coefficient for a mode are evaluated, one at a time (see fill_utility).
+		# utilities found in the utility cache (keyed by utility_signature) are not evaluated at all.
+		param = self.compiled_param
+		modes = list(modes)
+		cache = self.utility_cache
 
-			prob_nest = np.zeros((2730,2730))
-			prob_nest[~zero_logsum[nest]] = np.exp(theta * nest_logsums[nest][~zero_logsum[nest]]) / all_nest_sum[~zero_logsum[nest]]
-			
-			prob_mode_in_nest = np.zeros((2730,2730))
-			prob_mode_in_nest[~zero_logsum[nest]] = (mode_utils[mode][~zero_logsum[nest]] / 
-			np.exp((nest_logsums[nest]))[~zero_logsum[nest]])
-				
-			prob = prob_nest * prob_mode_in_nest
-			mode_probs[mode] = prob
-		
-		return mode_probs, nest_logsums, mode_utils
+		# compute utility for each mode, stacked modes x O x D.
+		mode_utils = np.empty((len(modes),) + self.shape, dtype = self.dtype) if out is None else out
+		tmp = np.empty(self.shape, dtype = self.dtype)
+		for i, mode in enumerate(modes):
+			util = mode_utils[i]
+			signature = self.utility_signature(pv,mode) if cache is not None else None
+			cached = cache.get(signature) if signature is not None else None
+			if cached is not None:
+				np.copyto(util, cached)
+				continue
+			self.fill_utility(util, pv, mode, tmp)
+			if signature is not None:
+				cache.put(signature, util)
+		del tmp
+		
+		# nested logit; probabilities are written over the utilities.
+		nest_of_mode = param.nest_of_mode[[param.mode_index[mode] for mode in modes]]
+		probs, logsums = nested_logit(mode_utils, nest_of_mode, param.nest_coefficient, out = mode_utils)
+		
+		mode_probs = dict(zip(modes, probs))
+		nest_logsums = dict(zip(param.nests, logsums))
+		return mode_probs, nest_logsums
 
-	def calculate_trips_by_mode(self):
+	@traced()
+	def calculate_trips_by_mode(self, base = None):
+		'''
+		:param base: base run with the parameter table of the active purpose (see pivot_base); if given, trips are pivoted from its results
+		'''
 		modes = self.param['mode']
 
-		self._0_PK, self._1_PK, self._0_OP, self._1_OP = ({},{},{},{})
-		
-		self.trips_by_mode = dict(zip(self.peak_veh, [self._0_PK, self._1_PK, self._0_OP, self._1_OP]))
+		self.trips_by_mode = {pv: {} for pv in self.peak_veh}
 		
 		for pv in self.peak_veh:
-			mode_probs = self.mode_probability_tables(pv,modes)[0]
-			print(f'✓ Trips for {pv} calculated. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+			if base is None:
+				self.trips_by_mode[pv].update(self.trips_for_segment(pv,modes))
+			else:
+				self.trips_by_mode[pv].update(self.pivot_trips_for_segment(base,pv,modes))
+		
+		gc.collect()
+	
+	@traced(attrs = lambda pv, modes: {'pv': pv})
+	def trips_for_segment(self, pv, modes):
+		'''
+		:param pv: market segment, e.g. '0_PK'
+		:param modes: modes of the active parameter table
+		:returns: dict, mode: trip table
+		'''
+		if self.config.sparse_demand:
+			trips = self.trips_for_segment_by_cells(pv, modes)
+			if trips is not None:
+				return trips
+		if self.config.block_rows:
+			return self.trips_for_segment_by_block(pv, modes, self.config.block_rows, self.config.n_threads)
+		mode_probs = self.mode_probability_tables(pv,modes)[0]
+		print(f'✓ Trips for {pv} calculated. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+		n = self.zones.n
+		trip_table = self.pre_MC_trip_table[self.trip_tables_dict[pv]][:n,:n]
+		trips = {}
+		for mode in modes: # trips are written over the probabilities
+			trips[mode] = np.multiply(trip_table, mode_probs[mode], out = mode_probs[mode])
+		return trips
+	
+	@traced(attrs = lambda base, pv, modes: {'pv': pv})
+	def pivot_trips_for_segment(self, base, pv, modes):
+		'''
+		Pivot-point version of trips_for_segment: only the utilities whose inputs differ from the base run (see utility_signature)
+		are computed, only for the OD pairs whose inputs changed (see changed_cells), and mode shares are only updated for the
+		OD pairs where these utilities changed. Trips of OD pairs that had no base trips are computed in full.
+		:param base: base run with the parameter table of the active purpose (see pivot_base)
+		:param pv: market segment, e.g. '0_PK'
+		:param modes: modes of the active parameter table
+		:returns: dict, mode: trip table
+		'''
+		modes = list(modes)
+		n = self.zones.n
+		trip_table = self.pre_MC_trip_table[self.trip_tables_dict[pv]][:n,:n]
+		base_table = base.pre_MC_trip_table[self.trip_tables_dict[pv]][:n,:n]
+		
+		base_trips = base.trips_by_mode[pv]
+		if self.pre_MC_trip_table[self.trip_tables_dict[pv]] is base.pre_MC_trip_table[self.trip_tables_dict[pv]]:
+			trips = {mode: np.array(base_trips[mode]) for mode in modes}
+			new_cells = np.zeros(0, dtype = np.intp)
+		else:
+			with np.errstate(divide = 'ignore', invalid = 'ignore'):
+				scale = np.nan_to_num(trip_table / base_table)
+			trips = {mode: (base_trips[mode] * scale).astype(self.dtype) for mode in modes}
+			new_cells = np.flatnonzero((base_table == 0) & (trip_table != 0)) # base mode shares are not known where there were no trips
+		
+		signatures = [(self.utility_signature(pv,mode), base.utility_signature(pv,mode)) for mode in modes]
+		changed = [mode for mode, (sig, base_sig) in zip(modes, signatures) if sig is None or sig != base_sig]
+		if changed:
+			# utility changes are only evaluated for the OD pairs whose inputs changed, if these are known
+			cells = self.changed_cells(base, pv, changed)
+			if cells is None:
+				delta_utils = {mode: (self.mode_utility(pv,mode) - base.mode_utility(pv,mode)).reshape(-1) for mode in changed}
+				cells = np.arange(n * n)
+			elif cells.size:
+				index = self.packed_cells(cells)
+				block, base_block = self.cell_block(index), base.cell_block(index)
+				delta_utils = {mode: (block.mode_utility(pv,mode) - base_block.mode_utility(pv,mode)).reshape(-1)[:cells.size] for mode in changed}
+			else:
+				delta_utils = {}
+			if delta_utils:
+				touched = np.any([delta != 0 for delta in delta_utils.values()], axis = 0)
+				cells = cells[touched]
+				delta_utils = {mode: delta[touched] for mode, delta in delta_utils.items()}
+			
+			param = self.compiled_param
+			nest_of_mode = param.nest_of_mode[[param.mode_index[mode] for mode in modes]]
+			base_probs = np.stack([np.take(base_trips[mode], cells) for mode in modes])
+			deltas = np.zeros(base_probs.shape)
+			for i, mode in enumerate(modes):
+				if mode in delta_utils:
+					deltas[i] = delta_utils[mode]
+			mode_probs = pivot_nested_logit(base_probs, deltas, nest_of_mode, param.nest_coefficient)
+			for mode, probs in zip(modes, mode_probs):
+				np.put(trips[mode], cells, np.take(trip_table, cells) * probs)
+		if new_cells.size: # trips of OD pairs without base trips are computed in full
+			block = self.cell_block(self.packed_cells(new_cells))
+			mode_probs = block.mode_probability_tables(pv,modes)[0]
+			new_trips = block.pre_MC_trip_table[self.trip_tables_dict[pv]]
+			for mode in modes:
+				np.put(trips[mode], new_cells, (new_trips * mode_probs[mode]).reshape(-1)[:new_cells.size])
+		print(f'✓ Trips for {pv} pivoted ({len(changed)} of {len(modes)} utilities changed). Time elapsed: {time.time()-self.start_time:.2f} seconds')
+		return trips
+	
+	def trips_for_segment_by_block(self, pv, modes, block_rows, n_threads = 1):
+		'''
+		Runs the utility - logsum - probability - trips chain for blocks of origin zones, on a thread pool,
+		so that temporaries stay cache-sized. Results are the same as trips_for_segment.
+		:param pv: market segment, e.g. '0_PK'
+		:param modes: modes of the active parameter table
+		:param block_rows: number of origin zones per block
+		:param n_threads: number of threads
+		:returns: dict, mode: trip table
+		'''
+		modes = list(modes)
+		trips = {mode: np.empty(self.shape, dtype = self.dtype) for mode in modes}
+		
+		n = self.zones.n
+		def run_block(rows):
+			block = self.row_block(rows)
+			mode_probs = block.mode_probability_tables(pv,modes)[0]
+			trip_table = block.pre_MC_trip_table[self.trip_tables_dict[pv]][:n,:n]
 			for mode in modes:
-				trip_table = self.pre_MC_trip_table[self.trip_tables_dict[pv]][:2730,:2730]
-				trips_MC = trip_table * mode_probs[mode]
-				self.trips_by_mode[pv][mode] = trips_MC
+				np.multiply(trip_table, mode_probs[mode], out = trips[mode][rows])
 		
-		gc.collect()		
\ No newline at end of file
+		blocks = [slice(row, min(row + block_rows, self.shape[0])) for row in range(0, self.shape[0], block_rows)]
+		with ThreadPoolExecutor(n_threads) as pool:
+			list(pool.map(run_block, blocks))
+		print(f'✓ Trips for {pv} calculated. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+		return trips
+	
+	@traced(attrs = lambda purpose, block_rows, n_threads = 1: {'purpose': purpose, 'block_rows': block_rows})
+	def stream_trips_by_mode(self, purpose, block_rows, n_threads = 1):
+		'''
+		Out-of-core version of calculate_trips_by_mode for zone systems whose tables do not fit in memory. For each block of
+		origin zones, skim rows and pre-MC trip rows (read from the .omx files, see omx_skim.rows) and zonal slices go through
+		the utility - logsum - probability - trips chain of every market segment. Trips are written to a memory-mapped file of
+		the table container, and trip totals by market segment and mode are accumulated on the way, so peak memory is bounded
+		by block_rows x number of zones rather than by the number of zones squared.
+		:param purpose: purpose of the active parameter table
+		:param block_rows: number of origin zones per block
+		:param n_threads: number of threads that evaluate blocks
+		:returns: purpose_tables
+		'''
+		modes = list(self.param['mode'])
+		tables = purpose_tables(self.peak_veh, modes, self.shape, self.dtype, self.table_container.spill_file(purpose))
+		sums = np.zeros(tables.stored.shape)
+		lock = threading.Lock()
+		
+		n = self.zones.n
+		def run_block(rows):
+			block = self.row_block(rows, cache = True) # rows of each table are read once for all segments
+			block_sums = np.zeros(sums.shape)
+			probs = np.empty((len(modes),) + block.shape, dtype = self.dtype) # reused by all segments
+			for s, pv in enumerate(self.peak_veh):
+				mode_probs = block.mode_probability_tables(pv,modes,probs)[0]
+				trip_table = block.pre_MC_trip_table[self.trip_tables_dict[pv]][:n,:n]
+				for m, mode in enumerate(modes):
+					out = tables.array[s, m, rows]
+					np.multiply(trip_table, mode_probs[mode], out = out)
+					block_sums[s, m] = out.sum(dtype = np.float64)
+			with lock:
+				np.add(sums, block_sums, out = sums)
+		
+		blocks = [slice(row, min(row + block_rows, self.shape[0])) for row in range(0, self.shape[0], block_rows)]
+		with ThreadPoolExecutor(n_threads) as pool:
+			list(pool.map(run_block, blocks))
+		tables.stored[:] = True
+		tables.freeze()
+		tables.sums = sums
+		print(f'✓ Trips for {purpose} streamed in {len(blocks)} blocks. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+		return tables
+	
+	def demand_support(self, pv):
+		'''
+		:param pv: market segment, e.g. '0_PK'
+		:returns: sorted flat indices of the OD pairs with trips in the pre-MC trip table of the segment; found once per table
+		'''
+		name = self.trip_tables_dict[pv]
+		table = self.pre_MC_trip_table[name]
+		cached = self._demand_support.get(name)
+		if cached is None or cached[0] is not table:
+			cached = (table, np.flatnonzero(table[:self.zones.n,:self.zones.n]))
+			self._demand_support[name] = cached
+		return cached[1]
+	
+	def trips_for_segment_by_cells(self, pv, modes):
+		'''
+		Runs the utility - logsum - probability - trips chain only for the OD pairs with trips in the pre-MC trip table of the segment,
+		packed into rows of a table (see cell_block). Results are the same as trips_for_segment, as sparse tables; the table
+		container writes them to a memory-mapped file (see table_container), so they are not expanded in memory.
+		:param pv: market segment, e.g. '0_PK'
+		:param modes: modes of the active parameter table
+		:returns: dict, mode: sparse_table; None if more than config.sparse_demand of the OD pairs have trips
+		'''
+		modes = list(modes)
+		support = self.demand_support(pv)
+		if support.size > self.config.sparse_demand * self.shape[0] * self.shape[1]:
+			return None
+		if not support.size:
+			return {mode: sparse_table(support, np.zeros(0, dtype = self.dtype), self.shape) for mode in modes}
+		block = self.cell_block(self.packed_cells(support))
+		mode_probs = block.mode_probability_tables(pv,modes)[0]
+		trip_table = block.pre_MC_trip_table[self.trip_tables_dict[pv]]
+		trips = {mode: sparse_table(support, (trip_table * mode_probs[mode]).reshape(-1)[:support.size], self.shape) for mode in modes}
+		print(f'✓ Trips for {pv} calculated for {support.size} OD pairs with trips. Time elapsed: {time.time()-self.start_time:.2f} seconds')
+		return trips
+	
+	def packed_cells(self, cells):
+		'''
+		:param cells: flat indices of OD pairs
+		:returns: (rows, cols) index of the OD pairs packed into rows of the width of a table, as cell_block takes; the last row is
+		padded with repeated OD pairs, so values of the OD pairs are the first len(cells) of the flattened block tables
+		'''
+		width = self.shape[1]
+		packed = np.resize(cells, -(-cells.size // width) * width).reshape(-1, width)
+		return np.unravel_index(packed, self.shape)
+	
+	def cell_block(self, index):
+		'''
+		Returns a shallow copy of the mode choice object restricted to some OD pairs: skims, the pre-MC trip table and zonal variables
+		return the values of these OD pairs as arrays of the shape of the index, so var_by_mode and mode_probability_tables
+		return tables of that shape.
+		:param index: (rows, cols) integer arrays of OD pairs, of shape (rows, number of zones) or less
+		'''
+		block = copy.copy(self)
+		for skim_fn in self.skim_list:
+			setattr(block, skim_fn, table_cells(getattr(self, skim_fn), index))
+		block.set_skim_dicts()
+		block.pre_MC_trip_table = table_cells(self.pre_MC_trip_table, index)
+		for var in self.zonal_vars:
+			setattr(block, var, getattr(self, var).cells(index))
+		block.shape = index[0].shape
+		return block
+	
+	def row_block(self, rows, cache = False):
+		'''
+		Returns a shallow copy of the mode choice object restricted to a block of origin zones:
+		skims, the pre-MC trip table and zonal variables only expose these rows, so var_by_mode and mode_probability_tables
+		return tables of shape (number of rows, number of zones).
+		:param rows: slice of origin zones
+		:param cache: keep the rows of each table once read (see table_rows)
+		'''
+		block = copy.copy(self)
+		for skim_fn in self.skim_list:
+			setattr(block, skim_fn, table_rows(getattr(self, skim_fn), rows, cache))
+		block.set_skim_dicts()
+		block.pre_MC_trip_table = table_rows(self.pre_MC_trip_table, rows, cache)
+		for var in self.zonal_vars:
+			setattr(block, var, getattr(self, var).take(rows))
+		block.shape = (len(range(*rows.indices(self.shape[0]))), self.shape[1])
+		return block
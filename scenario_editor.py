@@ -10,6 +10,11 @@ import copy
 import re
 import os
 from mc_table_container import table_container
+from mc_param import read_param_table
+from mc_od import od_edit
+from mc_skim_store import omx_skim
+from mc_trace import traced
+from concurrent.futures import ThreadPoolExecutor
 from config import data_path, taz_path, misc_path
 
 
@@ -29,18 +34,25 @@ clean_veh_amount = 0.05
 land_use_shift_factor = 0.5
 congestion_charge_fee = 5
 
-def implement_scenarios(mc_obj):
-	switches = config.scenario_switches
+@traced()
+def implement_scenarios(mc_obj, base = None, switches = None, params = None):
+	# base: optional base run that mc_obj was copied from (Mode_Choice.scenario_copy); model runs are then pivoted from its results
+	# and the CAV scenarios copy base instead of loading inputs again.
+	# switches: scenario switches, by default config.scenario_switches; params: values replacing the default parameter values above.
+	if switches is None:
+		switches = config.scenario_switches
+	params = dict({'clean_veh_amount': clean_veh_amount, 'land_use_shift_factor': land_use_shift_factor,
+		'congestion_charge_fee': congestion_charge_fee}, **(params or {}))
 	if sum(list(switches.values())) == 0: # no scenario is turned on
 		print('No scenario is enabled. Check config.')
 	else:
 		if switches['clean_vehicle']:
 			print(f'"Clean Vehicle" enabled: {scenario_space["Clean Vehicles"]}')
-			decrease_driving_cost(mc_obj, clean_veh_amount)
+			decrease_driving_cost(mc_obj, params['clean_veh_amount'])
 
 		if switches['growth_shift']:
 			print(f'"Land Use" enabled: {scenario_space["Land Use"]}')
-			land_use_growth_shift(mc_obj, land_use_shift_factor)
+			land_use_growth_shift(mc_obj, params['land_use_shift_factor'])
 			
 		if switches['transit_improvements']:
 			print(f'"Transit Improvements" enabled: {scenario_space["Transit Improvements"]}')
@@ -53,52 +65,47 @@ def implement_scenarios(mc_obj):
 			
 		if switches['congestion_charge']:
 			print(f'"Congestion Charge" enabled: {scenario_space["Congestion Charge"]}')
-			congestion_charge(mc_obj, congestion_charge_fee)
+			congestion_charge(mc_obj, params['congestion_charge_fee'])
 			
 		if switches['smart_mobility']:
 			print(f'"Smart Mobility" enabled: {scenario_space["Smart Mobility"]}')
 			smart_mobility_shift_HH(mc_obj)
-			if switches['smart_mobility_management_policy']:
+			if switches.get('smart_mobility_management_policy'):
 				mc_obj.param_file = config.SM_calib_param_mngpol_file
 			else:
 				mc_obj.param_file = config.SM_calib_param_file
 		
 		if switches['CAV'] == False and switches['TDM'] == False:
-			mc_obj.run_model(all_purposes = True)
+			mc_obj.run_model(all_purposes = True, base = base)
 			print('Scenario run is finished. You may now call methods in mc_util to produce output summaries.')
 		
 		elif switches['TDM'] == True and switches['CAV'] == False:
 			print(f'"TDM" enabled: {scenario_space["TDM"]}')
 			# mc_obj.run_model(all_purposes = True)
-			TDM_run(mc_obj)
+			TDM_run(mc_obj, base)
 			print('TDM run is finished. You may now call methods in mc_util to produce output summaries.')										
 		
 		elif switches['CAV'] == True and switches['TDM'] == False:
 			print(f'"CAV" enabled: {scenario_space["CAV"]}')
-			param_out, trip_table_conventional, trip_table_CAV = CAV_input_generator(mc_obj)
-			mc_obj.param_file = param_out
-			mc1 = mode_choice.Mode_Choice(config, run_now = False)
-			mc2 = mode_choice.Mode_Choice(config, run_now = False)
-			mc1.load_input()
-			mc2.load_input()
+			param_out, trip_table_conventional, trip_table_CAV = CAV_input_generator(mc_obj, switches = switches)
+			mc_obj.param_tables = param_out
+			mc1 = loaded_model(base, mc_obj.mode_share_excel_fn.replace('.xlsx', '_conventional.xlsx'))
+			mc2 = loaded_model(base, mc_obj.mode_share_excel_fn.replace('.xlsx', '_CAV.xlsx'))
 			
 			mc1.pre_MC_trip_table = trip_table_conventional
 			mc2.pre_MC_trip_table = trip_table_CAV
-			mc2.param_file = param_out
+			mc2.param_tables = param_out
             
 			print('Running CAV scenario for families with no vehicle or no access to CAV...')
-			mc1.run_model(all_purposes = True)
+			mc1.run_model(all_purposes = True, base = base)
 			print('Running CAV scenario for families with access to CAV...')
-			mc2.run_model(all_purposes = True)
+			mc2.run_model(all_purposes = True, base = base)
 			
 			# combine post mode choice trip tables
 			combined_table = table_container(mc_obj)
 			for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-				for peak in ['PK','OP']:
-					for veh_own in ['0','1']:
-						for mode in mc1.table_container.get_table(purpose)[f'{veh_own}_{peak}']:
-							combined_table.container[purpose][f'{veh_own}_{peak}'][mode] = mc1.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode] + mc2.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode]
-				combined_table.purpose_calculated[purpose] = True
+				combined_table.set_table(purpose, mc1.table_container.get_table(purpose) + mc2.table_container.get_table(purpose))
+			combined_table.modes = mc1.table_container.modes | mc2.table_container.modes
 				
 			mc_obj.table_container = combined_table
 			print('Scenario run is finished. You may now call methods to mc_util to produce output summaries.')
@@ -107,38 +114,32 @@ def implement_scenarios(mc_obj):
 			print(f'"TDM" enabled: {scenario_space["TDM"]}')
 			print(f'"CAV" enabled: {scenario_space["CAV"]}')
 			
-			param_out, trip_table_conventional, trip_table_CAV = CAV_input_generator(mc_obj)
-			mc_obj.param_file = param_out
-			mc1 = mode_choice.Mode_Choice(config, run_now = False)
-			mc2 = mode_choice.Mode_Choice(config, run_now = False)
-			mc1.load_input()
-			mc2.load_input()
+			param_out, trip_table_conventional, trip_table_CAV = CAV_input_generator(mc_obj, switches = switches)
+			mc_obj.param_tables = param_out
+			mc1 = loaded_model(base, mc_obj.mode_share_excel_fn.replace('.xlsx', '_conventional.xlsx'))
+			mc2 = loaded_model(base, mc_obj.mode_share_excel_fn.replace('.xlsx', '_CAV.xlsx'))
 			
 			mc1.pre_MC_trip_table = trip_table_conventional
 			mc2.pre_MC_trip_table = trip_table_CAV
-			mc2.param_file = param_out
+			mc2.param_tables = param_out
 			
 			print('Running CAV scenario for families with no vehicle or no access to CAV...')
-			mc1.run_model(all_purposes = True)
+			mc1.run_model(all_purposes = True, base = base)
 			print('Running CAV scenario for families with access to CAV...')
-			mc2.run_model(all_purposes = True)
+			mc2.run_model(all_purposes = True, base = base)
 			
             # TDM run on both mode choice objects
 			TDM_modify_skim_trip_table(mc1)
-			TDM_run(mc1)
+			TDM_run(mc1, base)
 			TDM_modify_skim_trip_table(mc2)
-			TDM_run(mc2)
+			TDM_run(mc2, base)
                         
             
 			# combine post mode choice trip tables
 			combined_table = table_container(mc_obj)
 			for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
-				for peak in ['PK','OP']:
-					for veh_own in ['0','1']:
-						for mode in mc_obj.table_container.get_table(purpose)[f'{veh_own}_{peak}']:
-							combined_table.container[purpose][f'{veh_own}_{peak}'][mode] = mc1.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode] + mc2.table_container.get_table(purpose)[f'{veh_own}_{peak}'][mode]
-			
-				combined_table.purpose_calculated[purpose] = True
+				combined_table.set_table(purpose, mc1.table_container.get_table(purpose) + mc2.table_container.get_table(purpose))
+			combined_table.modes = mc1.table_container.modes | mc2.table_container.modes
 				
 			mc_obj.table_container = combined_table		
 			
@@ -147,185 +148,231 @@ def implement_scenarios(mc_obj):
 		
 		
 			
+def loaded_model(base = None, mode_share_excel_fn = None):
+	'''
+	Returns a mode choice object with inputs as loaded from the files in config.
+	:param base: mode choice object with loaded, unmodified inputs; if given, a scenario copy of it is returned instead of loading the inputs again.
+	:param mode_share_excel_fn: output Excel filename of the mode share summary
+	'''
+	if base is None:
+		mc_obj = mode_choice.Mode_Choice(config, run_now = False)
+		mc_obj.load_input()
+	else:
+		mc_obj = base.scenario_copy()
+	if mode_share_excel_fn:
+		mc_obj.mode_share_excel_fn = mode_share_excel_fn
+	return mc_obj
+
+def run_batch(specs, out_path = None, n_jobs = 1, return_models = False):
+	'''
+	Runs many scenarios against one loaded base: inputs are loaded and the base model is run once, and every scenario is applied
+	to a scenario copy of the base (see Mode_Choice.scenario_copy) and pivoted from the base results.
+	Scenarios run on a thread pool; each writes its mode share workbook and trip tables to its own folder.
+	:param specs: list of dicts with 'switches' (scenario switches; missing ones are off), optionally 'name' and any of the
+	parameter values clean_veh_amount, land_use_shift_factor and congestion_charge_fee
+	:param out_path: output folder, by default the output path defined in config.py
+	:param n_jobs: number of scenarios run at the same time
+	:param return_models: also return the mode choice object of each scenario, for summaries with mc_util
+	:returns: dict, scenario name: output folder (or (output folder, mode choice object))
+	'''
+	if out_path is None:
+		out_path = config.out_path
+	base = loaded_model()
+	base.run_model(all_purposes = True)
+
+	def run_spec(spec):
+		switches = dict(dict.fromkeys(config.scenario_switches, False), **spec['switches'])
+		name = spec.get('name') or '_'.join([switch for switch in switches if switches[switch]] or ['base'])
+		params = {key: value for key, value in spec.items() if key not in ('name','switches')}
+		scen_path = os.path.join(out_path, name)
+		os.makedirs(scen_path, exist_ok = True)
+
+		mc_obj = base.scenario_copy()
+		mc_obj.mode_share_excel_fn = os.path.join(scen_path, 'MC_mode_share.xlsx')
+		if switches['TDM']: # TDM reruns HBW on top of results for all other purposes
+			for purpose in base.table_container.container:
+				mc_obj.table_container.container[purpose] = base.table_container.container[purpose]
+			mc_obj.table_container.purpose_calculated = dict(base.table_container.purpose_calculated)
+			mc_obj.table_container.modes = set(base.table_container.modes)
+		if sum(switches.values()) == 0:
+			mc_obj.table_container = base.table_container
+		else:
+			implement_scenarios(mc_obj, base, switches, params)
+		mc_util.write_mode_share_to_excel(mc_obj, 'all')
+		mc_util.write_trip_tables(mc_obj, os.path.join(scen_path, 'trip_tables.omx'))
+		print(f'Scenario {name} written to {scen_path}.')
+		return name, (scen_path, mc_obj) if return_models else scen_path
+
+	with ThreadPoolExecutor(n_jobs) as pool:
+		return dict(pool.map(run_spec, specs))
+	
 def show_scenarios():
 	for sc in scenario_space:
 		print(sc+':')
 		print(scenario_space[sc])
 		print('\n')
 
+@traced()
 def decrease_driving_cost(mc_obj, amount):
 	mc_obj.cost_per_mile -= amount
 
+@traced()
 def land_use_growth_shift(mc_obj, factor):
-	modified_2040 = misc_path + "2040_growth_shift_trip_tables.omx"
-#	if factor == 0.5:
-#	
-#		if os.path.isfile(modified_2040):
-#			mc_obj.pre_MC_trip_table = mc_util.store_omx_as_dict(modified_2040)
-#	else:
-	if True:
-		pre_MC_trip_file_2016 = misc_path + "Aggregated Matrix_2016/pre_MC_trip_6_purposes.omx"
-		pre_MC_trip_file_2040 = misc_path + "Aggregated Matrix_2040NB/pre_MC_trip_6_purposes.omx"
-		
-		dense_taz = pd.read_csv(misc_path + "Densified_TAZs.csv").sort_values('ID_FOR_CS')[['ID_FOR_CS']]
-		dense_taz['dense'] = 1
-		all_taz = pd.read_csv(mc_obj.config.taz_file)
-		dense_taz_list = all_taz[['ID_FOR_CS']].merge(dense_taz,on = 'ID_FOR_CS',how = 'left').fillna(0).astype(bool)[:2730]
+	# shifted trip tables are built in memory, so scenarios with different factors can run at the same time (see run_batch)
+	pre_MC_trip_file_2016 = misc_path + "Aggregated Matrix_2016/pre_MC_trip_6_purposes.omx"
+	pre_MC_trip_file_2040 = misc_path + "Aggregated Matrix_2040NB/pre_MC_trip_6_purposes.omx"
+	
+	dense_taz = pd.read_csv(misc_path + "Densified_TAZs.csv").sort_values('ID_FOR_CS')[['ID_FOR_CS']]
+	dense_taz['dense'] = 1
+	all_taz = pd.read_csv(mc_obj.config.taz_file)
+	n = mc_obj.zones.n
+	dense_taz_list = all_taz[['ID_FOR_CS']].merge(dense_taz,on = 'ID_FOR_CS',how = 'left').fillna(0).astype(bool)[:n]
 
-		with omx.open_file(pre_MC_trip_file_2016) as f1 , omx.open_file(pre_MC_trip_file_2040) as f2, omx.open_file(modified_2040,'w') as fout:
-			for name in f1.list_matrices():
-				tt_2016 = np.array(f1[name])[:2730,:2730]
-				tt_2040 = np.array(f2[name])[:2730,:2730]
-				diff = tt_2040 - tt_2016
-				prod_sum_2016 = tt_2016.sum(axis = 1)
-				prod_sum_2040 = tt_2040.sum(axis = 1)
-				prod_sum_diff = diff.sum(axis = 1)
-				sum_to_transfer = prod_sum_diff[~dense_taz_list['dense'].values].sum() * factor
-				prod_sum_diff[~dense_taz_list['dense'].values] = prod_sum_diff[~dense_taz_list['dense'].values] * (1-factor)
-				prod_sum_diff[dense_taz_list['dense'].values] = (prod_sum_diff[dense_taz_list['dense'].values] 
-			+ sum_to_transfer * prod_sum_2040[dense_taz_list['dense'].values] / prod_sum_2040[dense_taz_list['dense'].values].sum())
-				# distribute prod_sum to each attraction zone
-				tt_new = pd.DataFrame(tt_2040).divide(pd.Series(prod_sum_2040), axis = 0).fillna(0).multiply(prod_sum_2016 + prod_sum_diff,axis = 0).values
-				fout[name] = tt_new
+	trip_tables = {}
+	with omx.open_file(pre_MC_trip_file_2016) as f1 , omx.open_file(pre_MC_trip_file_2040) as f2:
+		for name in f1.list_matrices():
+			tt_2016 = np.array(f1[name])[:n,:n]
+			tt_2040 = np.array(f2[name])[:n,:n]
+			diff = tt_2040 - tt_2016
+			prod_sum_2016 = tt_2016.sum(axis = 1)
+			prod_sum_2040 = tt_2040.sum(axis = 1)
+			prod_sum_diff = diff.sum(axis = 1)
+			sum_to_transfer = prod_sum_diff[~dense_taz_list['dense'].values].sum() * factor
+			prod_sum_diff[~dense_taz_list['dense'].values] = prod_sum_diff[~dense_taz_list['dense'].values] * (1-factor)
+			prod_sum_diff[dense_taz_list['dense'].values] = (prod_sum_diff[dense_taz_list['dense'].values] 
+		+ sum_to_transfer * prod_sum_2040[dense_taz_list['dense'].values] / prod_sum_2040[dense_taz_list['dense'].values].sum())
+			# distribute prod_sum to each attraction zone
+			tt_new = pd.DataFrame(tt_2040).divide(pd.Series(prod_sum_2040), axis = 0).fillna(0).multiply(prod_sum_2016 + prod_sum_diff,axis = 0).values
+			trip_tables[name] = np.array(tt_new, dtype = mc_obj.dtype)
 
-		mc_obj.pre_MC_trip_table = mc_util.store_omx_as_dict(modified_2040)
+	mc_obj.pre_MC_trip_table = trip_tables
 	
 def transit_time_reduction(skim, idx_list, time_saving_list, factor = 0.3):
-	for i in range(len(idx_list)):
-		skim[tuple(idx_list[i])] -= min(time_saving_list[i],skim[tuple(idx_list[i])] * factor)
-	return skim
-	
-def transit_modify_skim(mc_obj, TAZ_savings_file = misc_path + 'transit_TAZ_and_time_savings.csv',factor = 0.3):
-	TAZ_savings = pd.read_csv(TAZ_savings_file)
-	ivtt_idx_list = ( TAZ_savings[TAZ_savings['IVTT difference']!=0][['TAZ_0_skim','TAZ_1_skim']].values.tolist()
-+  TAZ_savings[TAZ_savings['IVTT difference']!=0][['TAZ_1_skim','TAZ_0_skim']].values.tolist())
-
-	ivtt_list = TAZ_savings[TAZ_savings['IVTT difference']!=0]['IVTT difference'].values.tolist() * 2
-
-	ovtt_idx_list = ( TAZ_savings[TAZ_savings['OVTT difference']!=0][['TAZ_0_skim','TAZ_1_skim']].values.tolist()
-+  TAZ_savings[TAZ_savings['OVTT difference']!=0][['TAZ_1_skim','TAZ_0_skim']].values.tolist())
+	# reduces the time of each OD pair by its time saving, but by no more than factor of the time
+	return od_edit([idx[0] for idx in idx_list], [idx[1] for idx in idx_list], time_saving_list).apply(skim, time_saving(factor))
 
-	ovtt_list = TAZ_savings[TAZ_savings['OVTT difference']!=0]['OVTT difference'].values.tolist() * 2
+def time_saving(factor):
+	return lambda time, saving: time - np.fmin(saving, time * factor)
 	
-	mc_obj.DAT_B_skim_PK['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_B_skim_PK['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.DAT_B_skim_OP['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_B_skim_OP['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.DAT_CR_skim_PK['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_CR_skim_PK['Total_IVTT'], ivtt_idx_list, ivtt_list,factor) 
-	mc_obj.DAT_CR_skim_OP['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_CR_skim_OP['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.DAT_RT_skim_PK['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_RT_skim_PK['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.DAT_RT_skim_OP['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_RT_skim_OP['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.DAT_LB_skim_PK['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_LB_skim_PK['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.DAT_LB_skim_OP['Total_IVTT'] = transit_time_reduction(mc_obj.DAT_LB_skim_OP['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.WAT_skim_PK['Total_IVTT'] = transit_time_reduction(mc_obj.WAT_skim_PK['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
-	mc_obj.WAT_skim_OP['Total_IVTT'] = transit_time_reduction(mc_obj.WAT_skim_PK['Total_IVTT'], ivtt_idx_list, ivtt_list,factor)
+@traced()
+def transit_modify_skim(mc_obj, TAZ_savings_file = misc_path + 'transit_TAZ_and_time_savings.csv',factor = 0.3):
+	# OD pairs (both directions) with a time saving, as index arrays shared by all transit skims
+	ivtt = od_edit.from_csv(TAZ_savings_file, 'IVTT difference', symmetric = True, skip_zero = True)
+	ovtt = od_edit.from_csv(TAZ_savings_file, 'OVTT difference', symmetric = True, skip_zero = True)
 	
-	mc_obj.DAT_B_skim_PK['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_B_skim_PK['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.DAT_B_skim_OP['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_B_skim_OP['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.DAT_CR_skim_PK['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_CR_skim_PK['Total_OVTT'], ovtt_idx_list, ovtt_list,factor) 
-	mc_obj.DAT_CR_skim_OP['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_CR_skim_OP['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.DAT_RT_skim_PK['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_RT_skim_PK['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.DAT_RT_skim_OP['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_RT_skim_OP['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.DAT_LB_skim_PK['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_LB_skim_PK['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.DAT_LB_skim_OP['Total_OVTT'] = transit_time_reduction(mc_obj.DAT_LB_skim_OP['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.WAT_skim_PK['Total_OVTT'] = transit_time_reduction(mc_obj.WAT_skim_PK['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
-	mc_obj.WAT_skim_OP['Total_OVTT'] = transit_time_reduction(mc_obj.WAT_skim_PK['Total_OVTT'], ovtt_idx_list, ovtt_list,factor)
+	transit_skims = [mc_obj.DAT_B_skim_PK, mc_obj.DAT_B_skim_OP, mc_obj.DAT_CR_skim_PK, mc_obj.DAT_CR_skim_OP, mc_obj.DAT_RT_skim_PK,
+	mc_obj.DAT_RT_skim_OP, mc_obj.DAT_LB_skim_PK, mc_obj.DAT_LB_skim_OP, mc_obj.WAT_skim_PK, mc_obj.WAT_skim_OP]
+	ivtt.apply_all([(skim, 'Total_IVTT') for skim in transit_skims], time_saving(factor), config.n_threads)
+	ovtt.apply_all([(skim, 'Total_OVTT') for skim in transit_skims], time_saving(factor), config.n_threads)
 
 def bike_time_distance_reduction(time_skim, dist_skim, idx_list, factor_list):
-	for i in range(len(idx_list)):
-		time_skim[tuple(idx_list[i])] -= time_skim[tuple(idx_list[i])]*factor_list[i]
-		dist_skim[tuple(idx_list[i])] -= dist_skim[tuple(idx_list[i])]*factor_list[i]
-	return time_skim, dist_skim
+	pairs = od_edit([idx[0] for idx in idx_list], [idx[1] for idx in idx_list], factor_list)
+	return pairs.apply(time_skim, distance_factor), pairs.apply(dist_skim, distance_factor)
+
+def distance_factor(table, factor):
+	return table - table * factor
 	
+@traced()
 def active_transportation_modify_skim(mc_obj, bike_improvement_TAZ_file = misc_path + 'bike_trip_factors.csv'):
-	TAZ_pair_df = pd.read_csv(bike_improvement_TAZ_file)
-	idx_list = TAZ_pair_df[['TAZ_0_skim','TAZ_1_skim']].values.tolist()
-	factor_list = TAZ_pair_df['factor_avg'].values.tolist()
-
-	mc_obj.bike_skim['BikeTime'], mc_obj.bike_skim['Length (Skim)'] = bike_time_distance_reduction(mc_obj.bike_skim['BikeTime'], mc_obj.bike_skim['Length (Skim)'],idx_list, factor_list)
+	pairs = od_edit.from_csv(bike_improvement_TAZ_file, 'factor_avg')
+	pairs.apply_all([(mc_obj.bike_skim, 'BikeTime'), (mc_obj.bike_skim, 'Length (Skim)')], distance_factor, config.n_threads)
 	
 	mc_obj.bike_skim['OneMileorLess'] = 1*(mc_obj.bike_skim['Length (Skim)']<=1)
 	
 	
+@traced()
 def active_transportation_decrease_PEV(mc_obj, factor = 0.9):
-    mc_obj.AccPEV[0:447,0:447] *= factor
-    mc_obj.EgrPEV[0:447,0:447] *= factor
+	boston = mc_obj.zones.subsets['boston']
+	mc_obj.AccPEV.scale_block(boston, boston, factor)
+	mc_obj.EgrPEV.scale_block(boston, boston, factor)
 
 
+@traced()
 def congestion_charge(mc_obj,amount):
 	cong_zones = mc_obj.taz_lu[mc_obj.taz_lu['BOSTON_NB'].isin(['Downtown','North End','West End','South Boston Waterfront','Chinatown','Bay Village','Back Bay'])]['ID'].values
 	
-	cong_charge_table = np.zeros((2730,2730))
-	cong_charge_table[np.ix_(np.where(np.logical_not(mc_obj.taz_lu['ID'].iloc[:2730].isin(cong_zones).values))[0],
-      np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(cong_zones).values)[0])] = amount
+	# OD pairs from outside into the charged zones; only these cells are recorded as skim edits
+	charged_zones = mc_obj.zones.index_of(cong_zones)
+	charged = np.ix_(np.setdiff1d(np.arange(mc_obj.zones.n), charged_zones), charged_zones)
 	
-	mc_obj.drive_skim_PK['Auto_Toll (Skim)'] += cong_charge_table
-	mc_obj.drive_skim_OP['Auto_Toll (Skim)'] += cong_charge_table
+	mc_obj.drive_skim_PK.update('Auto_Toll (Skim)', charged, mc_obj.drive_skim_PK['Auto_Toll (Skim)'][charged] + amount)
+	mc_obj.drive_skim_OP.update('Auto_Toll (Skim)', charged, mc_obj.drive_skim_OP['Auto_Toll (Skim)'][charged] + amount)
 	
+@traced()
 def TDM_modify_skim_trip_table(mc_obj, fare_reduction = 1, trip_reduction = 0.0035):
 	# Run after the main process has finished
 	tdm_zones = mc_obj.taz_lu[mc_obj.taz_lu['BOSTON_NB'].isin(['Downtown','North End','West End','South Boston Waterfront','Chinatown','Bay Village','Back Bay'])]['ID'].values
+	tdm_index = mc_obj.zones.index_of(tdm_zones)
 	# reduce transit fare for HBW trips ending in Downtown equivalent neighborhoods
-	mc_obj.DAT_B_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]] -= np.minimum(1,mc_obj.DAT_B_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]])
-	mc_obj.DAT_CR_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]] -= np.minimum(1,mc_obj.DAT_CR_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]])
-	mc_obj.DAT_RT_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]] -= np.minimum(1,mc_obj.DAT_RT_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]])
-	mc_obj.DAT_LB_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]] -= np.minimum(1,mc_obj.DAT_LB_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]])
-	mc_obj.WAT_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]] -= np.minimum(1,mc_obj.WAT_skim_PK['Total_Cost'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]])
+	for skim in [mc_obj.DAT_B_skim_PK, mc_obj.DAT_CR_skim_PK, mc_obj.DAT_RT_skim_PK, mc_obj.DAT_LB_skim_PK, mc_obj.WAT_skim_PK]:
+		tdm_cells = np.ix_(np.arange(skim.shape('Total_Cost')[0]), tdm_index)
+		cost = skim['Total_Cost'][tdm_cells]
+		skim.update('Total_Cost', tdm_cells, cost - np.minimum(1,cost))
 	
 	# reduce HBW trips going to these neighborhoods by 0.35%
-	mc_obj.pre_MC_trip_table['HBW_PK_0Auto'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]] *= 1-trip_reduction
-	mc_obj.pre_MC_trip_table['HBW_PK_wAuto'][:,np.where(mc_obj.taz_lu['ID'].iloc[:2730].isin(tdm_zones).values)[0]] *= 1-trip_reduction
+	for segment in ['HBW_PK_0Auto','HBW_PK_wAuto']:
+		trip_table = np.array(mc_obj.pre_MC_trip_table[segment]) # trip tables shared with a base run are read-only
+		trip_table[:,tdm_index] *= 1-trip_reduction
+		mc_obj.pre_MC_trip_table[segment] = trip_table
 
-def TDM_run(mc_obj):
+@traced()
+def TDM_run(mc_obj, base = None):
 	# check if mc_obj contains trip tables for all purposes other than HBW
 	if all(mc_obj.table_container.purpose_calculated[purpose] for purpose in ['HBO','NHB', 'HBSc1','HBSc2','HBSc3']):
 		print('Rerunning HBW for TDM policy scenario...')
-		mc_obj.run_for_purpose('HBW')
+		mc_obj.run_for_purpose('HBW', base)
 		print('HBW trips rerun with TDM policy scenario.')
 	else: print('Requires trip tables for all other purposes. Run full model before implementing TDM.')	
 
 	
 	
-def CAV_input_generator(mc_obj, cost_reduction = 0.50, parking_reduction = 0.75, travel_time_reduction = 0.50, HH_shift = 0.1):
+@traced()
+def CAV_input_generator(mc_obj, cost_reduction = 0.50, parking_reduction = 0.75, travel_time_reduction = 0.50, HH_shift = 0.1, switches = None):
 	# create param for CAV households, alternative baseline and mangement policies
-	switches = config.scenario_switches
+	if switches is None:
+		switches = config.scenario_switches
 	if switches['smart_mobility'] == True:
-		if switches['smart_mobility_management_policy']:
+		if switches.get('smart_mobility_management_policy'):
 			param_file = mc_obj.config.SM_calib_param_file
 		else:
 			param_file = mc_obj.config.SM_calib_param_mngpol_file
-		param_out = misc_path + "CAV_param_SM_on.xlsx"
-		#param_mngpol_out = r"X:\Proj\2018\180021 - ISE_GHGMitAnly\001\Data\CTPS_Data\Mode Choice Related\CAV_mngpol_param_SM_on.xlsx"
 	else:
 		param_file = mc_obj.config.param_file
-		param_out = misc_path + "CAV_param_SM_off.xlsx"
-		#param_mngpol_out = r"X:\Proj\2018\180021 - ISE_GHGMitAnly\001\Data\CTPS_Data\Mode Choice Related\CAV_mngpol_param_SM_off.xlsx"
 	
-	writer1 = pd.ExcelWriter(param_out,engine = 'openpyxl')
+	# CAV parameter tables are kept in memory (see Mode_Choice.param_tables)
+	param_out = {}
 	for purpose in ['HBW','HBO','NHB', 'HBSc1','HBSc2','HBSc3']:
 	# TODO: what's the CAV management policy?
-		param = pd.read_excel(param_file, sheet_name = purpose,index_col = 0)
+		param = read_param_table(param_file, purpose)
+		DA = param['mode'] == 'DA'
 		try:
-			param.loc['DA','Cost'] *= (1 - cost_reduction)
-			param.loc['DA','Parking'] *= (1 - parking_reduction)
-			param.loc['DA','IVTT'] *= (1 - travel_time_reduction)
+			param.loc[DA,'Cost'] *= (1 - cost_reduction)
+			param.loc[DA,'Parking'] *= (1 - parking_reduction)
+			param.loc[DA,'IVTT'] *= (1 - travel_time_reduction)
 		except: pass
-		param.to_excel(writer1, sheet_name = purpose)
-	writer1.save()
+		param_out[purpose] = param
 	
 	# create two sets of trip tables: one with all 0-veh HHs and 90% of the 1+ veh HHs, the other with 10% of the 1+ veh HHs
-	trip_table_conventional = copy.deepcopy(mc_obj.pre_MC_trip_table)
-	trip_table_CAV = copy.deepcopy(mc_obj.pre_MC_trip_table)
-    
-	hh_0_veh = list(filter(re.compile('.*_0Auto').match, list(trip_table_conventional.keys())))
-	hh_1_veh = list(filter(re.compile('.*_wAuto').match, list(trip_table_conventional.keys())))
-	for segment in hh_1_veh:
-		trip_table_conventional[segment] *= (1-HH_shift)
-		trip_table_CAV[segment] *= HH_shift
+	# tables are scaled into new arrays; those of mc_obj may be shared with a base run and are left unchanged
+	if isinstance(mc_obj.pre_MC_trip_table, omx_skim):
+		raise ValueError('CAV scenarios scale whole pre-MC trip tables and cannot run with streamed trip tables (config.stream_rows)')
+	segments = list(mc_obj.pre_MC_trip_table.keys())
+	hh_0_veh = list(filter(re.compile('.*_0Auto').match, segments))
+	hh_1_veh = list(filter(re.compile('.*_wAuto').match, segments))
+	trip_table_conventional = {}
+	trip_table_CAV = {}
+	for segment in segments:
+		table = mc_obj.pre_MC_trip_table[segment]
+		if segment in hh_1_veh:
+			trip_table_conventional[segment] = table * (1-HH_shift)
+			trip_table_CAV[segment] = table * HH_shift
+		else:
+			trip_table_conventional[segment] = np.array(table)
+			trip_table_CAV[segment] = table * 0 if segment in hh_0_veh else np.array(table)
 	
-	for segment in hh_0_veh:
-		trip_table_CAV[segment] *= 0
-    
 	return param_out, trip_table_conventional, trip_table_CAV
 	
+@traced()
 def smart_mobility_shift_HH(mc_obj):
 	# check if mc_obj has a calibrated smart mobility parameter file
 	
@@ -350,10 +397,11 @@ def smart_mobility_shift_HH(mc_obj):
 			hh_0_veh = list(filter(re.compile('.*_0Auto').match, list(mc_obj.pre_MC_trip_table.keys())))
 			hh_1_veh = list(filter(re.compile('.*_wAuto').match, list(mc_obj.pre_MC_trip_table.keys())))
 			
+			n = mc_obj.zones.n
 			for segment in hh_0_veh:
-				mc_obj.pre_MC_trip_table[i][:2730,:2730][taz['TOWN']==town+',MA',:] *= hh0_new_total / hh0_old_total
+				mc_obj.pre_MC_trip_table[i][:n,:n][taz['TOWN']==town+',MA',:] *= hh0_new_total / hh0_old_total
 			
 			for segment in hh_1_veh:
-				mc_obj.pre_MC_trip_table[i][:2730,:2730][taz['TOWN'] == town+',MA',:] *= hh1_new_total / hh1_old_total
+				mc_obj.pre_MC_trip_table[i][:n,:n][taz['TOWN'] == town+',MA',:] *= hh1_new_total / hh1_old_total
 
 				
@@ -0,0 +1,47 @@
+# coding: utf-8
+'''
+Checks that every execution mode (sparse demand, row blocks, streaming, worker processes, utility cache, derived tables) gives the
+trips of the dense run, on synthetic inputs of a small zone system (see benchmarks/generate_inputs.py).
+The execution modes and the comparison are those of run_benchmarks.py --check.
+
+Usage: python -m pytest tests
+'''
+import os
+import sys
+import warnings
+import pytest
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+sys.path.insert(0, os.path.join(repo_path, 'benchmarks'))
+from generate_inputs import generate
+from run_benchmarks import dense_mode, execution_modes, run_all_purposes, compare_trips
+
+n_zones = 120 # two blocks of the row block and streaming modes
+
+
+@pytest.fixture(scope = 'module')
+def dense_run(tmp_path_factory):
+	'''
+	Runs all purposes densely on generated inputs, from their working folder (input and output paths in config.py are
+	relative to it), which stays the working folder for the tests of this module.
+	:returns: config module, settings of the dense run, Mode_Choice object of the dense run
+	'''
+	root = tmp_path_factory.mktemp('zone_system')
+	cwd = os.getcwd()
+	os.chdir(generate(str(root), n_zones))
+	warnings.simplefilter('ignore')
+	import config
+	dense = dict(dense_mode, table_spill_path = os.path.join(str(root), 'output'))
+	try:
+		yield config, dense, run_all_purposes(config, dense)
+	finally:
+		os.chdir(cwd)
+
+
+@pytest.mark.parametrize('mode', list(execution_modes))
+def test_execution_mode_equals_dense_run(dense_run, mode):
+	config, dense, reference = dense_run
+	settings, runs = execution_modes[mode]
+	rtol = 1e-9 if config.precision == 'float64' else 1e-4
+	compare_trips(run_all_purposes(config, dict(dense, **settings), runs), reference, rtol)